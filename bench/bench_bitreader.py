@@ -0,0 +1,57 @@
+"""
+Slice header decoding, BitReader against bitstring's BitStream.
+
+Run from the top of the checkout with: python bench/bench_bitreader.py
+"""
+
+import os
+import random
+
+from common import IDR_SLICE_HEADER, NON_IDR_SLICE_HEADER, best_of, report
+
+from flvlib.tags import SLICE_HEADER_BYTES
+from flvlib.bitreader import BitReader
+
+try:
+    from bitstring import BitStream
+except ImportError:
+    BitStream = None
+
+
+def decode_bitstream(data):
+    s = BitStream('0x' + data.encode('hex'))
+    return (s.read('uint:1'), s.read('uint:2'), s.read('uint:5'),
+            s.read('ue'), s.read('ue'), s.read('ue'), s.read('uint:4'))
+
+
+def decode_bitreader(data):
+    s = BitReader(data[:SLICE_HEADER_BYTES])
+    return (s.read(1), s.read(2), s.read(5),
+            s.read_ue(), s.read_ue(), s.read_ue(), s.read(4))
+
+
+def main():
+    rnd = random.Random(0)
+    nalus = []
+    for i in xrange(500):
+        header = (i % 10 == 0) and IDR_SLICE_HEADER or NON_IDR_SLICE_HEADER
+        size = rnd.randint(20000, 200000)
+        nalus.append(header + os.urandom(size - len(header)))
+
+    def run(decode):
+        for nalu in nalus:
+            decode(nalu)
+
+    if BitStream is not None:
+        for nalu in nalus:
+            assert decode_bitstream(nalu) == decode_bitreader(nalu)
+        report("slice headers, BitStream", len(nalus), "NALUs",
+               best_of(lambda: run(decode_bitstream)))
+    else:
+        print "bitstring is not installed, skipping the BitStream run"
+    report("slice headers, BitReader", len(nalus), "NALUs",
+           best_of(lambda: run(decode_bitreader)))
+
+
+if __name__ == '__main__':
+    main()
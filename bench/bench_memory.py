@@ -0,0 +1,80 @@
+"""
+Memory taken by materialised tags, per 100k tags.
+
+Compares the slotted tag classes with the same attributes stored in
+instance dictionaries, the way tags were laid out before. Sizes are summed
+with sys.getsizeof, since tracemalloc is not available on Python 2.
+Payloads are views into a mapped file and are not counted.
+
+Run from the top of the checkout with: python bench/bench_memory.py
+"""
+
+import os
+import sys
+
+from common import make_flv
+
+from flvlib import tags
+from flvlib.helpers import MappedFile
+
+
+class DictObject(object):
+    pass
+
+
+def slot_names(obj):
+    names = []
+    for klass in type(obj).__mro__:
+        names.extend(getattr(klass, '__slots__', ()))
+    return [name for name in names if hasattr(obj, name)]
+
+
+def as_dict_object(obj):
+    ret = DictObject()
+    for name in slot_names(obj):
+        setattr(ret, name, getattr(obj, name))
+    return ret
+
+
+def with_dicts(tag_list):
+    ret = []
+    for tag in tag_list:
+        copy = as_dict_object(tag)
+        if isinstance(tag, tags.VideoTag):
+            copy.nalus = [as_dict_object(nalu) for nalu in tag.nalus]
+        ret.append(copy)
+    return ret
+
+
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    nalus = getattr(obj, 'nalus', None)
+    if nalus:
+        size += sys.getsizeof(nalus)
+        size += sum([object_size(nalu) for nalu in nalus])
+    return size
+
+
+def main():
+    path = make_flv(seconds=2000, video_size=200, audio_size=50)
+    f = open(path, 'rb')
+    m = MappedFile(f)
+    try:
+        flv = tags.FLV(m)
+        flv.read_tags()
+        count = len(flv.tags)
+        for name, objects in (("dict based tags", with_dicts(flv.tags)),
+                              ("slotted tags", flv.tags)):
+            size = sum([object_size(obj) for obj in objects])
+            print "%-40s %8.1f MB per 100k tags" % (
+                name, size * 100000.0 / count / 1048576)
+    finally:
+        m.close()
+        f.close()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
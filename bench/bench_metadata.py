@@ -0,0 +1,106 @@
+"""
+Building onMetaData for a file with many keyframes, the way index-flv
+does it: find out how much the metadata grows, shift the filepositions by
+that and encode the result. Also encoding and decoding the keyframe
+tables one number at a time against in bulk, and decoding onMetaData
+from a file object against decoding it from a string.
+
+Run from the top of the checkout with: python bench/bench_metadata.py
+"""
+
+from StringIO import StringIO
+
+from common import best_of, report
+
+from flvlib import astypes
+from flvlib.astypes import FLVObject
+from flvlib.tags import create_script_tag, script_tag_size
+
+KEYFRAMES = 200000
+
+
+def make_metadata():
+    keyframes = FLVObject()
+    keyframes.times = [i * 2.0 for i in xrange(KEYFRAMES)]
+    keyframes.filepositions = [13 + i * 100000 for i in xrange(KEYFRAMES)]
+    return {'duration': KEYFRAMES * 2.0, 'keyframes': keyframes,
+            'metadatacreator': 'flvlib'}
+
+
+def shift(metadata, difference):
+    keyframes = metadata['keyframes']
+    keyframes.filepositions = [pos + difference
+                               for pos in keyframes.filepositions]
+
+
+def encode_twice(metadata):
+    difference = len(create_script_tag('onMetaData', metadata)) - 100
+    shift(metadata, difference)
+    return create_script_tag('onMetaData', metadata)
+
+
+def size_then_encode(metadata):
+    difference = script_tag_size('onMetaData', metadata) - 100
+    shift(metadata, difference)
+    return create_script_tag('onMetaData', metadata)
+
+
+def make_elementwise(l):
+    return astypes.make_ui32(len(l)) + ''.join(
+        [astypes.make_script_data_value(value) for value in l])
+
+
+def get_elementwise(data):
+    f = StringIO(data)
+    return [astypes.get_script_data_value(f)
+            for _ in xrange(astypes.get_ui32(f))]
+
+
+def bench_arrays():
+    times = make_metadata()['keyframes'].times
+    data = astypes.make_strict_array(times)
+    assert make_elementwise(times) == data
+    assert get_elementwise(data) == astypes.get_strict_array(StringIO(data))
+
+    report("encode numbers one by one", KEYFRAMES, "numbers",
+           best_of(lambda: make_elementwise(times)))
+    report("encode numbers in bulk", KEYFRAMES, "numbers",
+           best_of(lambda: astypes.make_strict_array(times)))
+    report("decode numbers one by one", KEYFRAMES, "numbers",
+           best_of(lambda: get_elementwise(data)))
+    report("decode numbers in bulk", KEYFRAMES, "numbers",
+           best_of(lambda: astypes.get_strict_array(StringIO(data))))
+
+
+def bench_decode():
+    tag = create_script_tag('onMetaData', make_metadata())
+    data = tag[11:-4]
+
+    def get():
+        f = StringIO(data)
+        astypes.get_ui8(f)
+        return astypes.get_script_data_variable(f, max_offset=len(data))
+
+    def decode():
+        return astypes.decode_script_data_variable(data, 1, len(data))[0]
+
+    assert get() == decode()
+    report("decode onMetaData from a file", KEYFRAMES, "keyframes",
+           best_of(get))
+    report("decode onMetaData from a string", KEYFRAMES, "keyframes",
+           best_of(decode))
+
+
+def main():
+    assert encode_twice(make_metadata()) == size_then_encode(make_metadata())
+    for name, func in (("encode twice", encode_twice),
+                       ("compute size, encode once", size_then_encode)):
+        metadata = make_metadata()
+        report("onMetaData, %s" % name, KEYFRAMES, "keyframes",
+               best_of(lambda: func(metadata)))
+    bench_arrays()
+    bench_decode()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Tag parsing throughput.
+
+Run from the top of the checkout with: python bench/bench_tags.py
+"""
+
+import os
+import multiprocessing
+
+from common import make_flv, best_of, report
+
+from flvlib import tags, index
+from flvlib.primitives import get_ui8, get_ui24, get_ui32, get_si32_extended
+from flvlib.primitives import EndOfFile
+
+
+class LegacyHeaderFLV(tags.FLV):
+    """
+    Reads the tag header field by field, the way flvlib used to before
+    tag headers were decoded with a single read.
+    """
+
+    def get_next_tag(self):
+        f = self.f
+        try:
+            tag_type = get_ui8(f)
+        except EndOfFile:
+            raise tags.EndOfTags
+        tag = self.tag_type_to_class(tag_type)(self, f)
+        tag.type = tag_type
+        tag.offset = f.tell() - 1
+        tag.size = get_ui24(f)
+        tag.timestamp = get_si32_extended(f)
+        if tag.timestamp < 0:
+            tags.log.warning("The tag at offset 0x%08X has negative "
+                             "timestamp: %d", tag.offset, tag.timestamp)
+        stream_id = get_ui24(f)
+        tags.ensure(stream_id, 0, "StreamID non zero: 0x%06X" % stream_id)
+        tag.parse_tag_content()
+        tag.previous_tag_size = get_ui32(f)
+        tags.ensure(tag.previous_tag_size, tag.size + 11,
+                    "PreviousTagSize of %d (0x%08X) "
+                    "not equal to actual tag size of %d (0x%08X)" %
+                    (tag.previous_tag_size, tag.previous_tag_size,
+                     tag.size + 11, tag.size + 11))
+        return tag
+
+
+def count_tags(path, flv_class=tags.FLV, payload=tags.PAYLOAD_FULL):
+    f = open(path, 'rb')
+    count = 0
+    for tag in flv_class(f).iter_tags(payload):
+        count += 1
+    f.close()
+    return count
+
+
+def bench_header(path):
+    count = count_tags(path)
+    report("tag headers, field by field", count, "tags",
+           best_of(lambda: count_tags(path, LegacyHeaderFLV)))
+    report("tag headers, single read", count, "tags",
+           best_of(lambda: count_tags(path)))
+
+
+def bench_payload(path):
+    size = os.path.getsize(path) / 1048576.0
+    for payload in (tags.PAYLOAD_FULL, tags.PAYLOAD_FLAGS, tags.PAYLOAD_NONE):
+        report("H.264 file, payload=%s" % payload, size, "MB",
+               best_of(lambda: count_tags(path, payload=payload)))
+
+    def build_index():
+        f = open(path, 'rb')
+        tags.FLV(f).build_index()
+        f.close()
+
+    report("H.264 file, build_index", size, "MB", best_of(build_index))
+
+    processes = multiprocessing.cpu_count()
+    report("H.264 file, parallel index, %d CPUs" % processes,
+           size, "MB", best_of(lambda: index.build_index_parallel(path)))
+
+
+def main():
+    path = make_flv(seconds=600, video=False, audio_size=64)
+    try:
+        bench_header(path)
+    finally:
+        os.remove(path)
+
+    path = make_flv(seconds=120, video_size=20000)
+    try:
+        bench_payload(path)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
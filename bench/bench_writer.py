@@ -0,0 +1,60 @@
+"""
+Writing tags, Tag.write against FLVWriter.
+
+Run from the top of the checkout with: python bench/bench_writer.py
+"""
+
+import os
+import tempfile
+
+from common import make_flv, best_of, report
+
+from flvlib import tags
+from flvlib.helpers import MappedFile
+
+
+def write_tags(path, tag_list):
+    fo = open(path, 'wb')
+    fo.write(tags.create_flv_header())
+    for tag in tag_list:
+        tag.write(fo)
+    fo.close()
+
+
+def write_tags_batched(path, tag_list):
+    fo = open(path, 'wb')
+    writer = tags.FLVWriter(fo)
+    writer.write_header()
+    write_tag = writer.write_tag
+    for tag in tag_list:
+        write_tag(tag)
+    writer.close()
+    fo.close()
+
+
+def main():
+    path = make_flv(seconds=300, video_size=2000, audio_size=200)
+    fd, out = tempfile.mkstemp()
+    os.close(fd)
+    f = open(path, 'rb')
+    m = MappedFile(f)
+    try:
+        tag_list = list(tags.FLV(m).iter_tags())
+        size = os.path.getsize(path) / 1048576.0
+
+        write_tags_batched(out, tag_list)
+        assert open(out, 'rb').read() == open(path, 'rb').read()
+
+        report("Tag.write", size, "MB",
+               best_of(lambda: write_tags(out, tag_list)))
+        report("FLVWriter", size, "MB",
+               best_of(lambda: write_tags_batched(out, tag_list)))
+    finally:
+        m.close()
+        f.close()
+        os.remove(path)
+        os.remove(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import random
+import tempfile
+
+# Benchmark the flvlib from this checkout, not an installed one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+
+from flvlib.constants import TAG_TYPE_AUDIO, TAG_TYPE_VIDEO
+from flvlib.primitives import make_ui8, make_ui24, make_ui32
+from flvlib.tags import create_flv_tag, create_flv_header, create_script_tag
+
+
+# An IDR and a non-IDR slice header: first_mb_in_slice 0, slice_type 7 or 5,
+# pic_parameter_set_id 0 and a 4 bit frame_num
+IDR_SLICE_HEADER = '\x65\x88\x80'
+NON_IDR_SLICE_HEADER = '\x41\x9a\x00'
+
+
+def make_h264_tag(timestamp, keyframe, nalu_size):
+    if keyframe:
+        flags, header = 0x17, IDR_SLICE_HEADER
+    else:
+        flags, header = 0x27, NON_IDR_SLICE_HEADER
+    nalu = header + os.urandom(nalu_size - len(header))
+    data = ''.join([make_ui8(flags), make_ui8(1), make_ui24(0),
+                    make_ui32(len(nalu)), nalu])
+    return create_flv_tag(TAG_TYPE_VIDEO, data, timestamp)
+
+
+def make_mp3_tag(timestamp, size):
+    data = make_ui8(0x2f) + os.urandom(size - 1)
+    return create_flv_tag(TAG_TYPE_AUDIO, data, timestamp)
+
+
+def make_flv(seconds=60, fps=25, gop=50, video_size=4000, audio_size=400,
+             metadata=None, video=True):
+    """
+    Write a synthetic H.264 + MP3 FLV file to a temporary path and return
+    the path. The caller is responsible for removing it.
+    """
+    fd, path = tempfile.mkstemp(suffix='.flv')
+    f = os.fdopen(fd, 'wb')
+    f.write(create_flv_header(has_video=video))
+    if metadata is not None:
+        f.write(create_script_tag('onMetaData', metadata))
+    rnd = random.Random(0)
+    for frame in xrange(seconds * fps):
+        timestamp = frame * 1000 / fps
+        if video:
+            size = rnd.randint(video_size / 2, video_size * 3 / 2)
+            f.write(make_h264_tag(timestamp, frame % gop == 0, size))
+        f.write(make_mp3_tag(timestamp, audio_size))
+    f.close()
+    return path
+
+
+def best_of(func, repeat=3):
+    """Return the best wall clock time of running func repeat times."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, count, unit, elapsed):
+    print "%-40s %10.0f %s/s (%.3fs)" % (name, count / elapsed, unit, elapsed)
@@ -1,4 +1,7 @@
 import os
+import sys
+import array
+import struct
 import calendar
 import datetime
 import logging
@@ -26,6 +29,9 @@ def get_number(f, max_offset=None):
 def make_number(num):
     return make_double(num)
 
+def number_size(num):
+    return 8
+
 
 # Boolean
 def get_boolean(f, max_offset=None):
@@ -35,6 +41,9 @@ def get_boolean(f, max_offset=None):
 def make_boolean(value):
     return make_ui8((value and 1) or 0)
 
+def boolean_size(value):
+    return 1
+
 
 # String
 def get_string(f, max_offset=None):
@@ -51,6 +60,11 @@ def make_string(string):
     length = make_ui16(len(string))
     return length + string
 
+def string_size(string):
+    if isinstance(string, unicode):
+        string = string.encode('UTF-8')
+    return 2 + len(string)
+
 
 # Longstring
 def get_longstring(f, max_offset=None):
@@ -67,6 +81,11 @@ def make_longstring(string):
     length = make_ui32(len(string))
     return length + string
 
+def longstring_size(string):
+    if isinstance(string, unicode):
+        string = string.encode('UTF-8')
+    return 4 + len(string)
+
 
 # ECMA Array
 class ECMAArray(OrderedAttrDict):
@@ -98,20 +117,72 @@ def make_ecma_array(d):
     marker = make_ui24(9)
     return length + rest + marker
 
+def ecma_array_size(d):
+    return 4 + sum([script_data_variable_size(name, value)
+                    for name, value in d.iteritems()]) + 3
+
 
 # Strict Array
+
+# Arrays of numbers, like the keyframe tables in onMetaData, are encoded
+# and decoded in bulk, up to NUMBER_BLOCK elements at a time. Each element
+# is the VALUE_TYPE_NUMBER marker, a zero byte, and a big endian double.
+NUMBER_BLOCK = 65536
+NUMBER_CLASSES = frozenset([int, long, float])
+
+def is_number_array(l):
+    if isinstance(l, array.array):
+        return l.typecode not in ('c', 'u')
+    return NUMBER_CLASSES.issuperset(map(type, l))
+
+def pack_numbers(numbers):
+    doubles = array.array('d', numbers)
+    if sys.byteorder == 'little':
+        doubles.byteswap()
+    raw = doubles.tostring()
+    ret = bytearray(9 * len(doubles))
+    for i in xrange(8):
+        ret[i + 1::9] = raw[i::8]
+    return str(ret)
+
+def unpack_numbers(data):
+    raw = bytearray(len(data) // 9 * 8)
+    for i in xrange(8):
+        raw[i::8] = data[i + 1::9]
+    doubles = array.array('d', str(raw))
+    if sys.byteorder == 'little':
+        doubles.byteswap()
+    return doubles.tolist()
+
 def get_strict_array(f, max_offset=None):
     length = get_ui32(f)
     log.debug("The length is %d", length)
-    elements = [get_script_data_value(f, max_offset=max_offset)
-                for _ in xrange(length)]
+    elements = []
+    while len(elements) < length:
+        count = min(length - len(elements), NUMBER_BLOCK)
+        start = f.tell()
+        data = f.read(9 * count)
+        if len(data) == 9 * count and data[::9] == '\x00' * count:
+            elements.extend(unpack_numbers(data))
+            continue
+        # not just numbers, decode the rest one by one
+        f.seek(start)
+        elements.extend([get_script_data_value(f, max_offset=max_offset)
+                         for _ in xrange(length - len(elements))])
     return elements
 
 def make_strict_array(l):
     ret = make_ui32(len(l))
+    if is_number_array(l):
+        return ret + pack_numbers(l)
     rest = ''.join([make_script_data_value(value) for value in l])
     return ret + rest
 
+def strict_array_size(l):
+    if is_number_array(l):
+        return 4 + 9 * len(l)
+    return 4 + sum([script_data_value_size(value) for value in l])
+
 
 # Date
 def get_date(f, max_offset=None):
@@ -137,6 +208,9 @@ def make_date(date):
     offset = 0
     return ret + make_si16(offset)
 
+def date_size(date):
+    return 10
+
 
 # Null
 def get_null(f, max_offset=None):
@@ -145,6 +219,9 @@ def get_null(f, max_offset=None):
 def make_null(none):
     return ''
 
+def null_size(none):
+    return 0
+
 
 # Object
 class FLVObject(OrderedAttrDict):
@@ -180,6 +257,14 @@ def make_object(obj):
     marker = make_ui24(9)
     return ret + marker
 
+def object_size(obj):
+    try:
+        iterator = obj.iteritems()
+    except AttributeError:
+        iterator = obj.__dict__.iteritems()
+    return sum([script_data_variable_size(name, value)
+                for name, value in iterator]) + 3
+
 
 # MovieClip
 class MovieClip(object):
@@ -200,6 +285,9 @@ def get_movieclip(f, max_offset=None):
 def make_movieclip(clip):
     return make_string(clip.path)
 
+def movieclip_size(clip):
+    return string_size(clip.path)
+
 
 # Undefined
 class Undefined(object):
@@ -216,6 +304,9 @@ def get_undefined(f, max_offset=None):
 def make_undefined(undefined):
     return ''
 
+def undefined_size(undefined):
+    return 0
+
 
 # Reference
 class Reference(object):
@@ -236,6 +327,9 @@ def get_reference(f, max_offset=None):
 def make_reference(reference):
     return make_ui16(reference.ref)
 
+def reference_size(reference):
+    return 2
+
 
 as_type_to_getter_and_maker = {
     VALUE_TYPE_NUMBER: (get_number, make_number),
@@ -252,6 +346,23 @@ as_type_to_getter_and_maker = {
     VALUE_TYPE_LONGSTRING: (get_longstring, make_longstring)
 }
 
+# The number of bytes the makers above produce, computed without encoding
+# anything
+as_type_to_size = {
+    VALUE_TYPE_NUMBER: number_size,
+    VALUE_TYPE_BOOLEAN: boolean_size,
+    VALUE_TYPE_STRING: string_size,
+    VALUE_TYPE_OBJECT: object_size,
+    VALUE_TYPE_MOVIECLIP: movieclip_size,
+    VALUE_TYPE_NULL: null_size,
+    VALUE_TYPE_UNDEFINED: undefined_size,
+    VALUE_TYPE_REFERENCE: reference_size,
+    VALUE_TYPE_ECMA_ARRAY: ecma_array_size,
+    VALUE_TYPE_STRICT_ARRAY: strict_array_size,
+    VALUE_TYPE_DATE: date_size,
+    VALUE_TYPE_LONGSTRING: longstring_size
+}
+
 type_to_as_type = {
     bool: VALUE_TYPE_BOOLEAN,
     int: VALUE_TYPE_NUMBER,
@@ -262,6 +373,7 @@ type_to_as_type = {
     str: VALUE_TYPE_STRING,
     unicode: VALUE_TYPE_STRING,
     list: VALUE_TYPE_STRICT_ARRAY,
+    array.array: VALUE_TYPE_STRICT_ARRAY,
     dict: VALUE_TYPE_ECMA_ARRAY,
     ECMAArray: VALUE_TYPE_ECMA_ARRAY,
     datetime.datetime: VALUE_TYPE_DATE,
@@ -285,6 +397,9 @@ def make_script_data_variable(name, value):
     ret = make_string(name) + make_script_data_value(value)
     return ret
 
+def script_data_variable_size(name, value):
+    return string_size(name) + script_data_value_size(value)
+
 
 # SCRIPTDATAVALUE
 def get_script_data_value(f, max_offset=None):
@@ -308,3 +423,743 @@ def make_script_data_value(value):
     type_tag = make_ui8(value_type)
     ret = make_value(value)
     return type_tag + ret
+
+def script_data_value_size(value):
+    # The size of make_script_data_value(value), including the type marker
+    value_type = type_to_as_type.get(value.__class__, VALUE_TYPE_OBJECT)
+    return 1 + as_type_to_size[value_type](value)
+
+
+# Decoding from strings. The decode_* functions do the same as their get_*
+# counterparts, but on a string (or buffer) and an offset into it instead of
+# a file. They return (value, new_offset). end plays the role of max_offset.
+
+UI8 = struct.Struct(">B")
+UI16 = struct.Struct(">H")
+UI32 = struct.Struct(">I")
+DOUBLE = struct.Struct(">d")
+DATE = struct.Struct(">dh")
+
+def _unpack_from(s, data, offset):
+    try:
+        return s.unpack_from(data, offset)[0], offset + s.size
+    except struct.error:
+        raise EndOfFile
+
+def _read_from(data, offset, length):
+    if offset + length > len(data):
+        raise EndOfFile
+    return data[offset:offset + length], offset + length
+
+def decode_number(data, offset, end=None):
+    return _unpack_from(DOUBLE, data, offset)
+
+def decode_boolean(data, offset, end=None):
+    value, offset = _unpack_from(UI8, data, offset)
+    return bool(value), offset
+
+def decode_string(data, offset, end=None):
+    length, offset = _unpack_from(UI16, data, offset)
+    return _read_from(data, offset, length)
+
+def decode_longstring(data, offset, end=None):
+    length, offset = _unpack_from(UI32, data, offset)
+    return _read_from(data, offset, length)
+
+def _decode_members(data, offset, end, add, variable_end):
+    # The members of ECMA arrays and objects, up to the end marker
+    while True:
+        if end and offset == end:
+            log.debug("Prematurely terminating reading members")
+            return offset
+        if offset + 3 > len(data):
+            raise EndOfFile
+        if data[offset:offset + 3] == '\x00\x00\x09':
+            return offset + 3
+        name, offset = decode_string(data, offset)
+        value, offset = decode_script_data_value(data, offset, variable_end)
+        add(name, value)
+
+def decode_ecma_array(data, offset, end=None):
+    length, offset = _unpack_from(UI32, data, offset)
+    ret = ECMAArray()
+    offset = _decode_members(data, offset, end, ret.__setitem__, end)
+    return ret, offset
+
+def decode_strict_array(data, offset, end=None):
+    length, offset = _unpack_from(UI32, data, offset)
+    size = 9 * length
+    if (offset + size <= len(data) and
+        data[offset:offset + size:9] == '\x00' * length):
+        return unpack_numbers(data[offset:offset + size]), offset + size
+    elements = []
+    for _ in xrange(length):
+        value, offset = decode_script_data_value(data, offset, end)
+        elements.append(value)
+    return elements, offset
+
+def decode_date(data, offset, end=None):
+    try:
+        timestamp, _ignored = DATE.unpack_from(data, offset)
+    except struct.error:
+        raise EndOfFile
+    return (datetime.datetime.fromtimestamp(timestamp / 1000.0, utc),
+            offset + DATE.size)
+
+def decode_null(data, offset, end=None):
+    return None, offset
+
+def decode_object(data, offset, end=None):
+    ret = FLVObject()
+    # like get_object, the members themselves are not limited by end
+    offset = _decode_members(data, offset, end, ret.__setattr__, None)
+    return ret, offset
+
+def decode_movieclip(data, offset, end=None):
+    path, offset = decode_string(data, offset)
+    return MovieClip(path), offset
+
+def decode_undefined(data, offset, end=None):
+    return Undefined(), offset
+
+def decode_reference(data, offset, end=None):
+    ref, offset = _unpack_from(UI16, data, offset)
+    return Reference(ref), offset
+
+as_type_to_decoder = {
+    VALUE_TYPE_NUMBER: decode_number,
+    VALUE_TYPE_BOOLEAN: decode_boolean,
+    VALUE_TYPE_STRING: decode_string,
+    VALUE_TYPE_OBJECT: decode_object,
+    VALUE_TYPE_MOVIECLIP: decode_movieclip,
+    VALUE_TYPE_NULL: decode_null,
+    VALUE_TYPE_UNDEFINED: decode_undefined,
+    VALUE_TYPE_REFERENCE: decode_reference,
+    VALUE_TYPE_ECMA_ARRAY: decode_ecma_array,
+    VALUE_TYPE_STRICT_ARRAY: decode_strict_array,
+    VALUE_TYPE_DATE: decode_date,
+    VALUE_TYPE_LONGSTRING: decode_longstring
+}
+
+def decode_script_data_variable(data, offset=0, end=None):
+    name, offset = decode_string(data, offset)
+    value, offset = decode_script_data_value(data, offset, end)
+    return (name, value), offset
+
+def decode_script_data_value(data, offset=0, end=None):
+    value_type, offset = _unpack_from(UI8, data, offset)
+    try:
+        decode_value = as_type_to_decoder[value_type]
+    except KeyError:
+        raise MalformedFLV("Invalid script data value type: %d", value_type)
+    return decode_value(data, offset, end)
+
+
+# AMF3. Script data can switch from AMF0 to AMF3 with the AVM+ marker.
+# Strings, objects and traits that occur more than once in an AMF3 value
+# are sent as references to tables of the ones seen before, so decoding and
+# encoding go through objects that keep those tables. Like decode_*, the
+# decoder works on a string and an offset into it.
+
+AMF3_MIN_INT = -0x10000000
+AMF3_MAX_INT = 0x0FFFFFFF
+
+
+class XMLDocument(str):
+    pass
+
+
+class XML(str):
+    pass
+
+
+class ByteArray(str):
+    pass
+
+
+class TypedObject(FLVObject):
+    """
+    An object of a named ActionScript class.
+    """
+
+    def __init__(self, class_name, dict=None, **kwargs):
+        self.__dict__['class_name'] = class_name
+        FLVObject.__init__(self, dict, **kwargs)
+
+
+class Vector(list):
+    """
+    An ActionScript Vector. kind is one of AMF3_VECTOR_INT, AMF3_VECTOR_UINT,
+    AMF3_VECTOR_DOUBLE and AMF3_VECTOR_OBJECT, class_name is the type of the
+    elements of object vectors.
+    """
+
+    def __init__(self, items=(), kind=AMF3_VECTOR_OBJECT, fixed=False,
+                 class_name='*'):
+        list.__init__(self, items)
+        self.kind = kind
+        self.fixed = fixed
+        self.class_name = class_name
+
+
+class Dictionary(dict):
+
+    def __init__(self, items=(), weak_keys=False):
+        dict.__init__(self, items)
+        self.weak_keys = weak_keys
+
+
+class AMF3Value(object):
+    """
+    Wraps a value to have make_script_data_value encode it as AMF3.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, AMF3Value) and self.value == other.value
+
+    def __repr__(self):
+        return "<AMF3Value %r>" % (self.value,)
+
+
+def make_u29(n):
+    if n < 0x80:
+        return chr(n)
+    if n < 0x4000:
+        return chr(n >> 7 | 0x80) + chr(n & 0x7F)
+    if n < 0x200000:
+        return (chr(n >> 14 | 0x80) + chr(n >> 7 & 0x7F | 0x80) +
+                chr(n & 0x7F))
+    if n < 0x20000000:
+        return (chr(n >> 22 | 0x80) + chr(n >> 15 & 0x7F | 0x80) +
+                chr(n >> 8 & 0x7F | 0x80) + chr(n & 0xFF))
+    raise ValueError("Too large for an AMF3 U29: %d" % n)
+
+
+vector_formats = {
+    AMF3_VECTOR_INT: 'i',
+    AMF3_VECTOR_UINT: 'I',
+    AMF3_VECTOR_DOUBLE: 'd'
+}
+
+
+class AMF3Decoder(object):
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+        self.strings = []
+        self.objects = []
+        self.traits = []
+
+    def read(self, length):
+        offset = self.offset
+        if offset + length > len(self.data):
+            raise EndOfFile
+        self.offset = offset + length
+        return self.data[offset:offset + length]
+
+    def read_byte(self):
+        try:
+            ret = ord(self.data[self.offset])
+        except IndexError:
+            raise EndOfFile
+        self.offset += 1
+        return ret
+
+    def read_u29(self):
+        # Seven bits in each of the first three bytes, as long as the high
+        # bit is set, then eight in the fourth
+        data, offset = self.data, self.offset
+        ret = 0
+        try:
+            for i in xrange(offset, offset + 3):
+                byte = ord(data[i])
+                if byte < 0x80:
+                    self.offset = i + 1
+                    return (ret << 7) | byte
+                ret = (ret << 7) | (byte & 0x7F)
+            self.offset = offset + 4
+            return (ret << 8) | ord(data[offset + 3])
+        except IndexError:
+            raise EndOfFile
+
+    def read_double(self):
+        value, self.offset = _unpack_from(DOUBLE, self.data, self.offset)
+        return value
+
+    def get_reference(self, table, index):
+        try:
+            return table[index]
+        except IndexError:
+            raise MalformedFLV("Invalid AMF3 reference: %d" % index)
+
+    def read_header(self):
+        # Complex values start with a U29 that has the low bit clear for a
+        # reference to the object table, and set for a value that follows
+        # inline. Returns the rest of the U29 and None, or None and the
+        # referenced object.
+        ref = self.read_u29()
+        if ref & 1:
+            return ref >> 1, None
+        return None, self.get_reference(self.objects, ref >> 1)
+
+    def read_value(self):
+        marker = self.read_byte()
+        try:
+            read = self.readers[marker]
+        except KeyError:
+            raise MalformedFLV("Invalid AMF3 value type: %d" % marker)
+        return read(self)
+
+    def read_undefined(self):
+        return Undefined()
+
+    def read_null(self):
+        return None
+
+    def read_false(self):
+        return False
+
+    def read_true(self):
+        return True
+
+    def read_integer(self):
+        ret = self.read_u29()
+        if ret & 0x10000000:
+            ret -= 0x20000000
+        return ret
+
+    def read_string(self):
+        # Strings have their own table and the empty string is never
+        # referenced
+        ref = self.read_u29()
+        if not ref & 1:
+            return self.get_reference(self.strings, ref >> 1)
+        length = ref >> 1
+        if not length:
+            return ''
+        ret = self.read(length)
+        self.strings.append(ret)
+        return ret
+
+    def read_xml_document(self):
+        return self.read_blob(XMLDocument)
+
+    def read_xml(self):
+        return self.read_blob(XML)
+
+    def read_byte_array(self):
+        return self.read_blob(ByteArray)
+
+    def read_blob(self, klass):
+        length, ret = self.read_header()
+        if length is None:
+            return ret
+        ret = klass(self.read(length))
+        self.objects.append(ret)
+        return ret
+
+    def read_date(self):
+        inline, ret = self.read_header()
+        if inline is None:
+            return ret
+        timestamp = self.read_double() / 1000.0
+        ret = datetime.datetime.fromtimestamp(timestamp, utc)
+        self.objects.append(ret)
+        return ret
+
+    def read_array(self):
+        # A dense part and an associative part. Arrays without the latter
+        # become lists, others ECMAArrays with integer keys for the dense
+        # elements.
+        count, ret = self.read_header()
+        if count is None:
+            return ret
+        name = self.read_string()
+        if name:
+            ret = ECMAArray()
+            self.objects.append(ret)
+            while name:
+                ret[name] = self.read_value()
+                name = self.read_string()
+            for i in xrange(count):
+                ret[i] = self.read_value()
+        else:
+            ret = []
+            self.objects.append(ret)
+            for _ in xrange(count):
+                ret.append(self.read_value())
+        return ret
+
+    def read_traits(self, ref):
+        if not ref & 1:
+            return self.get_reference(self.traits, ref >> 1)
+        if ref & 2:
+            class_name = self.read_string()
+            raise MalformedFLV("Can't decode externalizable AMF3 class %s" %
+                               class_name)
+        dynamic = bool(ref & 4)
+        class_name = self.read_string()
+        names = [self.read_string() for _ in xrange(ref >> 3)]
+        ret = (class_name, names, dynamic)
+        self.traits.append(ret)
+        return ret
+
+    def read_object(self):
+        ref, ret = self.read_header()
+        if ref is None:
+            return ret
+        class_name, names, dynamic = self.read_traits(ref)
+        if class_name:
+            ret = TypedObject(class_name)
+        else:
+            ret = FLVObject()
+        self.objects.append(ret)
+        for name in names:
+            setattr(ret, name, self.read_value())
+        if dynamic:
+            name = self.read_string()
+            while name:
+                setattr(ret, name, self.read_value())
+                name = self.read_string()
+        return ret
+
+    def read_number_vector(self, kind):
+        count, ret = self.read_header()
+        if count is None:
+            return ret
+        fixed = bool(self.read_byte())
+        # the elements are fixed size, so unpack them all at once
+        fmt = '>%d%s' % (count, vector_formats[kind])
+        items = struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+        ret = Vector(items, kind, fixed)
+        self.objects.append(ret)
+        return ret
+
+    def read_int_vector(self):
+        return self.read_number_vector(AMF3_VECTOR_INT)
+
+    def read_uint_vector(self):
+        return self.read_number_vector(AMF3_VECTOR_UINT)
+
+    def read_double_vector(self):
+        return self.read_number_vector(AMF3_VECTOR_DOUBLE)
+
+    def read_object_vector(self):
+        count, ret = self.read_header()
+        if count is None:
+            return ret
+        fixed = bool(self.read_byte())
+        ret = Vector((), AMF3_VECTOR_OBJECT, fixed, self.read_string())
+        self.objects.append(ret)
+        for _ in xrange(count):
+            ret.append(self.read_value())
+        return ret
+
+    def read_dictionary(self):
+        count, ret = self.read_header()
+        if count is None:
+            return ret
+        ret = Dictionary(weak_keys=bool(self.read_byte()))
+        self.objects.append(ret)
+        for _ in xrange(count):
+            key = self.read_value()
+            try:
+                ret[key] = self.read_value()
+            except TypeError:
+                raise MalformedFLV("Unhashable AMF3 dictionary key: %r" %
+                                   (key,))
+        return ret
+
+    readers = {
+        AMF3_UNDEFINED: read_undefined,
+        AMF3_NULL: read_null,
+        AMF3_FALSE: read_false,
+        AMF3_TRUE: read_true,
+        AMF3_INTEGER: read_integer,
+        AMF3_DOUBLE: read_double,
+        AMF3_STRING: read_string,
+        AMF3_XML_DOCUMENT: read_xml_document,
+        AMF3_DATE: read_date,
+        AMF3_ARRAY: read_array,
+        AMF3_OBJECT: read_object,
+        AMF3_XML: read_xml,
+        AMF3_BYTE_ARRAY: read_byte_array,
+        AMF3_VECTOR_INT: read_int_vector,
+        AMF3_VECTOR_UINT: read_uint_vector,
+        AMF3_VECTOR_DOUBLE: read_double_vector,
+        AMF3_VECTOR_OBJECT: read_object_vector,
+        AMF3_DICTIONARY: read_dictionary
+    }
+
+
+class AMF3Encoder(object):
+
+    def __init__(self):
+        self.chunks = []
+        self.strings = {}
+        self.objects = {}
+        self.traits = {}
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+    def write_marker(self, marker):
+        self.chunks.append(chr(marker))
+
+    def write_reference(self, value):
+        # Writes a reference if value was written before and returns True,
+        # otherwise gives it the next slot in the object table. The values
+        # are kept in the table, so their ids can't get reused.
+        try:
+            index = self.objects[id(value)][0]
+        except KeyError:
+            self.objects[id(value)] = (len(self.objects), value)
+            return False
+        self.chunks.append(make_u29(index << 1))
+        return True
+
+    def write_value(self, value):
+        amf3_type = type_to_amf3_type.get(value.__class__, AMF3_OBJECT)
+        self.writers[amf3_type](self, value)
+
+    def write_undefined(self, undefined):
+        self.write_marker(AMF3_UNDEFINED)
+
+    def write_null(self, none):
+        self.write_marker(AMF3_NULL)
+
+    def write_boolean(self, value):
+        self.write_marker((value and AMF3_TRUE) or AMF3_FALSE)
+
+    def write_integer(self, value):
+        if not AMF3_MIN_INT <= value <= AMF3_MAX_INT:
+            self.write_double(value)
+            return
+        self.write_marker(AMF3_INTEGER)
+        self.chunks.append(make_u29(value & 0x1FFFFFFF))
+
+    def write_double(self, value):
+        self.write_marker(AMF3_DOUBLE)
+        self.chunks.append(DOUBLE.pack(value))
+
+    def write_string_data(self, string):
+        if isinstance(string, unicode):
+            string = string.encode('UTF-8')
+        if not string:
+            self.chunks.append(make_u29(1))
+            return
+        index = self.strings.get(string)
+        if index is not None:
+            self.chunks.append(make_u29(index << 1))
+            return
+        self.strings[string] = len(self.strings)
+        self.chunks.append(make_u29(len(string) << 1 | 1))
+        self.chunks.append(string)
+
+    def write_string(self, string):
+        self.write_marker(AMF3_STRING)
+        self.write_string_data(string)
+
+    def write_blob(self, marker, blob):
+        self.write_marker(marker)
+        if self.write_reference(blob):
+            return
+        self.chunks.append(make_u29(len(blob) << 1 | 1))
+        self.chunks.append(blob)
+
+    def write_xml_document(self, xml):
+        self.write_blob(AMF3_XML_DOCUMENT, xml)
+
+    def write_xml(self, xml):
+        self.write_blob(AMF3_XML, xml)
+
+    def write_byte_array(self, data):
+        self.write_blob(AMF3_BYTE_ARRAY, data)
+
+    def write_date(self, date):
+        self.write_marker(AMF3_DATE)
+        if self.write_reference(date):
+            return
+        if date.tzinfo:
+            utc_date = date.astimezone(utc)
+        else:
+            # assume it's UTC
+            utc_date = date.replace(tzinfo=utc)
+        timestamp = (calendar.timegm(utc_date.timetuple()) * 1000 +
+                     utc_date.microsecond / 1000.0)
+        self.chunks.append(make_u29(1))
+        self.chunks.append(DOUBLE.pack(timestamp))
+
+    def write_array(self, l):
+        # Lists have only a dense part, dictionaries the integer keys from 0
+        # up in the dense part and the rest in the associative part
+        self.write_marker(AMF3_ARRAY)
+        if self.write_reference(l):
+            return
+        if isinstance(l, dict) or isinstance(l, ECMAArray):
+            dense = 0
+            while dense in l:
+                dense += 1
+            dense_items = [l[i] for i in xrange(dense)]
+            items = [(key, value) for key, value in l.iteritems()
+                     if not (isinstance(key, (int, long)) and
+                             0 <= key < dense)]
+        else:
+            dense_items = l
+            items = ()
+        self.chunks.append(make_u29(len(dense_items) << 1 | 1))
+        for key, value in items:
+            if not isinstance(key, basestring):
+                key = str(key)
+            self.write_string_data(key)
+            self.write_value(value)
+        self.chunks.append(make_u29(1))
+        for value in dense_items:
+            self.write_value(value)
+
+    def write_object(self, obj):
+        # Objects are written with dynamic members only
+        self.write_marker(AMF3_OBJECT)
+        if self.write_reference(obj):
+            return
+        class_name = getattr(obj, 'class_name', '')
+        index = self.traits.get(class_name)
+        if index is None:
+            self.traits[class_name] = len(self.traits)
+            self.chunks.append(make_u29(0x0B))
+            self.write_string_data(class_name)
+        else:
+            self.chunks.append(make_u29(index << 2 | 1))
+        try:
+            iterator = obj.iteritems()
+        except AttributeError:
+            iterator = obj.__dict__.iteritems()
+        for name, value in iterator:
+            self.write_string_data(name)
+            self.write_value(value)
+        self.chunks.append(make_u29(1))
+
+    def write_vector(self, vector):
+        self.write_marker(vector.kind)
+        if self.write_reference(vector):
+            return
+        self.chunks.append(make_u29(len(vector) << 1 | 1))
+        self.chunks.append(chr(bool(vector.fixed)))
+        if vector.kind == AMF3_VECTOR_OBJECT:
+            self.write_string_data(vector.class_name)
+            for value in vector:
+                self.write_value(value)
+        else:
+            fmt = '>%d%s' % (len(vector), vector_formats[vector.kind])
+            self.chunks.append(struct.pack(fmt, *vector))
+
+    def write_dictionary(self, d):
+        self.write_marker(AMF3_DICTIONARY)
+        if self.write_reference(d):
+            return
+        self.chunks.append(make_u29(len(d) << 1 | 1))
+        self.chunks.append(chr(bool(d.weak_keys)))
+        for key, value in d.iteritems():
+            self.write_value(key)
+            self.write_value(value)
+
+    writers = {
+        AMF3_UNDEFINED: write_undefined,
+        AMF3_NULL: write_null,
+        AMF3_TRUE: write_boolean,
+        AMF3_INTEGER: write_integer,
+        AMF3_DOUBLE: write_double,
+        AMF3_STRING: write_string,
+        AMF3_XML_DOCUMENT: write_xml_document,
+        AMF3_DATE: write_date,
+        AMF3_ARRAY: write_array,
+        AMF3_OBJECT: write_object,
+        AMF3_XML: write_xml,
+        AMF3_BYTE_ARRAY: write_byte_array,
+        AMF3_VECTOR_OBJECT: write_vector,
+        AMF3_DICTIONARY: write_dictionary
+    }
+
+
+type_to_amf3_type = {
+    type(None): AMF3_NULL,
+    Undefined: AMF3_UNDEFINED,
+    bool: AMF3_TRUE,
+    int: AMF3_INTEGER,
+    long: AMF3_INTEGER,
+    float: AMF3_DOUBLE,
+    str: AMF3_STRING,
+    unicode: AMF3_STRING,
+    XMLDocument: AMF3_XML_DOCUMENT,
+    XML: AMF3_XML,
+    ByteArray: AMF3_BYTE_ARRAY,
+    datetime.datetime: AMF3_DATE,
+    list: AMF3_ARRAY,
+    tuple: AMF3_ARRAY,
+    array.array: AMF3_ARRAY,
+    dict: AMF3_ARRAY,
+    ECMAArray: AMF3_ARRAY,
+    # the vector's kind says which type it's written as
+    Vector: AMF3_VECTOR_OBJECT,
+    Dictionary: AMF3_DICTIONARY
+}
+
+def decode_amf3_value(data, offset=0, end=None):
+    decoder = AMF3Decoder(data, offset)
+    value = decoder.read_value()
+    return value, decoder.offset
+
+def make_amf3_value(value):
+    encoder = AMF3Encoder()
+    encoder.write_value(value)
+    return encoder.getvalue()
+
+
+# AVM+ Object, an AMF3 value in AMF0 script data. The reference tables
+# start out empty for each of them.
+AVMPLUS_READ_SIZE = 4096
+
+def get_avmplus(f, max_offset=None):
+    start = f.tell()
+    if max_offset:
+        value, offset = decode_amf3_value(f.read(max_offset - start))
+        f.seek(start + offset)
+        return value
+
+    # How long the value is only comes out when decoding it, so read in
+    # growing chunks until it's all there
+    data = ''
+    size = AVMPLUS_READ_SIZE
+    while True:
+        more = f.read(size - len(data))
+        data += more
+        try:
+            value, offset = decode_amf3_value(data)
+            break
+        except EndOfFile:
+            if not more:
+                raise
+            size *= 2
+    f.seek(start + offset)
+    return value
+
+
+def make_avmplus(value):
+    return make_amf3_value(value.value)
+
+
+def avmplus_size(value):
+    return len(make_avmplus(value))
+
+
+def decode_avmplus(data, offset, end=None):
+    return decode_amf3_value(data, offset)
+
+as_type_to_getter_and_maker[VALUE_TYPE_AVMPLUS] = (get_avmplus, make_avmplus)
+as_type_to_size[VALUE_TYPE_AVMPLUS] = avmplus_size
+as_type_to_decoder[VALUE_TYPE_AVMPLUS] = decode_avmplus
+type_to_as_type[AMF3Value] = VALUE_TYPE_AVMPLUS
@@ -0,0 +1,64 @@
+"""
+Bit level reading of H.264 NAL unit headers.
+"""
+
+from binascii import hexlify
+
+from primitives import EndOfFile
+
+
+__all__ = ['BitReader', 'remove_emulation_prevention']
+
+
+def remove_emulation_prevention(data):
+    # Inside a NAL unit every 0x000003 sequence stands for 0x0000, the
+    # 0x03 byte is only there to avoid start code emulation
+    if '\x00\x00\x03' not in data:
+        return data
+    parts = data.split('\x00\x00\x03')
+    return '\x00\x00'.join(parts)
+
+
+class BitReader(object):
+    """
+    Reads big endian bit fields and Exp-Golomb codes from a string.
+
+    The whole string is turned into one integer and fields are extracted
+    with shifts and masks, so it's meant to be used on the first few
+    dozen bytes of a NAL unit, not on the entire payload.
+    """
+
+    def __init__(self, data, emulation_prevention=True):
+        if emulation_prevention:
+            data = remove_emulation_prevention(data)
+        self.length = len(data) * 8
+        self.value = (data and int(hexlify(data), 16)) or 0
+        self.pos = 0
+
+    def read(self, bits):
+        pos = self.pos + bits
+        if pos > self.length:
+            raise EndOfFile
+        self.pos = pos
+        return (self.value >> (self.length - pos)) & ((1 << bits) - 1)
+
+    def read_ue(self):
+        # unsigned Exp-Golomb: N zero bits, a one bit and N more bits
+        value, length, pos = self.value, self.length, self.pos
+        zeros = 0
+        while True:
+            if pos >= length:
+                raise EndOfFile
+            pos += 1
+            if (value >> (length - pos)) & 1:
+                break
+            zeros += 1
+        self.pos = pos
+        return (1 << zeros) - 1 + self.read(zeros)
+
+    def read_se(self):
+        # signed Exp-Golomb: 1, 2, 3, 4... map to 1, -1, 2, -2...
+        code = self.read_ue()
+        if code & 1:
+            return (code + 1) >> 1
+        return -(code >> 1)
@@ -148,6 +148,8 @@ h264_packet_type_to_string = {
  VALUE_TYPE_DATE,
  VALUE_TYPE_LONGSTRING) = range(10, 13)
 
+VALUE_TYPE_AVMPLUS = 0x11
+
 value_type_to_string = {
     VALUE_TYPE_NUMBER: 'Number',
     VALUE_TYPE_BOOLEAN: 'Boolean',
@@ -160,5 +162,48 @@ value_type_to_string = {
     VALUE_TYPE_ECMA_ARRAY: 'ECMA Array',
     VALUE_TYPE_STRICT_ARRAY: 'Strict Array',
     VALUE_TYPE_DATE: 'Date',
-    VALUE_TYPE_LONGSTRING: 'Longstring'
+    VALUE_TYPE_LONGSTRING: 'Longstring',
+    VALUE_TYPE_AVMPLUS: 'AVM+ Object'
+}
+
+
+# AMF3 value type
+(AMF3_UNDEFINED,
+ AMF3_NULL,
+ AMF3_FALSE,
+ AMF3_TRUE,
+ AMF3_INTEGER,
+ AMF3_DOUBLE,
+ AMF3_STRING,
+ AMF3_XML_DOCUMENT,
+ AMF3_DATE,
+ AMF3_ARRAY,
+ AMF3_OBJECT,
+ AMF3_XML,
+ AMF3_BYTE_ARRAY,
+ AMF3_VECTOR_INT,
+ AMF3_VECTOR_UINT,
+ AMF3_VECTOR_DOUBLE,
+ AMF3_VECTOR_OBJECT,
+ AMF3_DICTIONARY) = range(18)
+
+amf3_type_to_string = {
+    AMF3_UNDEFINED: 'Undefined',
+    AMF3_NULL: 'Null',
+    AMF3_FALSE: 'False',
+    AMF3_TRUE: 'True',
+    AMF3_INTEGER: 'Integer',
+    AMF3_DOUBLE: 'Double',
+    AMF3_STRING: 'String',
+    AMF3_XML_DOCUMENT: 'XMLDocument',
+    AMF3_DATE: 'Date',
+    AMF3_ARRAY: 'Array',
+    AMF3_OBJECT: 'Object',
+    AMF3_XML: 'XML',
+    AMF3_BYTE_ARRAY: 'ByteArray',
+    AMF3_VECTOR_INT: 'Vector.<int>',
+    AMF3_VECTOR_UINT: 'Vector.<uint>',
+    AMF3_VECTOR_DOUBLE: 'Vector.<Number>',
+    AMF3_VECTOR_OBJECT: 'Vector.<Object>',
+    AMF3_DICTIONARY: 'Dictionary'
 }
@@ -1,10 +1,57 @@
 import os
 import time
+import errno
+import mmap
+import select
 import datetime
 
 from StringIO import StringIO
 from UserDict import DictMixin
 
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except (ImportError, OSError):
+    _libc = None
+
+
+def _libc_function(name, restype=None, argtypes=None):
+    # Return a C library function, or None if it isn't available
+    try:
+        func = getattr(_libc, name)
+    except AttributeError:
+        return None
+    if restype is not None:
+        func.restype = restype
+        func.argtypes = argtypes
+    return func
+
+_inotify_init = _libc_function('inotify_init')
+_inotify_add_watch = _libc_function('inotify_add_watch')
+if _libc is not None:
+    # ctypes only has c_ssize_t from Python 2.7 on, it is a long on Linux
+    _ssize_t = getattr(ctypes, 'c_ssize_t', ctypes.c_long)
+    _copy_file_range = _libc_function(
+        'copy_file_range', _ssize_t,
+        [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint])
+    _sendfile = _libc_function(
+        'sendfile64', _ssize_t,
+        [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+         ctypes.c_size_t])
+else:
+    _copy_file_range = _sendfile = None
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+
+# copy_range falls back to the next method when the kernel says one of
+# these, and it moves at most this much per call or chunk
+COPY_FALLBACK_ERRORS = (errno.EINVAL, errno.ENOSYS, errno.EXDEV,
+                        errno.EOPNOTSUPP, errno.EBADF, errno.ESPIPE)
+COPY_CHUNK_SIZE = 1 << 20
+
 
 class UTC(datetime.tzinfo):
     """
@@ -206,3 +253,193 @@ def force_remove(path):
         os.remove(path)
     except OSError:
         pass
+
+
+class MappedFile(object):
+    """
+    A read-only file object backed by a memory map of an open file.
+
+    Besides the usual read(), seek() and tell() it provides read_view(),
+    which returns a buffer object pointing into the map instead of a copy
+    of the data. The views are only valid until the MappedFile is closed.
+    """
+
+    def __init__(self, f):
+        self.name = getattr(f, 'name', None)
+        self.pos = 0
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        else:
+            # empty files cannot be mapped
+            self.map = None
+        self.data = self.map or ''
+        self.size = size
+
+    def read(self, size=-1):
+        start = self.pos
+        if size < 0:
+            end = self.size
+        else:
+            end = min(start + size, self.size)
+        self.pos = end = max(start, end)
+        return self.data[start:end]
+
+    def read_view(self, size):
+        start = self.pos
+        self.pos = end = max(start, min(start + size, self.size))
+        return buffer(self.data, start, end - start)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError(22, "Invalid argument")
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.data = ''
+        self.size = 0
+
+
+def _kernel_copy(copy, in_fd, out_fd, offset, count):
+    # Copy with copy_file_range or sendfile, returns how much got copied
+    # before the end of the input or an error that a fallback may fix
+    position = ctypes.c_int64(offset)
+    copied = 0
+    while copied < count:
+        size = min(count - copied, COPY_CHUNK_SIZE)
+        if copy is _copy_file_range:
+            ret = copy(in_fd, ctypes.byref(position), out_fd, None, size, 0)
+        else:
+            ret = copy(out_fd, in_fd, ctypes.byref(position), size)
+        if ret < 0:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            if copied == 0 and error in COPY_FALLBACK_ERRORS:
+                return 0
+            raise IOError(error, os.strerror(error))
+        if ret == 0:
+            break
+        copied += ret
+    return copied
+
+
+def copy_range(fi, fo, offset, count=None):
+    """
+    Copy count bytes starting at offset from fi to the current position
+    of fo, or everything up to the end of fi if count is None. Returns the
+    number of bytes copied, which is less than count if fi ends first.
+
+    For real files the kernel moves the data, with copy_file_range (which
+    can share the blocks on filesystems that support reflinks) or
+    sendfile, falling back to copying in chunks. Either way memory use
+    doesn't depend on count. Afterwards fi is positioned after the copied
+    range.
+    """
+    if count is None:
+        fi.seek(0, os.SEEK_END)
+        count = max(fi.tell() - offset, 0)
+
+    copied = 0
+    try:
+        in_fd, out_fd = fi.fileno(), fo.fileno()
+    except (AttributeError, IOError):
+        in_fd = out_fd = None
+    if in_fd is not None and count:
+        fo.flush()
+        for copy in (_copy_file_range, _sendfile):
+            if copy is None:
+                continue
+            copied = _kernel_copy(copy, in_fd, out_fd, offset, count)
+            if copied:
+                # the file object's idea of its position is out of date,
+                # unless it's something like a pipe that has none
+                try:
+                    fo.seek(os.lseek(out_fd, 0, os.SEEK_CUR))
+                except EnvironmentError:
+                    pass
+                break
+
+    fi.seek(offset + copied)
+    while copied < count:
+        data = fi.read(min(count - copied, COPY_CHUNK_SIZE))
+        if not data:
+            break
+        fo.write(data)
+        copied += len(data)
+    return copied
+
+
+class OffsetStringIO(StringIO):
+    """
+    A StringIO holding a piece of a larger stream, starting at offset base.
+
+    tell() and absolute seeks use positions in the whole stream, so parsing
+    code that records offsets works on the piece as it would on the
+    complete file.
+    """
+
+    def __init__(self, buf, base):
+        StringIO.__init__(self, buf)
+        self.base = base
+
+    def seek(self, pos, mode=0):
+        if mode == 0:
+            pos -= self.base
+        StringIO.seek(self, pos, mode)
+
+    def tell(self):
+        return StringIO.tell(self) + self.base
+
+
+class FileWatcher(object):
+    """
+    Waits for a file to change.
+
+    Uses inotify where the platform has it and path is given, otherwise
+    wait() just sleeps. poll_interval bounds every wait either way, so
+    changes inotify doesn't see (like on network filesystems) are only
+    picked up later.
+    """
+
+    def __init__(self, path=None, poll_interval=0.5):
+        self.poll_interval = poll_interval
+        self.fd = None
+        if path is None or _inotify_init is None:
+            return
+        fd = _inotify_init()
+        if fd < 0:
+            return
+        if _inotify_add_watch(fd, path, IN_MODIFY | IN_CLOSE_WRITE) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout=None):
+        if timeout is None or timeout > self.poll_interval:
+            timeout = self.poll_interval
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error:
+            return
+        if readable:
+            # drain the pending events, their details don't matter
+            os.read(self.fd, 4096)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,494 @@
+"""
+Columnar indexes of the tags in an FLV file.
+"""
+
+import os
+import sys
+import array
+import bisect
+import struct
+import logging
+import tempfile
+import multiprocessing
+
+from primitives import EndOfFile
+from constants import *
+from astypes import MalformedFLV
+from tags import FLV, TAG_HEADER, PREVIOUS_TAG_SIZE, ensure
+from tags import decode_tag_header
+from helpers import MappedFile, force_remove
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger('flvlib.index')
+
+
+# File offsets need 64 bits. Python 2's array has no 'q', so where a C long
+# only has 32 they are kept as doubles, which are exact up to 2 ** 53.
+if array.array('l').itemsize >= 8:
+    OFFSET_TYPECODE = 'l'
+else:
+    OFFSET_TYPECODE = 'd'
+
+# Column name, array.array typecode and NumPy type. Columns that don't apply
+# to a tag (like frame_type for audio) hold -1. For audio tags codec_id is
+# the sound format and packet_type the AAC packet type.
+INDEX_COLUMNS = (
+    ('offset', OFFSET_TYPECODE, '<i8'),
+    ('timestamp', 'i', '<i4'),
+    ('size', 'I', '<u4'),
+    ('type', 'B', 'u1'),
+    ('frame_type', 'b', 'i1'),
+    ('codec_id', 'b', 'i1'),
+    ('packet_type', 'b', 'i1'),
+)
+
+# Enough of the tag to get to the end of the H.264 packet type
+TAG_SCAN_SIZE = TAG_HEADER.size + 2
+
+
+def scan_tags(f):
+    """
+    Yield (offset, timestamp, size, type, frame_type, codec_id,
+    packet_type) for every tag, starting from the current position of f.
+
+    Only the tag headers and the first two bytes of the payloads are read.
+    """
+    chunk = f.read(TAG_SCAN_SIZE)
+    offset = f.tell() - len(chunk)
+    while chunk:
+        if len(chunk) < TAG_HEADER.size:
+            raise EndOfFile
+        tag_type, size, timestamp, _ = decode_tag_header(chunk)
+
+        payload = chunk[11:11 + size]
+        frame_type = codec_id = packet_type = -1
+        if tag_type == TAG_TYPE_AUDIO and payload:
+            codec_id = ord(payload[0]) >> 4
+            if codec_id == SOUND_FORMAT_AAC and len(payload) > 1:
+                packet_type = ord(payload[1])
+        elif tag_type == TAG_TYPE_VIDEO and payload:
+            frame_type = ord(payload[0]) >> 4
+            codec_id = ord(payload[0]) & 0xF
+            if codec_id == CODEC_ID_H264 and len(payload) > 1:
+                packet_type = ord(payload[1])
+        elif tag_type not in (TAG_TYPE_SCRIPT, TAG_TYPE_SCRIPT_AMF3):
+            raise MalformedFLV("Invalid tag type: %d", tag_type)
+
+        yield (offset, timestamp, size, tag_type, frame_type, codec_id,
+               packet_type)
+
+        # Read this tag's PreviousTagSize together with the start of the
+        # next tag
+        end = offset + 11 + size
+        f.seek(end)
+        chunk = f.read(4 + TAG_SCAN_SIZE)
+        if len(chunk) < 4:
+            raise EndOfFile
+        previous_tag_size = PREVIOUS_TAG_SIZE.unpack(chunk[:4])[0]
+        if previous_tag_size != size + 11:
+            ensure(previous_tag_size, size + 11,
+                   "PreviousTagSize of %d (0x%08X) "
+                   "not equal to actual tag size of %d (0x%08X)" %
+                   (previous_tag_size, previous_tag_size,
+                    size + 11, size + 11))
+        chunk = chunk[4:]
+        offset = end + 4
+
+
+def collect_columns(rows, end=None):
+    """
+    Gather rows from scan_tags into one array.array per column, stopping
+    at the first tag that starts at or after end.
+    """
+    columns = [array.array(typecode) for _, typecode, _ in INDEX_COLUMNS]
+    (add_offset, add_timestamp, add_size, add_type, add_frame_type,
+     add_codec_id, add_packet_type) = [column.append for column in columns]
+    for (offset, timestamp, size, tag_type, frame_type, codec_id,
+         packet_type) in rows:
+        if end is not None and offset >= end:
+            break
+        add_offset(offset)
+        add_timestamp(timestamp)
+        add_size(size)
+        add_type(tag_type)
+        add_frame_type(frame_type)
+        add_codec_id(codec_id)
+        add_packet_type(packet_type)
+    return columns
+
+
+def build_index(flv, use_numpy=True):
+    """
+    Index all tags of an FLV file.
+
+    Returns a NumPy structured array with the fields from INDEX_COLUMNS if
+    NumPy is available (and use_numpy is true), otherwise a dictionary
+    mapping column names to array.array objects. Either way, index['offset']
+    and friends give whole columns.
+    """
+    flv.parse_header()
+    return make_index(collect_columns(scan_tags(flv.f)), use_numpy)
+
+
+def make_index(columns, use_numpy=True):
+    if not use_numpy or numpy is None:
+        return dict(zip([name for name, _, _ in INDEX_COLUMNS], columns))
+
+    index = numpy.empty(len(columns[0]),
+                        dtype=[(name, dtype) for name, _, dtype in
+                               INDEX_COLUMNS])
+    for (name, typecode, _), column in zip(INDEX_COLUMNS, columns):
+        # the offsets may be doubles, they get converted to the field's
+        # integer type
+        index[name] = numpy.frombuffer(column, dtype=typecode)
+    return index
+
+
+VALID_TAG_TYPES = (TAG_TYPE_AUDIO, TAG_TYPE_VIDEO, TAG_TYPE_SCRIPT,
+                   TAG_TYPE_SCRIPT_AMF3)
+
+# Shards smaller than this are not worth a worker
+MIN_SHARD_SIZE = 1 << 20
+
+
+def is_tag_boundary(data, offset, first_offset):
+    """
+    Check if a tag starts at offset in data, a string or memory map of a
+    whole FLV file whose first tag is at first_offset.
+
+    The tag header has to be followed by a matching PreviousTagSize (unless
+    the file ends first) and the PreviousTagSize in front of it has to
+    point back to a tag header of that size.
+    """
+    length = len(data)
+    if offset + TAG_HEADER.size > length:
+        return False
+    tag_type, size, _, stream_id = decode_tag_header(data, offset)
+    if tag_type not in VALID_TAG_TYPES or stream_id:
+        return False
+    end = offset + 11 + size
+    if (end + 4 <= length and
+        PREVIOUS_TAG_SIZE.unpack_from(data, end)[0] != end - offset):
+        return False
+
+    if offset == first_offset:
+        return True
+    if offset - 4 < first_offset:
+        return False
+    previous_tag_size = PREVIOUS_TAG_SIZE.unpack_from(data, offset - 4)[0]
+    previous_offset = offset - 4 - previous_tag_size
+    if previous_tag_size < 11 or previous_offset < first_offset:
+        return False
+    tag_type, size, _, _ = decode_tag_header(data, previous_offset)
+    return tag_type in VALID_TAG_TYPES and size + 11 == previous_tag_size
+
+
+def find_tag_boundary(data, start, end, first_offset):
+    """
+    Return the offset of the first tag boundary in [start, end) of data, or
+    None if there is none.
+    """
+    valid_types = [chr(tag_type) for tag_type in VALID_TAG_TYPES]
+    for offset in xrange(max(start, first_offset), end):
+        if data[offset] in valid_types and is_tag_boundary(data, offset,
+                                                           first_offset):
+            return offset
+    return None
+
+
+def index_range(args):
+    """
+    Index the tags that start in the byte range [start, end) of an FLV
+    file. Unless exact is true, start doesn't have to be a tag boundary,
+    the scan resynchronises to the first one in the range.
+
+    Takes a single tuple of (path, start, end, first_offset, exact), to be
+    usable with Pool.map.
+    """
+    path, start, end, first_offset, exact = args
+    f = open(path, 'rb')
+    m = MappedFile(f)
+    try:
+        if exact:
+            m.seek(start)
+            return collect_columns(scan_tags(m), end)
+        start = find_tag_boundary(m.data, start, end, first_offset)
+        if start is None:
+            return collect_columns(())
+        m.seek(start)
+        try:
+            return collect_columns(scan_tags(m), end)
+        except (MalformedFLV, EndOfFile):
+            # Resynchronised to something that only looked like a tag. The
+            # merge in build_index_parallel will scan this range again.
+            return collect_columns(())
+    finally:
+        m.close()
+        f.close()
+
+
+def build_index_parallel(path, processes=None, use_numpy=True,
+                         shard_size=None):
+    """
+    Index all tags of an FLV file like build_index does, splitting the file
+    into byte ranges that get scanned by a pool of processes.
+
+    Resynchronising can in theory hit something that looks like a tag in
+    the middle of a payload. The shards are checked against each other
+    when merging and any shard that started at the wrong place is scanned
+    again from where the previous one ended, so the result is always the
+    same as a serial scan.
+    """
+    f = open(path, 'rb')
+    try:
+        FLV(f).parse_header()
+        first_offset = f.tell()
+    finally:
+        f.close()
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    length = os.stat(path).st_size
+    if shard_size is None:
+        shard_size = max(length // (processes * 4) + 1, MIN_SHARD_SIZE)
+    ranges = [(start, min(start + shard_size, length))
+              for start in xrange(first_offset, max(length, first_offset + 1),
+                                  shard_size)]
+    jobs = [(path, start, end, first_offset, start == first_offset)
+            for start, end in ranges]
+
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            shards = pool.map(index_range, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        shards = map(index_range, jobs)
+
+    columns = [array.array(typecode) for _, typecode, _ in INDEX_COLUMNS]
+    expected = first_offset
+    for (start, end), shard in zip(ranges, shards):
+        offsets = shard[0]
+        if expected >= end:
+            # a tag from an earlier shard covers this whole range, anything
+            # found in it was inside a payload
+            continue
+        if not offsets or offsets[0] != expected:
+            log.debug("Shard at %d resynchronised to the wrong offset, "
+                      "rescanning from %d", start, expected)
+            shard = index_range((path, expected, end, first_offset, True))
+            offsets = shard[0]
+        for column, part in zip(columns, shard):
+            column.extend(part)
+        if offsets:
+            expected = int(offsets[-1]) + shard[2][-1] + 15
+
+    return make_index(columns, use_numpy)
+
+
+# Sidecar files keep the seek tables of an FLV next to it, in file.flv.idx.
+# After the header come the keyframe timestamps (int32, milliseconds) and
+# offsets (double, like onMetaData filepositions), followed by the same two
+# tables for every tag. Everything is little endian.
+SIDECAR_SUFFIX = '.idx'
+SIDECAR_MAGIC = 'FLVIDX'
+SIDECAR_VERSION = 1
+
+# magic, version, source file size, source file mtime, number of
+# keyframes, number of tags
+SIDECAR_HEADER = struct.Struct("<6sBxQdII")
+
+
+def keyframe_rows(idx):
+    """
+    Return the row numbers of the seek points in a tag index.
+
+    Those are the video keyframes, not counting H.264 sequence headers, or
+    every audio tag except AAC sequence headers if there is no video.
+    """
+    types, frame_types, packet_types = (idx['type'], idx['frame_type'],
+                                        idx['packet_type'])
+    rows = [i for i in xrange(len(types))
+            if types[i] == TAG_TYPE_VIDEO and
+            frame_types[i] == FRAME_TYPE_KEYFRAME and
+            packet_types[i] != H264_PACKET_TYPE_SEQUENCE_HEADER]
+    if not rows:
+        rows = [i for i in xrange(len(types))
+                if types[i] == TAG_TYPE_AUDIO and
+                packet_types[i] != AAC_PACKET_TYPE_SEQUENCE_HEADER]
+    return rows
+
+
+def _to_little_endian(column):
+    if sys.byteorder != 'little':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tostring()
+
+
+def _from_little_endian(typecode, data):
+    column = array.array(typecode)
+    column.fromstring(data)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+class KeyframeIndex(object):
+    """
+    The seek tables of an FLV file, as stored in its sidecar file.
+
+    Timestamps are in milliseconds. The tag tables are None if they were
+    not loaded.
+    """
+
+    def __init__(self, source_size, source_mtime, keyframe_timestamps,
+                 keyframe_offsets, tag_timestamps=None, tag_offsets=None):
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        self.keyframe_timestamps = keyframe_timestamps
+        self.keyframe_offsets = keyframe_offsets
+        self.tag_timestamps = tag_timestamps
+        self.tag_offsets = tag_offsets
+
+    def keyframe_at(self, timestamp):
+        """
+        Find the last keyframe at or before timestamp and return its
+        (timestamp, offset), or None if there is none.
+        """
+        i = bisect.bisect_right(self.keyframe_timestamps, timestamp)
+        if not i:
+            return None
+        i -= 1
+        return self.keyframe_timestamps[i], int(self.keyframe_offsets[i])
+
+    def keyframe_after(self, timestamp):
+        """
+        Find the first keyframe at or after timestamp and return its
+        (timestamp, offset), or None if there is none.
+        """
+        i = bisect.bisect_left(self.keyframe_timestamps, timestamp)
+        if i == len(self.keyframe_timestamps):
+            return None
+        return self.keyframe_timestamps[i], int(self.keyframe_offsets[i])
+
+
+def sidecar_path(path):
+    return path + SIDECAR_SUFFIX
+
+
+def make_keyframe_index(path, idx=None):
+    """
+    Build the KeyframeIndex of an FLV file, from a tag index built by
+    build_index if one is given.
+    """
+    st = os.stat(path)
+    if idx is None:
+        f = open(path, 'rb')
+        try:
+            idx = build_index(FLV(f), use_numpy=False)
+        finally:
+            f.close()
+
+    rows = keyframe_rows(idx)
+    timestamps, offsets = idx['timestamp'], idx['offset']
+    return KeyframeIndex(
+        st.st_size, st.st_mtime,
+        array.array('i', [timestamps[i] for i in rows]),
+        array.array('d', [offsets[i] for i in rows]),
+        array.array('i', timestamps), array.array('d', offsets))
+
+
+def write_sidecar(path, idx=None):
+    """
+    Index an FLV file and write its sidecar file. Returns the
+    KeyframeIndex that got written.
+    """
+    keyframe_index = make_keyframe_index(path, idx)
+    header = SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION,
+                                 keyframe_index.source_size,
+                                 keyframe_index.source_mtime,
+                                 len(keyframe_index.keyframe_timestamps),
+                                 len(keyframe_index.tag_timestamps))
+
+    # write to a temporary file and move it over, so readers never see a
+    # partially written sidecar
+    fd, temppath = tempfile.mkstemp(dir=os.path.dirname(
+            os.path.abspath(path)))
+    try:
+        fo = os.fdopen(fd, 'wb')
+        fo.write(header)
+        for column in (keyframe_index.keyframe_timestamps,
+                       keyframe_index.keyframe_offsets,
+                       keyframe_index.tag_timestamps,
+                       keyframe_index.tag_offsets):
+            fo.write(_to_little_endian(column))
+        fo.close()
+        os.rename(temppath, sidecar_path(path))
+    except:
+        force_remove(temppath)
+        raise
+
+    return keyframe_index
+
+
+def read_sidecar(path, with_tags=False):
+    """
+    Read the sidecar file of an FLV file.
+
+    Returns None if there is no sidecar, it is damaged or the FLV changed
+    since it was written. Unless with_tags is true only the keyframe
+    tables are read.
+    """
+    try:
+        st = os.stat(path)
+        f = open(sidecar_path(path), 'rb')
+    except EnvironmentError:
+        return None
+
+    try:
+        header = f.read(SIDECAR_HEADER.size)
+        if len(header) < SIDECAR_HEADER.size:
+            log.debug("Sidecar of `%s' is truncated", path)
+            return None
+        (magic, version, source_size, source_mtime, keyframe_count,
+         tag_count) = SIDECAR_HEADER.unpack(header)
+        if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION:
+            log.debug("Sidecar of `%s' has an unknown format", path)
+            return None
+        if source_size != st.st_size or source_mtime != st.st_mtime:
+            log.debug("Sidecar of `%s' is stale", path)
+            return None
+
+        counts = [keyframe_count, keyframe_count]
+        if with_tags:
+            counts += [tag_count, tag_count]
+        columns = []
+        for typecode, count in zip(('i', 'd', 'i', 'd'), counts):
+            size = array.array(typecode).itemsize * count
+            data = f.read(size)
+            if len(data) < size:
+                log.debug("Sidecar of `%s' is truncated", path)
+                return None
+            columns.append(_from_little_endian(typecode, data))
+    finally:
+        f.close()
+
+    return KeyframeIndex(source_size, source_mtime, *columns)
+
+
+def get_keyframe_index(path, with_tags=False):
+    """
+    Return the KeyframeIndex of an FLV file from its sidecar, (re)writing
+    the sidecar first if it's missing or out of date.
+    """
+    keyframe_index = read_sidecar(path, with_tags)
+    if keyframe_index is None:
+        keyframe_index = write_sidecar(path)
+    return keyframe_index
@@ -1,4 +1,5 @@
 import sys
+import bisect
 import logging
 
 from optparse import OptionParser
@@ -9,11 +10,24 @@ from flvlib.constants import FRAME_TYPE_KEYFRAME
 from flvlib.constants import H264_PACKET_TYPE_SEQUENCE_HEADER
 from flvlib.constants import H264_PACKET_TYPE_NALU
 from flvlib.astypes import MalformedFLV, FLVObject
-from flvlib.tags import FLV, EndOfFile, AudioTag, VideoTag, ScriptTag
+from flvlib.tags import FLV, EndOfFile, EndOfTags, AudioTag, VideoTag
+from flvlib.tags import ScriptTag, PAYLOAD_FLAGS, PAYLOAD_NONE
+from flvlib.tags import create_flv_header, create_script_tag
+from flvlib.tags import script_tag_size
+from flvlib.index import read_sidecar
+from flvlib.helpers import copy_range
+from flvlib.scripts.index_flv import IndexingAudioTag, METADATA_PADDING_KEY
+from flvlib.scripts.retimestamp_flv import is_nonheader_media
+from flvlib.scripts.retimestamp_flv import copy_retimestamped
 
 
 log = logging.getLogger('flvlib.cut-flv')
 
+# metadata entries some tools add that are wrong for a clip and don't get
+# recomputed, so they are dropped
+STALE_METADATA_KEYS = ('lasttimestamp', 'lastkeyframetimestamp',
+                       'lastkeyframelocation', METADATA_PADDING_KEY)
+
 
 class CuttingAudioTag(AudioTag):
 
@@ -64,128 +78,516 @@ class CuttingFLV(FLV):
             raise MalformedFLV("Invalid tag type: %d", tag_type)
 
 
-def cut_file(inpath, outpath, start_time, end_time):
-    log.debug("Cutting file `%s' into file `%s'", inpath, outpath)
-
-    try:
-        f = open(inpath, 'rb')
-    except IOError, (errno, strerror):
-        log.error("Failed to open `%s': %s", inpath, strerror)
+def is_cut_start(flv, tag, start_time):
+    # The output starts with the first H.264 keyframe after start_time, or
+    # the first audio tag after it in files without video
+    if tag.timestamp <= start_time:
         return False
-
+    if isinstance(tag, VideoTag):
+        return (tag.frame_type == FRAME_TYPE_KEYFRAME and
+                tag.h264_packet_type == H264_PACKET_TYPE_NALU)
+    return flv.no_video and isinstance(tag, AudioTag)
+
+
+def read_keyframe_table(inpath, metadata):
+    """
+    Return the timestamps in milliseconds and the offsets of the seek
+    points of a file, from its sidecar index or from the keyframes object
+    in its onMetaData, or None if it has neither.
+    """
+    keyframe_index = read_sidecar(inpath)
+    if keyframe_index is not None:
+        return (keyframe_index.keyframe_timestamps,
+                keyframe_index.keyframe_offsets)
     try:
-        fo = open(outpath, 'wb')
-    except IOError, (errno, strerror):
-        log.error("Failed to open `%s': %s", outpath, strerror)
-        return False
+        times = metadata['keyframes']['times']
+        positions = metadata['keyframes']['filepositions']
+    except (TypeError, KeyError, AttributeError):
+        return None
+    if not times or len(times) != len(positions):
+        return None
+    return [int(round(t * 1000)) for t in times], positions
+
+
+def read_cut_table(flv, inpath):
+    """
+    Parse the start of the file up to the first media tag and return its
+    keyframe table, as read_keyframe_table does, or None.
+    """
+    metadata = None
+    try:
+        for tag in flv.iter_tags(PAYLOAD_FLAGS):
+            if isinstance(tag, ScriptTag) and tag.name == 'onMetaData':
+                metadata = tag.variable
+            if flv.first_media_tag_offset:
+                break
+    except (MalformedFLV, EndOfFile):
+        return None
+    if not flv.first_media_tag_offset:
+        return None
+    table = read_keyframe_table(inpath, metadata)
+    if table is None:
+        log.debug("No keyframe table, scanning the whole file")
+    return table
+
+
+def find_cut_with_index(flv, table, start_time, end_time):
+    """
+    Find what to cut using a keyframe table from read_cut_table: binary
+    search to the last seek point before start_time, parse tag flags from
+    there up to the start keyframe and only tag headers from there up to
+    end_time.
+
+    Returns the offsets of the first tag to output and of the tag after
+    the last one to output (None for the end of the file). Returns None if
+    the table doesn't match the file or the cut needs the whole file to be
+    looked at.
+    """
+    f = flv.f
+    times, positions = table
+    no_video = flv.no_video
+    try:
+        offset = flv.first_media_tag_offset
+        i = bisect.bisect_right(times, start_time) - 1
+        if i >= 0:
+            offset = int(positions[i])
+            if not flv.is_plausible_tag(offset):
+                log.debug("The keyframe table is out of date")
+                return None
+            f.seek(offset)
+            flv.payload = PAYLOAD_FLAGS
+            tag = flv.get_next_tag()
+            if (abs(tag.timestamp - times[i]) > 1 or
+                    not isinstance(tag, (AudioTag, VideoTag))):
+                log.debug("The keyframe table is out of date")
+                return None
+            # tables only list audio tags when there is no video
+            flv.no_video = isinstance(tag, AudioTag)
+        log.debug("Looking for the start from offset %d", offset)
+
+        f.seek(offset)
+        flv.payload = PAYLOAD_FLAGS
+        while True:
+            tag = flv.get_next_tag()
+            if is_cut_start(flv, tag, start_time):
+                break
+        start_offset = tag.offset
 
-    if start_time is None:
-        start_time = 0
-    else:
-        start_time = int(start_time)
-    if end_time is None:
-        end_time = -1
-    else:
-        end_time = int(end_time)
+        if end_time == -1:
+            return start_offset, None
+        if tag.timestamp > end_time:
+            return None
 
-    flv = CuttingFLV(f)
-    tag_iterator = flv.iter_tags()
-    last_tag = None
-    tag_after_last_tag = None
-    first_keyframe_after_start = None
+        flv.payload = PAYLOAD_NONE
+        while True:
+            try:
+                tag = flv.get_next_tag()
+            except EndOfTags:
+                return start_offset, None
+            if tag.timestamp != 0 and tag.timestamp > end_time:
+                return start_offset, tag.offset
+    except (MalformedFLV, EndOfFile, EndOfTags):
+        # leave the reporting to the full scan
+        return None
+    finally:
+        flv.no_video = no_video
+
+
+def find_cuts_by_scanning(flv, inpath, times):
+    """
+    Find what to cut for each (start_time, end_time) in times, looking at
+    every tag from the start of the file until the start keyframes and the
+    ends of all the cuts are found.
+
+    Returns a list with what find_cut_with_index returns for each cut, with
+    None for cuts that can't be made, or None if the file can't be cut at
+    all. The reasons get logged.
+    """
+    tag_iterator = flv.iter_tags(PAYLOAD_FLAGS)
+    starts = [None] * len(times)
+    ends = [None] * len(times)
+    min_timestamp = None
+
+    # The cuts that still need a start or an end, sorted by time. A tag
+    # settles all of them up to its timestamp, in file order.
+    pending_starts = sorted([(start_time, i)
+                             for i, (start_time, _) in enumerate(times)])
+    pending_ends = sorted([(end_time, i)
+                           for i, (_, end_time) in enumerate(times)
+                           if end_time != -1])
+    pending_starts.reverse()
+    pending_ends.reverse()
 
     try:
-        while True:
+        while pending_starts or pending_ends or min_timestamp is None:
             tag = tag_iterator.next()
             # some buggy software, like gstreamer's flvmux, puts a metadata tag
             # at the end of the file with timestamp 0, and we don't want to
             # base our duration computation on that
-            if tag.timestamp != 0 and (
-                    tag.timestamp <= end_time or end_time == -1):
-                last_tag = tag
-            elif tag_after_last_tag is None and tag.timestamp != 0:
-                tag_after_last_tag = tag
-            if not first_keyframe_after_start and tag.timestamp > start_time:
-                if isinstance(tag, VideoTag):
-                    if (tag.frame_type == FRAME_TYPE_KEYFRAME and
-                            tag.h264_packet_type == H264_PACKET_TYPE_NALU):
-                        first_keyframe_after_start = tag
-                elif flv.no_video:
-                    first_keyframe_after_start = tag
+            if tag.timestamp != 0:
+                if min_timestamp is None or tag.timestamp < min_timestamp:
+                    min_timestamp = tag.timestamp
+                while pending_ends and pending_ends[-1][0] < tag.timestamp:
+                    ends[pending_ends.pop()[1]] = tag.offset
+            if (pending_starts and
+                    is_cut_start(flv, tag, pending_starts[-1][0])):
+                while (pending_starts and
+                       pending_starts[-1][0] < tag.timestamp):
+                    starts[pending_starts.pop()[1]] = tag.offset
     except MalformedFLV, e:
         message = e[0] % e[1:]
         log.error("The file `%s' is not a valid FLV file: %s", inpath, message)
-        return False
+        return None
     except EndOfFile:
         log.error("Unexpected end of file on file `%s'", inpath)
-        return False
+        return None
     except StopIteration:
         pass
 
     if not flv.first_media_tag_offset:
         log.error("The file `%s' does not have any media content", inpath)
-        return False
-
-    if not last_tag:
-        log.error("The file `%s' does not have any content with a "
-                  "non-zero timestamp", inpath)
-        return False
+        return None
+
+    cuts = []
+    for (start_time, end_time), start, end in zip(times, starts, ends):
+        if min_timestamp is None or (end_time != -1 and
+                                     min_timestamp > end_time):
+            log.error("The file `%s' does not have any content with a "
+                      "non-zero timestamp", inpath)
+            cuts.append(None)
+        elif start is None:
+            log.error("The file `%s' has no keyframes greater than start "
+                      "time %d", inpath, start_time)
+            cuts.append(None)
+        else:
+            log.debug("Cut from %d to %d: offsets %d to %s",
+                      start_time, end_time, start, end)
+            cuts.append((start, end))
+    return cuts
+
+
+def normalize_times(start_time, end_time):
+    if start_time is None:
+        start_time = 0
+    else:
+        start_time = int(start_time)
+    if end_time is None:
+        end_time = -1
+    else:
+        end_time = int(end_time)
+    return start_time, end_time
+
+
+def read_clip_header(f, first_media_tag_offset):
+    """
+    Return the onMetaData of a file, or None, and the offsets and sizes of
+    the other tags before its first media tag, like the H.264 sequence
+    header, that go at the start of every clip.
+    """
+    metadata = None
+    header_tags = []
+    for tag in FLV(f).iter_tags(PAYLOAD_FLAGS):
+        if tag.offset >= first_media_tag_offset:
+            break
+        if isinstance(tag, ScriptTag) and tag.name == 'onMetaData':
+            metadata = tag.variable
+        else:
+            header_tags.append((tag.offset, tag.size + 15))
+    return metadata, header_tags
+
+
+def write_clip(f, fo, flv, metadata, header_tags, start_offset, end_offset):
+    """
+    Write the tags from start_offset up to end_offset as a file of their
+    own, after the header tags from read_clip_header, with an onMetaData
+    that has the clip's duration, file size and keyframe table. The
+    timestamps get rebased to start from zero, the way retimestamp-flv does
+    it, and onMetaData tags inside the clip are left out.
+
+    The keyframe table and the new timestamps come from one look at the
+    tag headers and flags, the payloads only get read once, when they are
+    copied.
+    """
+    reader = FLV(f)
+    reader.payload = PAYLOAD_FLAGS
+    f.seek(start_offset)
+
+    base = None
+    # where the tags that get rebased start
+    base_tag = None
+    last_timestamp = 0
+    has_video = False
+    keyframes = FLVObject()
+    keyframes.times = []
+    keyframes.filepositions = []
+    audio_seekpoints = FLVObject()
+    audio_seekpoints.times = []
+    audio_seekpoints.filepositions = []
+    audio_tag_number = 0
+    # the parts of the clip around the dropped tags, where they start and
+    # end
+    segment = [start_offset, None]
+    segments = [segment]
+    dropped = 0
+
+    while f.tell() < end_offset:
+        tag = reader.get_next_tag()
+        if isinstance(tag, ScriptTag) and tag.name == 'onMetaData':
+            # like the one gstreamer's flvmux writes at the end, with the
+            # values of the whole file
+            dropped += tag.size + 15
+            segment[1] = tag.offset
+            segment = [tag.offset + tag.size + 15, None]
+            segments.append(segment)
+            continue
+
+        timestamp = tag.timestamp
+        if base is None and is_nonheader_media(tag):
+            base = timestamp
+            base_tag = tag.offset
+        if base:
+            timestamp -= base
+        if timestamp != 0:
+            last_timestamp = timestamp
+
+        # the same seek points index-flv would make
+        position = tag.offset - start_offset - dropped
+        if isinstance(tag, VideoTag):
+            has_video = True
+            if tag.frame_type == FRAME_TYPE_KEYFRAME:
+                keyframes.filepositions.append(position)
+                keyframes.times.append(timestamp / 1000.0)
+        elif isinstance(tag, AudioTag) and not has_video:
+            audio_tag_number += 1
+            if audio_tag_number % IndexingAudioTag.SEEKPOINT_DENSITY == 0:
+                audio_seekpoints.filepositions.append(position)
+                audio_seekpoints.times.append(timestamp / 1000.0)
+    segment[1] = end_offset
+
+    if not has_video:
+        keyframes = audio_seekpoints
+
+    if metadata is None:
+        metadata = {}
+    else:
+        # the same metadata is used for every clip
+        metadata = metadata.__class__(metadata)
+    for key in STALE_METADATA_KEYS:
+        metadata.pop(key, None)
+    metadata['duration'] = last_timestamp / 1000.0
+    metadata['keyframes'] = keyframes
+    metadata['filesize'] = 0
+    metadata['metadatacreator'] = 'flvlib %s' % __versionstr__
+
+    # numbers are fixed-width in AMF0, so the size of the metadata, and
+    # with it where the clip's tags end up, is known before the file
+    # positions are filled in
+    header = create_flv_header(has_audio=flv.has_audio,
+                               has_video=flv.has_video)
+    media_start = (len(header) + script_tag_size('onMetaData', metadata) +
+                   sum([size for _, size in header_tags]))
+    keyframes.filepositions = [media_start + position
+                               for position in keyframes.filepositions]
+    metadata['filesize'] = (media_start + end_offset - start_offset -
+                            dropped)
+
+    fo.write(header)
+    fo.write(create_script_tag('onMetaData', metadata))
+    for offset, size in header_tags:
+        copy_range(f, fo, offset, size)
+    for start, end in segments:
+        if base and base_tag < end:
+            copy_retimestamped(f, fo, start, max(start, base_tag), base,
+                               end - start)
+        else:
+            copy_range(f, fo, start, end - start)
+
+
+def cut_file_ranges(inpath, ranges, update_metadata=False):
+    """
+    Cut many parts out of a file. ranges is a list of (start_time,
+    end_time, outpath), with None for an open start or end.
+
+    All the cuts are found with one look at the keyframe table or one scan
+    of the file, and each output is copied straight from the input. With
+    update_metadata the outputs get their own metadata and timestamps
+    starting from zero, see write_clip. Returns True if all the cuts were
+    made.
+    """
+    log.debug("Cutting %d ranges from file `%s'", len(ranges), inpath)
+
+    times = [normalize_times(start_time, end_time)
+             for start_time, end_time, _ in ranges]
 
-    if not first_keyframe_after_start:
-        log.error("The file `%s' has no keyframes greater than start time %d",
-                  inpath, start_time)
+    try:
+        f = open(inpath, 'rb')
+    except IOError, (errno, strerror):
+        log.error("Failed to open `%s': %s", inpath, strerror)
         return False
 
-    log.debug("Creating the output file")
+    flv = CuttingFLV(f)
+    table = read_cut_table(flv, inpath)
+    cuts = [None] * len(times)
+    if table is not None:
+        cuts = [find_cut_with_index(flv, table, start_time, end_time)
+                for start_time, end_time in times]
+    missing = [i for i, cut in enumerate(cuts) if cut is None]
+    if missing:
+        flv = CuttingFLV(f)
+        scanned = find_cuts_by_scanning(flv, inpath,
+                                        [times[i] for i in missing])
+        if scanned is None:
+            f.close()
+            return False
+        for i, cut in zip(missing, scanned):
+            cuts[i] = cut
+    first_media_tag_offset = flv.first_media_tag_offset
+
+    f.seek(0, 2)
+    file_size = f.tell()
+
+    if update_metadata:
+        try:
+            metadata, header_tags = read_clip_header(f,
+                                                     first_media_tag_offset)
+        except (MalformedFLV, EndOfFile):
+            log.error("The file `%s' is not a valid FLV file", inpath)
+            f.close()
+            return False
+
+    ret = True
+    for (_, _, outpath), (start_time, end_time), cut in zip(ranges, times,
+                                                            cuts):
+        if cut is None:
+            ret = False
+            continue
+        start_offset, end_offset = cut
+        if end_offset is None:
+            end_offset = file_size
+        if end_offset <= start_offset:
+            log.error("The file `%s' has no keyframes between %d and %d",
+                      inpath, start_time, end_time)
+            ret = False
+            continue
 
-    log.debug("First tag to output %s", first_keyframe_after_start)
-    log.debug("Last tag to output %s", last_tag)
-    log.debug("Tag after last tag %s", tag_after_last_tag)
+        try:
+            fo = open(outpath, 'wb')
+        except IOError, (errno, strerror):
+            log.error("Failed to open `%s': %s", outpath, strerror)
+            ret = False
+            continue
+
+        log.debug("Creating the output file `%s'", outpath)
+        if update_metadata:
+            try:
+                write_clip(f, fo, flv, metadata, header_tags, start_offset,
+                           end_offset)
+            except MalformedFLV, e:
+                message = e[0] % e[1:]
+                log.error("The file `%s' is not a valid FLV file: %s",
+                          inpath, message)
+                ret = False
+            except (EndOfFile, EndOfTags):
+                log.error("Unexpected end of file on file `%s'", inpath)
+                ret = False
+            fo.close()
+            continue
+
+        log.debug("copying up to %d bytes", first_media_tag_offset)
+        copy_range(f, fo, 0, first_media_tag_offset)
+        log.debug("copying %d bytes from offset %d",
+                  end_offset - start_offset, start_offset)
+        copy_range(f, fo, start_offset, end_offset - start_offset)
+        fo.close()
 
-    f.seek(0)
-    log.debug("copying up to %d bytes", flv.first_media_tag_offset)
-    fo.write(f.read(flv.first_media_tag_offset))
-    log.debug("seeking to %d bytes", first_keyframe_after_start.offset)
-    if tag_after_last_tag:
-        end_offset = tag_after_last_tag.offset
-    else:
-        f.seek(0, 2)
-        end_offset = f.tell()
-    log.debug("end offset %d", end_offset)
-    f.seek(first_keyframe_after_start.offset)
-
-    copy_bytes = end_offset - first_keyframe_after_start.offset
-    log.debug("copying %d bytes", copy_bytes)
-    fo.write(f.read(copy_bytes))
     f.close()
-    fo.close()
-    return True
+    return ret
+
+
+def cut_file(inpath, outpath, start_time, end_time, update_metadata=False):
+    log.debug("Cutting file `%s' into file `%s'", inpath, outpath)
+    return cut_file_ranges(inpath, [(start_time, end_time, outpath)],
+                           update_metadata)
+
+
+def read_ranges(path):
+    """
+    Read the ranges for cut_file_ranges from a file with one "start end
+    outpath" line per range. A - for the start or end leaves it open, and
+    empty lines and lines starting with # are skipped. Raises ValueError
+    for lines that don't have that form or that end before they start.
+    """
+    ranges = []
+    f = open(path, 'r')
+    try:
+        for number, line in enumerate(f):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 2)
+            if len(fields) != 3:
+                raise ValueError("Line %d of `%s' is not of the form "
+                                 "\"start end outpath\"" % (number + 1, path))
+            times = []
+            for field in fields[:2]:
+                if field == '-':
+                    times.append(None)
+                    continue
+                try:
+                    times.append(int(field))
+                except ValueError:
+                    raise ValueError("Line %d of `%s' has a time that is not "
+                                     "a number of milliseconds: %s" %
+                                     (number + 1, path, field))
+            start_time, end_time = times
+            if (start_time is not None and end_time is not None and
+                    end_time < start_time):
+                raise ValueError("Line %d of `%s' ends before it starts" %
+                                 (number + 1, path))
+            ranges.append((start_time, end_time, fields[2]))
+    finally:
+        f.close()
+    return ranges
 
 
 def process_options():
-    usage = "%prog file outfile"
+    usage = "%prog file outfile\n       %prog --ranges rangesfile file"
     description = ("Cut out part of a FLV file. Start and end times are "
                    "timestamps that will be compared to the timestamps "
                    "of tags from inside the file. Tags from outside of the "
                    "start/end range will be discarded, taking care to always "
-                   "start the new file with a keyframe. "
-                   "The script accepts one input and one output file path.")
+                   "start the new file with a keyframe. Files with a "
+                   "keyframe table in their metadata or a sidecar index "
+                   "are cut without reading them whole. "
+                   "The script accepts one input and one output file path, "
+                   "or with --ranges a file listing many parts to cut out, "
+                   "one \"start end outpath\" per line with - for an open "
+                   "start or end.")
     version = "%%prog flvlib %s" % __versionstr__
     parser = OptionParser(usage=usage, description=description,
                           version=version)
     parser.add_option("-s", "--start-time", help="start time to cut from")
     parser.add_option("-e", "--end-time", help="end time to cut to")
+    parser.add_option("-r", "--ranges", metavar="FILE",
+                      help="cut out all the ranges listed in FILE")
+    parser.add_option("-m", "--update-metadata", action="store_true",
+                      help=("give the output its own metadata, with "
+                            "timestamps starting from zero"))
     parser.add_option("-v", "--verbose", action="count",
                       default=0, dest="verbosity",
                       help="be more verbose, each -v increases verbosity")
     options, args = parser.parse_args(sys.argv)
 
-    if len(args) < 2:
-        parser.error("You have to provide an input and output file path")
+    if options.ranges:
+        if len(args) < 2:
+            parser.error("You have to provide an input file path")
+    else:
+        if len(args) < 3:
+            parser.error("You have to provide an input and output file path")
 
-    if not options.start_time and not options.end_time:
-        parser.error("You need to provide at least "
-                     "one of start time or end time ")
+        if not options.start_time and not options.end_time:
+            parser.error("You need to provide at least "
+                         "one of start time or end time ")
 
     if options.verbosity > 3:
         options.verbosity = 3
@@ -198,7 +600,15 @@ def process_options():
 
 def cut_files():
     options, args = process_options()
-    return cut_file(args[1], args[2], options.start_time, options.end_time)
+    if options.ranges:
+        try:
+            ranges = read_ranges(options.ranges)
+        except ValueError, e:
+            log.error("%s", e)
+            return False
+        return cut_file_ranges(args[1], ranges, options.update_metadata)
+    return cut_file(args[1], args[2], options.start_time, options.end_time,
+                    options.update_metadata)
 
 
 def main():
@@ -12,14 +12,14 @@ log = logging.getLogger('flvlib.debug-flv')
 log.setLevel(logging.ERROR)
 
 
-def debug_file(filename, quiet=False, metadata=False):
+def debug_file(filename, quiet=False, metadata=False, recover=False):
     try:
         f = open(filename, 'rb')
     except IOError, (errno, strerror):
         log.error("Failed to open `%s': %s", filename, strerror)
         return False
 
-    flv = tags.FLV(f)
+    flv = tags.FLV(f, recover=recover)
 
     if not quiet:
         print "=== `%s' ===" % filename
@@ -49,7 +49,11 @@ def debug_file(filename, quiet=False, metadata=False):
 
     f.close()
 
-    return True
+    for start, end in flv.skipped:
+        log.error("Skipped %d damaged bytes at offset 0x%08X in file `%s'",
+                  end - start, start, filename)
+
+    return not flv.skipped
 
 
 def process_options():
@@ -66,6 +70,8 @@ def process_options():
                       help="do not output anything unless there are errors")
     parser.add_option("-m", "--metadata", action="store_true",
                       help="exit immediately after printing an onMetaData tag")
+    parser.add_option("-r", "--recover", action="store_true",
+                      help="skip over damaged parts of the file")
     parser.add_option("-v", "--verbose", action="count",
                       default=0, dest="verbosity",
                       help="be more verbose, each -v increases verbosity")
@@ -93,7 +99,8 @@ def debug_files():
     clean_run = True
 
     for filename in args[1:]:
-        if not debug_file(filename, options.quiet, options.metadata):
+        if not debug_file(filename, options.quiet, options.metadata,
+                          options.recover):
             clean_run = False
 
     return clean_run
@@ -11,11 +11,19 @@ from flvlib.constants import TAG_TYPE_AUDIO, TAG_TYPE_VIDEO, TAG_TYPE_SCRIPT
 from flvlib.constants import FRAME_TYPE_KEYFRAME
 from flvlib.astypes import MalformedFLV, FLVObject
 from flvlib.tags import FLV, EndOfFile, AudioTag, VideoTag, ScriptTag
-from flvlib.tags import create_script_tag, create_flv_header
-from flvlib.helpers import force_remove
+from flvlib.tags import create_script_tag, create_flv_header, PAYLOAD_FLAGS
+from flvlib.tags import script_tag_size
+from flvlib.helpers import force_remove, copy_range
+from flvlib.scripts.retimestamp_flv import is_nonheader_media
+from flvlib.scripts.retimestamp_flv import copy_retimestamped
 
 log = logging.getLogger('flvlib.index-flv')
 
+# onMetaData entry that reserves room for updating the metadata in place,
+# as a string with at most MAX_METADATA_PADDING characters
+METADATA_PADDING_KEY = 'metadatapadding'
+MAX_METADATA_PADDING = 0xFFFF
+
 
 class IndexingAudioTag(AudioTag):
 
@@ -42,7 +50,8 @@ class IndexingAudioTag(AudioTag):
         parent.audio_tag_number += 1
         if (parent.audio_tag_number % self.SEEKPOINT_DENSITY == 0):
             parent.audio_seekpoints.filepositions.append(self.offset)
-            parent.audio_seekpoints.times.append(self.timestamp / 1000.0)
+            parent.audio_seekpoints.times.append(
+                parent.output_timestamp(self) / 1000.0)
 
 
 class IndexingVideoTag(VideoTag):
@@ -58,7 +67,8 @@ class IndexingVideoTag(VideoTag):
 
         if self.frame_type == FRAME_TYPE_KEYFRAME:
             parent.keyframes.filepositions.append(self.offset)
-            parent.keyframes.times.append(self.timestamp / 1000.0)
+            parent.keyframes.times.append(
+                parent.output_timestamp(self) / 1000.0)
 
 
 class IndexingScriptTag(ScriptTag):
@@ -82,8 +92,14 @@ tag_to_class = {
 
 class IndexingFLV(FLV):
 
-    def __init__(self, f):
+    def __init__(self, f, retimestamp=False):
         FLV.__init__(self, f)
+        # when retimestamping, the timestamps get rebased like
+        # retimestamp-flv does, as the tags are read
+        self.retimestamp = retimestamp
+        self.timestamp_offset = None
+        # where the tags that get offset start
+        self.timestamp_offset_tag = None
         self.metadata = None
         self.keyframes = FLVObject()
         self.keyframes.filepositions = []
@@ -113,20 +129,55 @@ class IndexingFLV(FLV):
         except KeyError:
             raise MalformedFLV("Invalid tag type: %d", tag_type)
 
+    def output_timestamp(self, tag):
+        # the timestamp the tag is going to have in the output; everything
+        # from the first non-header media tag on gets offset
+        if not self.retimestamp:
+            return tag.timestamp
+        if self.timestamp_offset is None:
+            if not is_nonheader_media(tag):
+                return tag.timestamp
+            self.timestamp_offset = tag.timestamp
+            self.timestamp_offset_tag = tag.offset
+            log.debug("Determined the offset to be %d", tag.timestamp)
+        return tag.timestamp - self.timestamp_offset
+
+
+def create_padded_metadata(metadata, size, pad=True):
+    """
+    Create an onMetaData tag of exactly size bytes, padding it with a
+    METADATA_PADDING_KEY entry if needed and pad is true. Returns None if
+    the metadata doesn't fit.
+    """
+    metadata.pop(METADATA_PADDING_KEY, None)
+    if script_tag_size('onMetaData', metadata) == size:
+        return create_script_tag('onMetaData', metadata)
+    if not pad:
+        return None
+
+    metadata[METADATA_PADDING_KEY] = ''
+    padding = size - script_tag_size('onMetaData', metadata)
+    if padding < 0 or padding > MAX_METADATA_PADDING:
+        del metadata[METADATA_PADDING_KEY]
+        return None
+    metadata[METADATA_PADDING_KEY] = ' ' * padding
+    return create_script_tag('onMetaData', metadata)
+
 
 def filepositions_difference(metadata, original_metadata_size):
-    test_payload = create_script_tag('onMetaData', metadata)
-    payload_size = len(test_payload)
-    difference = payload_size - original_metadata_size
-    return test_payload, difference
+    # AMF0 numbers are fixed-width, so shifting the filepositions won't
+    # change the size of the metadata and it can be computed up front
+    payload_size = script_tag_size('onMetaData', metadata)
+    return payload_size - original_metadata_size
 
 
-def retimestamp_and_index_file(inpath, outpath=None, retimestamp=None):
+def retimestamp_and_index_file(inpath, outpath=None, retimestamp=None,
+                               padding=0):
 
     # no retimestamping needed
     if retimestamp is None:
 
-        return index_file(inpath, outpath)
+        return index_file(inpath, outpath, padding)
 
     # retimestamp the input in place and index
     elif retimestamp == 'inplace':
@@ -139,52 +190,25 @@ def retimestamp_and_index_file(inpath, outpath=None, retimestamp=None):
             log.error("Failed to retimestamp `%s' in place", inpath)
             return False
 
-        return index_file(inpath, outpath)
+        return index_file(inpath, outpath, padding)
 
-    # retimestamp the input into a temporary file
+    # retimestamp the tags while writing the indexed file
     elif retimestamp == 'atomic':
-        from flvlib.scripts.retimestamp_flv import retimestamp_file_atomically
-
         log.debug("Retimestamping file `%s' atomically", inpath)
 
-        try:
-            fd, temppath = tempfile.mkstemp()
-            os.close(fd)
-            # preserve the permission bits
-            shutil.copymode(inpath, temppath)
-        except EnvironmentError, (errno, strerror):
-            log.error("Failed to create temporary file: %s", strerror)
-            return False
+        return index_file(inpath, outpath, padding, retimestamp=True)
 
-        if not retimestamp_file_atomically(inpath, temppath):
-            log.error("Failed to retimestamp `%s' atomically", inpath)
-            # remove the temporary files
-            force_remove(temppath)
-            return False
 
-        # index the temporary file
-        if not index_file(temppath, outpath):
-            force_remove(temppath)
-            return False
+def index_file(inpath, outpath=None, padding=0, retimestamp=False):
+    """
+    Write the file with an onMetaData that has its keyframe table, to
+    outpath or over the input.
 
-        if not outpath:
-            # If we were not writing directly to the output file
-            # we need to overwrite the original
-            try:
-                shutil.move(temppath, inpath)
-            except EnvironmentError, (errno, strerror):
-                log.error("Failed to overwrite the original file with the "
-                          "retimestamped and indexed version: %s", strerror)
-                return False
-        else:
-            # if we were writing directly to the output file we need to remove
-            # the retimestamped temporary file
-            force_remove(temppath)
-
-        return True
-
-
-def index_file(inpath, outpath=None):
+    With retimestamp the timestamps in the output are rebased like
+    retimestamp-flv does. The keyframe table is computed with the new
+    timestamps while the input is indexed, and the timestamps are patched
+    as the tags are copied, so that takes no extra pass over the file.
+    """
     out_text = (outpath and ("into file `%s'" % outpath)) or "and overwriting"
     log.debug("Indexing file `%s' %s", inpath, out_text)
 
@@ -194,9 +218,10 @@ def index_file(inpath, outpath=None):
         log.error("Failed to open `%s': %s", inpath, strerror)
         return False
 
-    flv = IndexingFLV(f)
-    tag_iterator = flv.iter_tags()
-    last_tag = None
+    flv = IndexingFLV(f, retimestamp)
+    # indexing only needs the tag headers and the audio/video flags
+    tag_iterator = flv.iter_tags(payload=PAYLOAD_FLAGS)
+    last_timestamp = None
 
     try:
         while True:
@@ -204,8 +229,9 @@ def index_file(inpath, outpath=None):
             # some buggy software, like gstreamer's flvmux, puts a metadata tag
             # at the end of the file with timestamp 0, and we don't want to
             # base our duration computation on that
-            if tag.timestamp != 0:
-                last_tag = tag
+            timestamp = flv.output_timestamp(tag)
+            if timestamp != 0:
+                last_timestamp = timestamp
     except MalformedFLV, e:
         message = e[0] % e[1:]
         log.error("The file `%s' is not a valid FLV file: %s", inpath, message)
@@ -220,7 +246,7 @@ def index_file(inpath, outpath=None):
         log.error("The file `%s' does not have any media content", inpath)
         return False
 
-    if not last_tag:
+    if last_timestamp is None:
         log.error("The file `%s' does not have any content with a "
                   "non-zero timestamp", inpath)
         return False
@@ -244,26 +270,43 @@ def index_file(inpath, outpath=None):
     if not duration:
         # A duration of 0 is nonsensical, yet some tools put it like that. In
         # that case (or when there is no such field) update the duration value.
-        duration = last_tag.timestamp / 1000.0
+        duration = last_timestamp / 1000.0
 
     metadata['duration'] = duration
     metadata['keyframes'] = keyframes
     metadata['metadatacreator'] = 'flvlib %s' % __versionstr__
+    padded = metadata.pop(METADATA_PADDING_KEY, None) is not None
+
+    # When updating a file whose metadata comes before the media, try to
+    # fit the new metadata into the space taken by the old one. Nothing
+    # moves then, so it's enough to overwrite the metadata tag. Padding is
+    # only added to files that asked for it, now or when last indexed.
+    if (not outpath and not flv.timestamp_offset and
+        flv.metadata_tag_start and
+        flv.metadata_tag_start < flv.first_media_tag_offset):
+        payload = create_padded_metadata(metadata, original_metadata_size,
+                                         padded or padding)
+        if payload is not None:
+            f.close()
+            return write_metadata_inplace(inpath, flv.metadata_tag_start,
+                                          payload)
+        log.debug("The new metadata of `%s' does not fit in place", inpath)
+
+    if padding:
+        metadata[METADATA_PADDING_KEY] = ' ' * padding
 
     # we're going to write new metadata, so we need to shift the
     # filepositions by the amount of bytes that we're going to add to
     # the metadata tag
-    test_payload, difference = filepositions_difference(metadata,
-                                                        original_metadata_size)
+    difference = filepositions_difference(metadata, original_metadata_size)
 
     if difference:
         new_filepositions = [pos + difference
                              for pos in keyframes.filepositions]
         metadata['keyframes'].filepositions = new_filepositions
-        payload = create_script_tag('onMetaData', metadata)
     else:
         log.debug("The file `%s' metadata size did not change.", inpath)
-        payload = test_payload
+    payload = create_script_tag('onMetaData', metadata)
 
     if outpath:
         try:
@@ -287,8 +330,11 @@ def index_file(inpath, outpath=None):
         fo.write(create_flv_header(has_audio=flv.has_audio,
                                    has_video=flv.has_video))
         fo.write(payload)
-        f.seek(flv.first_media_tag_offset)
-        shutil.copyfileobj(f, fo)
+        if flv.timestamp_offset:
+            copy_retimestamped(f, fo, flv.first_media_tag_offset,
+                               flv.timestamp_offset_tag, flv.timestamp_offset)
+        else:
+            copy_range(f, fo, flv.first_media_tag_offset)
     except IOError, (errno, strerror):
         log.error("Failed to create the indexed file: %s", strerror)
         if not outpath:
@@ -312,6 +358,21 @@ def index_file(inpath, outpath=None):
     return True
 
 
+def write_metadata_inplace(path, offset, payload):
+    log.debug("Updating the metadata of `%s' in place", path)
+    try:
+        fo = open(path, 'r+b')
+        try:
+            fo.seek(offset)
+            fo.write(payload)
+        finally:
+            fo.close()
+    except IOError, (errno, strerror):
+        log.error("Failed to update the metadata of `%s': %s", path, strerror)
+        return False
+    return True
+
+
 def process_options():
     usage = "%prog [-U] file [outfile|file2 file3 ...]"
     description = ("Finds keyframe timestamps and file offsets "
@@ -333,6 +394,11 @@ def process_options():
                       help=("same as -r but avoid creating temporary files at "
                             "the risk of corrupting the input files in case "
                             "of errors"))
+    parser.add_option("-p", "--padding", type="int", default=0,
+                      metavar="BYTES",
+                      help=("reserve this many bytes in the metadata, so "
+                            "that later updates can overwrite it in place "
+                            "instead of rewriting the file"))
     parser.add_option("-v", "--verbose", action="count",
                       default=0, dest="verbosity",
                       help="be more verbose, each -v increases verbosity")
@@ -348,6 +414,10 @@ def process_options():
     if options.retimestamp and options.retimestamp_inplace:
         parser.error("You cannot provide both -r and -R")
 
+    if not 0 <= options.padding <= MAX_METADATA_PADDING:
+        parser.error("The padding has to be between 0 and %d bytes" %
+                     MAX_METADATA_PADDING)
+
     if options.verbosity > 3:
         options.verbosity = 3
 
@@ -370,11 +440,13 @@ def index_files():
 
     if not options.update:
         clean_run = retimestamp_and_index_file(args[1], args[2],
-                                               retimestamp=retimestamp_mode)
+                                               retimestamp=retimestamp_mode,
+                                               padding=options.padding)
     else:
         for filename in args[1:]:
             if not retimestamp_and_index_file(filename,
-                                              retimestamp=retimestamp_mode):
+                                              retimestamp=retimestamp_mode,
+                                              padding=options.padding):
                 clean_run = False
 
     return clean_run
@@ -7,24 +7,18 @@ import tempfile
 from optparse import OptionParser
 
 from flvlib import __versionstr__
-from flvlib.constants import TAG_TYPE_AUDIO, TAG_TYPE_VIDEO, TAG_TYPE_SCRIPT
 from flvlib.constants import AAC_PACKET_TYPE_SEQUENCE_HEADER
 from flvlib.constants import H264_PACKET_TYPE_SEQUENCE_HEADER
 from flvlib.primitives import make_ui8, make_ui24, make_si32_extended
 from flvlib.astypes import MalformedFLV
-from flvlib.tags import FLV, EndOfFile, AudioTag, VideoTag, ScriptTag
-from flvlib.helpers import force_remove
+from flvlib.tags import FLV, FLVParser, EndOfFile, AudioTag, VideoTag
+from flvlib.tags import ScriptTag, PAYLOAD_FLAGS, TAG_HEADER, tag_to_class
+from flvlib.tags import decode_tag_header
+from flvlib.helpers import force_remove, COPY_CHUNK_SIZE
 
 log = logging.getLogger('flvlib.retimestamp-flv')
 
 
-class_to_tag = {
-    AudioTag: TAG_TYPE_AUDIO,
-    VideoTag: TAG_TYPE_VIDEO,
-    ScriptTag: TAG_TYPE_SCRIPT
-}
-
-
 def is_nonheader_media(tag):
     if isinstance(tag, ScriptTag):
         return False
@@ -41,7 +35,7 @@ def output_offset_tag(fi, fo, tag, offset):
         new_timestamp = tag.timestamp
 
     # write the FLV tag value
-    fo.write(make_ui8(class_to_tag[tag.__class__]))
+    fo.write(make_ui8(tag.type))
     # the tag size remains unchanged
     fo.write(make_ui24(tag.size))
     # wirte the new timestamp
@@ -58,7 +52,7 @@ def retimestamp_tags_inplace(f, fu):
     flv = FLV(f)
     offset = None
 
-    for tag in flv.iter_tags():
+    for tag in flv.iter_tags(payload=PAYLOAD_FLAGS):
         if offset is None and is_nonheader_media(tag):
             offset = tag.timestamp
             log.debug("Determined the offset to be %d", offset)
@@ -69,6 +63,95 @@ def retimestamp_tags_inplace(f, fu):
             fu.write(make_si32_extended(tag.timestamp - offset))
 
 
+def patch_tag_headers(buf, pos, offset):
+    # Offset the timestamps of the tags in buf starting with the one at pos,
+    # as far as their headers are in buf. Returns the position of the
+    # first tag that was not done, which can be past the end of buf.
+    while pos + TAG_HEADER.size <= len(buf):
+        tag_type, size, timestamp, _ = decode_tag_header(buf, pos)
+        if tag_type not in tag_to_class:
+            raise MalformedFLV("Invalid tag type: %d", tag_type)
+        buf[pos + 4:pos + 8] = make_si32_extended(timestamp - offset)
+
+        #   next tag: header (11) + tag size + previous tag size (4)
+        pos += TAG_HEADER.size + size + 4
+    return pos
+
+
+def copy_retimestamped(f, fo, start, first_tag, offset, count=None):
+    """
+    Copy count bytes of f from start on, or everything up to the end of f
+    if count is None, to fo, subtracting offset from the timestamps of the
+    tags from the one at first_tag on.
+
+    The data goes through in big blocks and only the tag headers in them
+    get touched. Raises EndOfFile if the data ends in the middle of a tag.
+    """
+    f.seek(start)
+    end = None
+    if count is not None:
+        end = start + count
+    pending = bytearray()
+    # file offset of the first pending byte
+    written = start
+    # file offset of the next tag to patch
+    next_tag = first_tag
+
+    while True:
+        size = COPY_CHUNK_SIZE
+        if end is not None:
+            size = min(size, end - written - len(pending))
+            if size <= 0:
+                break
+        data = f.read(size)
+        if not data:
+            break
+        pending += data
+
+        next_tag = written + patch_tag_headers(pending, next_tag - written,
+                                               offset)
+        # keep a header that is not complete yet
+        done = min(next_tag - written, len(pending))
+        fo.write(buffer(pending, 0, done))
+        del pending[:done]
+        written += done
+
+    if next_tag != written + len(pending):
+        raise EndOfFile("The file ends in the middle of a tag")
+
+
+def retimestamp_tags_streaming(f, fo):
+    # Read f in big blocks and write them to fo with the timestamps
+    # changed. Until the offset is found the blocks go through a push
+    # parser. Every tag after that gets offset, so the rest of the file
+    # only needs its tag headers patched on the way.
+    parser = FLVParser(payload=PAYLOAD_FLAGS)
+    pending = ''
+    # file offset of the first pending byte
+    written = 0
+
+    while True:
+        data = f.read(COPY_CHUNK_SIZE)
+        if not data:
+            # nothing to offset, but complain about a truncated last tag
+            parser.close()
+            return
+        pending += data
+
+        for tag in parser.feed(data):
+            if is_nonheader_media(tag):
+                log.debug("Determined the offset to be %d", tag.timestamp)
+                fo.write(pending[:tag.offset - written])
+                copy_retimestamped(f, fo, tag.offset, tag.offset,
+                                   tag.timestamp)
+                return
+
+        done = parser.offset - written
+        fo.write(pending[:done])
+        pending = pending[done:]
+        written += done
+
+
 def retimestamp_file_inplace(inpath):
     try:
         f = open(inpath, 'rb')
@@ -105,7 +188,7 @@ def retimestamp_file_atomically(inpath, outpath):
 
     if outpath:
         try:
-            fo = open(outpath, 'w+b')
+            fo = open(outpath, 'wb')
         except IOError, (errno, strerror):
             log.error("Failed to open `%s': %s", outpath, strerror)
             return False
@@ -120,17 +203,7 @@ def retimestamp_file_atomically(inpath, outpath):
             return False
 
     try:
-        shutil.copyfileobj(f, fo)
-    except EnvironmentError, (errno, strerror):
-        log.error("Failed to create temporary copy: %s", strerror)
-        force_remove(temppath)
-        return False
-
-    f.seek(0)
-    fo.seek(0)
-
-    try:
-        retimestamp_tags_inplace(f, fo)
+        retimestamp_tags_streaming(f, fo)
     except IOError, (errno, strerror):
         log.error("Failed to create the retimestamped file: %s", strerror)
         if not outpath:
@@ -0,0 +1,71 @@
+"""
+Reading FLV streams from sockets without blocking.
+"""
+
+import socket
+import asyncore
+import logging
+
+from primitives import EndOfFile
+from astypes import MalformedFLV
+from tags import FLVParser
+
+log = logging.getLogger('flvlib.streams')
+
+RECV_SIZE = 65536
+
+
+class FLVDispatcher(asyncore.dispatcher):
+    """
+    An asyncore dispatcher that parses the FLV stream coming in on its
+    socket.
+
+    Subclasses override handle_tag(), which gets called with every tag as
+    soon as it's complete, and optionally handle_stream_end(). Any number
+    of streams can be served from a single thread by asyncore.loop().
+
+    The keyword arguments are passed to the FLVParser, so payload and
+    encrypted work like they do for FLV.
+    """
+
+    def __init__(self, sock=None, map=None, **kwargs):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.parser = FLVParser(**kwargs)
+
+    def writable(self):
+        return not self.connected
+
+    def handle_read(self):
+        try:
+            data = self.recv(RECV_SIZE)
+        except socket.error, (errno, strerror):
+            log.error("Failed to read from the stream: %s", strerror)
+            self.close()
+            return
+        if not data:
+            return
+        try:
+            for tag in self.parser.feed(data):
+                self.handle_tag(tag)
+        except (MalformedFLV, EndOfFile), e:
+            # EndOfFile here means a tag was shorter than its DataSize
+            self.handle_stream_end(e)
+            self.close()
+
+    def handle_close(self):
+        error = None
+        try:
+            self.parser.close()
+        except EndOfFile, e:
+            error = e
+        self.handle_stream_end(error)
+        self.close()
+
+    def handle_tag(self, tag):
+        pass
+
+    def handle_stream_end(self, error):
+        # error is None if the stream ended cleanly after a complete tag,
+        # otherwise the exception that stopped parsing
+        if error is not None:
+            log.error("The FLV stream ended abnormally: %s", error)
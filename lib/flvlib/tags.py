@@ -1,4 +1,6 @@
 import os
+import re
+import time
 import struct
 import logging
 
@@ -6,14 +8,50 @@ from primitives import *
 from constants import *
 from astypes import MalformedFLV
 from astypes import get_script_data_variable, make_script_data_variable
-from bitstring import BitStream
+from astypes import script_data_variable_size
+from astypes import decode_string, decode_script_data_value, AMF3Value
+from bitreader import BitReader
+from helpers import FileWatcher, OffsetStringIO
 
 log = logging.getLogger('flvlib.tags')
 
 STRICT_PARSING = False
 
+# TagType, DataSize, Timestamp, TimestampExtended and StreamID. The 24-bit
+# fields are split into a high byte and a low short.
+TAG_HEADER = struct.Struct(">BBHBHBBH")
+TAG_SIZE = struct.Struct(">BH")
+PREVIOUS_TAG_SIZE = struct.Struct(">I")
+
+# How much of each tag's payload gets parsed: nothing at all, only the
+# audio/video flags at the start of the payload, or everything
+(PAYLOAD_NONE,
+ PAYLOAD_FLAGS,
+ PAYLOAD_FULL) = ('none', 'flags', 'full')
+
+# How much gets read at a time when looking for the next tag in a damaged
+# file, and what the start of a tag header looks like: a known TagType and
+# a zero StreamID
+RESYNC_BUFFER_SIZE = 1 << 20
+TAG_CANDIDATE = re.compile('(?=[\x08\x09\x0f\x12]'
+                           '[\x00-\xff]{7}\x00\x00\x00)')
+
+# The FLV header is 9 bytes in version 1. Later versions may make it longer,
+# but FLVParser doesn't believe a DataOffset above this.
+MAX_HEADER_SIZE = 1 << 16
+
+# FLVWriter collects this much before writing
+WRITE_BUFFER_SIZE = 1 << 20
+
 frame_num_width = 4;
 
+# The NAL unit header, first_mb_in_slice, slice_type, pic_parameter_set_id
+# and frame_num all fit in the first few bytes of a slice
+SLICE_HEADER_BYTES = 32
+
+# Stands in for a script tag value that has not been decoded yet
+UNDECODED = object()
+
 def strict_parser():
     return globals()['STRICT_PARSING']
 
@@ -22,6 +60,31 @@ class EndOfTags(Exception):
     pass
 
 
+def read_payload(f, size):
+    # Files that can hand out views of their data, like helpers.MappedFile,
+    # let payloads be kept around without copying them
+    try:
+        read_view = f.read_view
+    except AttributeError:
+        return f.read(size)
+    return read_view(size)
+
+
+def decode_tag_header(buf, pos=0):
+    # TagType, DataSize, the signed Timestamp with TimestampExtended as its
+    # high byte, and StreamID of the tag header at pos in buf. Raises
+    # struct.error if the header is not all there.
+    (tag_type, size_high, size_low, timestamp_high, timestamp_low,
+     timestamp_extended, stream_id_high, stream_id_low) = \
+        TAG_HEADER.unpack_from(buf, pos)
+    timestamp = ((timestamp_extended << 24) + (timestamp_high << 16) +
+                 timestamp_low)
+    if timestamp_extended & 0x80:
+        timestamp -= 0x100000000
+    return (tag_type, (size_high << 16) + size_low, timestamp,
+            (stream_id_high << 16) + stream_id_low)
+
+
 def ensure(value, expected, error_msg):
     if value == expected:
         return
@@ -34,6 +97,10 @@ def ensure(value, expected, error_msg):
 
 class Tag(object):
 
+    # Tags are created by the million, so they don't get a __dict__
+    __slots__ = ('f', 'parent_flv', 'offset', 'size', 'stream_id',
+                 'timestamp', 'type', 'previous_tag_size', '_header')
+
     def __init__(self, parent_flv, f):
         self.f = f
         self.parent_flv = parent_flv
@@ -42,6 +109,14 @@ class Tag(object):
         self.stream_id = 0
         self.timestamp = None
         self.type = 0
+        # the tag header, when FLV.get_next_tag already read it
+        self._header = None
+
+    def detach(self):
+        # Drop the references to the file and the FLV object, once the tag
+        # is parsed they are not needed anymore
+        self.f = None
+        self.parent_flv = None
 
     def write(self, outfile):
         outfile.write(make_ui8(self.type))
@@ -55,39 +130,64 @@ class Tag(object):
     def parse(self):
         f = self.f
 
-        self.offset = f.tell() - 1
-
-        # DataSize
-        self.size = get_ui24(f)
+        # The tag header is decoded from a single read. FLV.get_next_tag
+        # leaves the full 11 bytes it read, including the TagType, on the
+        # tag; otherwise f is positioned right after TagType.
+        header = self._header
+        if header is None:
+            self.offset = f.tell() - 1
+            header = make_ui8(self.type) + f.read(TAG_HEADER.size - 1)
+        else:
+            self._header = None
+            self.offset = f.tell() - TAG_HEADER.size
 
-        # Timestamp + TimestampExtended
-        self.timestamp = get_si32_extended(f)
+        try:
+            tag_type, self.size, self.timestamp, stream_id = \
+                decode_tag_header(header)
+        except struct.error:
+            raise EndOfFile
 
         if self.timestamp < 0:
             log.warning("The tag at offset 0x%08X has negative timestamp: %d",
                         self.offset, self.timestamp)
 
-        # StreamID
-        stream_id = get_ui24(f)
-        ensure(stream_id, 0, "StreamID non zero: 0x%06X" % stream_id)
+        if stream_id != 0:
+            ensure(stream_id, 0, "StreamID non zero: 0x%06X" % stream_id)
 
         # The rest gets parsed in the subclass, it should move f to the
         # correct position to read PreviousTagSize
-        self.parse_tag_content()
+        payload = getattr(self.parent_flv, 'payload', PAYLOAD_FULL)
+        if payload == PAYLOAD_FULL:
+            self.parse_tag_content()
+        elif payload == PAYLOAD_FLAGS:
+            self.parse_tag_flags()
+        else:
+            f.seek(self.size, os.SEEK_CUR)
 
         self.previous_tag_size = get_ui32(f)
-        ensure(self.previous_tag_size, self.size + 11,
-               "PreviousTagSize of %d (0x%08X) "
-               "not equal to actual tag size of %d (0x%08X)" %
-               (self.previous_tag_size, self.previous_tag_size,
-                self.size + 11, self.size + 11))
+        # only format the message when it's going to be used
+        if self.previous_tag_size != self.size + 11:
+            ensure(self.previous_tag_size, self.size + 11,
+                   "PreviousTagSize of %d (0x%08X) "
+                   "not equal to actual tag size of %d (0x%08X)" %
+                   (self.previous_tag_size, self.previous_tag_size,
+                    self.size + 11, self.size + 11))
 
     def parse_tag_content(self):
         # By default just seek past the tag content
         self.f.seek(self.size, os.SEEK_CUR)
 
+    def parse_tag_flags(self):
+        # Only parse what can be read from the first few bytes of the
+        # content and seek past the rest. By default there's nothing cheaper
+        # than parsing everything.
+        self.parse_tag_content()
+
 class AudioTag(Tag):
 
+    __slots__ = ('sound_format', 'sound_rate', 'sound_size', 'sound_type',
+                 'aac_packet_type', 'frame_offset', 'data')
+
     def __init__(self, parent_flv, f):
         Tag.__init__(self, parent_flv, f)
         self.sound_format = None
@@ -95,8 +195,39 @@ class AudioTag(Tag):
         self.sound_size = None
         self.sound_type = None
         self.aac_packet_type = None  # always None for non-AAC tags
+        self.data = None
 
-    def parse_tag_content(self):
+    def write_tag_content(self, outfile):
+        sound_flags = ((self.sound_format << 4) | (self.sound_rate << 2) |
+                       (self.sound_size << 1) | self.sound_type)
+        outfile.write(make_ui8(sound_flags))
+        if self.sound_format == SOUND_FORMAT_AAC:
+            outfile.write(make_ui8(self.aac_packet_type))
+        outfile.write(self.read_data())
+
+    def read_data(self):
+        # The audio frames, read back from the file if they were not kept
+        # when the tag was parsed
+        if self.data is not None:
+            return self.data
+        if self.f is None:
+            raise ValueError("The audio data of the tag at offset 0x%08X was "
+                             "not kept, parse the file with keep_audio_data "
+                             "or from a MappedFile" % self.offset)
+        read_bytes = self.sound_format == SOUND_FORMAT_AAC and 2 or 1
+        size = self.size - read_bytes
+        f = self.f
+        pos = f.tell()
+        try:
+            f.seek(self.offset + TAG_HEADER.size + read_bytes)
+            data = f.read(size)
+        finally:
+            f.seek(pos)
+        if len(data) < size:
+            raise EndOfFile
+        return data
+
+    def parse_sound_flags(self):
         f = self.f
 
         sound_flags = get_ui8(f)
@@ -137,7 +268,22 @@ class AudioTag(Tag):
                 raise MalformedFLV("Invalid AAC packet type: %d",
                                    self.aac_packet_type)
 
-        f.seek(self.size - read_bytes, os.SEEK_CUR)
+        return read_bytes
+
+    def parse_tag_flags(self):
+        read_bytes = self.parse_sound_flags()
+        self.f.seek(self.size - read_bytes, os.SEEK_CUR)
+
+    def parse_tag_content(self):
+        read_bytes = self.parse_sound_flags()
+        # Copies of the audio frames would keep a whole file's worth of them
+        # in memory, so they are only kept when they come as views or when
+        # asked for
+        if (hasattr(self.f, 'read_view') or
+            getattr(self.parent_flv, 'keep_audio_data', False)):
+            self.data = read_payload(self.f, self.size - read_bytes)
+        else:
+            self.f.seek(self.size - read_bytes, os.SEEK_CUR)
 
     def __repr__(self):
         if self.offset is None:
@@ -171,6 +317,11 @@ class AVCDecoderConfigurationRecord():
         self.numPPS = 0
         self.pps = []
 
+    def detach(self):
+        self.f = None
+        for nalu in self.sps + self.pps:
+            nalu.detach()
+
     def parse_tag_content(self):
         self.configurationVersion = get_ui8(self.f)
         self.avcProfileIndication = get_ui8(self.f)
@@ -219,6 +370,11 @@ class AVCDecoderConfigurationRecord():
 
 
 class NALU(Tag):
+
+    __slots__ = ('data', 'forbidden_bit', 'nal_ref_idc', 'nal_unit_type',
+                 'first_mb_in_slice', 'slice_type', 'pic_parameter_set_id',
+                 'frame_num')
+
     def __init__(self, tag, f):
         self.f = f;
         self.size = 0;
@@ -249,19 +405,18 @@ class NALU(Tag):
         elif size_width == 4:
             self.size = get_ui32(self.f)
 
-        self.data = self.f.read(self.size)
-        s = BitStream('0x' + self.data.encode('hex'))
-        self.forbidden_bit = s.read('uint:1')
-        self.nal_ref_idc = s.read('uint:2')
-        self.nal_unit_type = s.read('uint:5')
+        self.data = read_payload(self.f, self.size)
+        s = BitReader(self.data[:SLICE_HEADER_BYTES])
+        self.forbidden_bit = s.read(1)
+        self.nal_ref_idc = s.read(2)
+        self.nal_unit_type = s.read(5)
         self.type = self.nal_unit_type
         #self.type = int(struct.unpack('B', self.data[0])[0]) & 31
         if (self.type == 1 or self.type == 5):
-            #s = BitStream('0x' + self.data[1:].encode('hex'))
-            self.first_mb_in_slice = s.read('ue')
-            self.slice_type = s.read('ue')
-            self.pic_parameter_set_id = s.read('ue')
-            self.frame_num = s.read('uint:{}'.format(frame_num_width))
+            self.first_mb_in_slice = s.read_ue()
+            self.slice_type = s.read_ue()
+            self.pic_parameter_set_id = s.read_ue()
+            self.frame_num = s.read(frame_num_width)
 
     def __repr__(self):
         if self.type == 1:
@@ -284,67 +439,78 @@ CROP_TOP = 2
 CROP_BOTTOM = 3
 class SPS(NALU):
     chroma_profiles = [100, 110, 122, 244, 44, 83, 86, 118, 128, 134, 138, 139]
-    parsed = False
-    forbidden_bit = -1
-    nal_ref_idc = -1
-    nal_unit_type = -1
-    profile_idc = -1
-    constraint_flags = []
-    reserved_bits = -1
-    level_idc = -1
-    seq_parameter_set_id = -1
-    log2_max_frame_num_minus4 = -1
-    pic_order_cnt_type = -1
-    log2_max_pic_order_cnt_lsb_minus4 = -1
-    num_ref_frames = -1
-    gaps_in_frame_num_value_allowed_flag = -1
-    frame_mbs_only_flag = -1
-    direct_8x8_inference_flag = -1
-    frame_cropping_flag = -1
-    vui_prameters_present_flag = -1
-    rbsp_stop_one_bit = -1
-    chroma_format_idc = -1
-    separate_color_plane_flag = -1
-    bit_depth_luma_minus8 = -1
-    bit_depth_chroma_minus8 = -1
-    qpprime_y_zero_transform_bypass_flag = -1
-    seq_scaling_matrix_present_flag = -1
-    sequence_scaling_list = []
-    delta_pic_order_always_zero_flag = -1
-    offset_for_non_ref_pic = -1
-    offset_for_top_to_bottom_field = -1
-    num_ref_frames_in_pic_order_cnt_cycle = -1
-    offsets_for_ref_frame = -1
-    max_num_ref_frames = -1
-    pic_width_in_mbs_minus1 = -1
-    pic_height_in_map_units_minus1 = -1
-    mb_adaptive_frame_field_flag = -1
-    frame_crop_offsets = []
-    vui_parameters_present_flag = -1
+
+    # The fields filled in by parse_sps_data and their initial values
+    sps_defaults = (
+        ('parsed', False),
+        ('profile_idc', -1),
+        ('reserved_bits', -1),
+        ('level_idc', -1),
+        ('seq_parameter_set_id', -1),
+        ('log2_max_frame_num_minus4', -1),
+        ('pic_order_cnt_type', -1),
+        ('log2_max_pic_order_cnt_lsb_minus4', -1),
+        ('num_ref_frames', -1),
+        ('gaps_in_frame_num_value_allowed_flag', -1),
+        ('frame_mbs_only_flag', -1),
+        ('direct_8x8_inference_flag', -1),
+        ('frame_cropping_flag', -1),
+        ('vui_prameters_present_flag', -1),
+        ('rbsp_stop_one_bit', -1),
+        ('chroma_format_idc', -1),
+        ('separate_color_plane_flag', -1),
+        ('bit_depth_luma_minus8', -1),
+        ('bit_depth_chroma_minus8', -1),
+        ('qpprime_y_zero_transform_bypass_flag', -1),
+        ('seq_scaling_matrix_present_flag', -1),
+        ('delta_pic_order_always_zero_flag', -1),
+        ('offset_for_non_ref_pic', -1),
+        ('offset_for_top_to_bottom_field', -1),
+        ('num_ref_frames_in_pic_order_cnt_cycle', -1),
+        ('offsets_for_ref_frame', -1),
+        ('max_num_ref_frames', -1),
+        ('pic_width_in_mbs_minus1', -1),
+        ('pic_height_in_map_units_minus1', -1),
+        ('mb_adaptive_frame_field_flag', -1),
+        ('vui_parameters_present_flag', -1),
+    )
+
+    __slots__ = (tuple([name for name, value in sps_defaults]) +
+                 ('constraint_flags', 'sequence_scaling_list',
+                  'frame_crop_offsets', 'log2_max_frame_num', 'width',
+                  'height'))
 
     def __init__(self, tag, f):
         NALU.__init__(self, tag, f)
+        self.forbidden_bit = -1
+        self.nal_ref_idc = -1
+        self.nal_unit_type = -1
+        for name, value in self.sps_defaults:
+            setattr(self, name, value)
+        self.constraint_flags = []
+        self.sequence_scaling_list = []
+        self.frame_crop_offsets = []
 
     def parse_sps_data(self):
-        s = BitStream('0x' + self.data.encode('hex'))
-        self.forbidden_bit = s.read('uint:1')
-        self.nal_ref_idc = s.read('uint:2')
-        self.nal_unit_type = s.read('uint:5')
-        self.profile_idc = s.read('uint:8')
-        self.constraint_flags = s.readlist('4*uint:1')
-        self.reserved_bits = s.read('uint:4')
-        self.level_idc = s.read('uint:8')
-        self.seq_parameter_set_id = s.read('ue')
+        s = BitReader(self.data)
+        self.forbidden_bit = s.read(1)
+        self.nal_ref_idc = s.read(2)
+        self.nal_unit_type = s.read(5)
+        self.profile_idc = s.read(8)
+        self.constraint_flags = [s.read(1) for i in xrange(4)]
+        self.reserved_bits = s.read(4)
+        self.level_idc = s.read(8)
+        self.seq_parameter_set_id = s.read_ue()
         if self.profile_idc in self.chroma_profiles:
-            self.chroma_format_idc = s.read('ue')
+            self.chroma_format_idc = s.read_ue()
             if self.chroma_format_idc == 3:
-                self.separate_color_plane_flag = s.read('uint:1')
-            self.bit_depth_luma_minus8 = s.read('ue')
-            self.bit_depth_chroma_minus8 = s.read('ue')
-            self.qpprime_y_zero_transform_bypass_flag = s.read('uint:1')
-            self.seq_scaling_matrix_present_flag = s.read('uint:1')
+                self.separate_color_plane_flag = s.read(1)
+            self.bit_depth_luma_minus8 = s.read_ue()
+            self.bit_depth_chroma_minus8 = s.read_ue()
+            self.qpprime_y_zero_transform_bypass_flag = s.read(1)
+            self.seq_scaling_matrix_present_flag = s.read(1)
             if self.seq_scaling_matrix_present_flag:
-                seq_scaling_list_present = s.read('uint:1')
+                seq_scaling_list_present = s.read(1)
                 scaling_list_count = 12 if self.chroma_format_idc == 3 else 8
                 for i in xrange(scaling_list_count):
                     if seq_scaling_list_present:
@@ -352,32 +518,33 @@ class SPS(NALU):
                         next_scale = 8
                         list_size = 16 if i < 6 else 64
                         for j in xrange(list_size):
-                            delta_scale = s.read('ue')
+                            delta_scale = s.read_ue()
 
-        self.log2_max_frame_num_minus4 = s.read('ue')
+        self.log2_max_frame_num_minus4 = s.read_ue()
         self.log2_max_frame_num = self.log2_max_frame_num_minus4 + 4
         frame_num_width = self.log2_max_frame_num;
-        self.pic_order_cnt_type = s.read('ue')
+        self.pic_order_cnt_type = s.read_ue()
         if self.pic_order_cnt_type == 0:
-            self.log2_max_pic_order_cnt_lsb_minus4 = s.read('ue')
+            self.log2_max_pic_order_cnt_lsb_minus4 = s.read_ue()
         elif self.pic_order_cnt_type == 1:
-            self.delta_pic_order_always_zero_flag = s.read('uint:1')
-            self.offset_for_non_ref_pic = s.read('se')
-            self.offset_for_top_to_bottom_field = s.read('se')
-            self.num_ref_frames_in_pic_order_cnt_cycle = s.read('ue')
-            self.offsets_for_ref_frame = s.readlist('4*')
-
-        self.max_num_ref_frames = s.read('ue')
-        self.gaps_in_frame_num_value_allowed_flag = s.read('uint:1')
-        self.pic_width_in_mbs_minus1 = s.read('ue')
-        self.pic_height_in_map_units_minus1 = s.read('ue')
-        self.frame_mbs_only_flag = s.read('uint:1')
+            self.delta_pic_order_always_zero_flag = s.read(1)
+            self.offset_for_non_ref_pic = s.read_se()
+            self.offset_for_top_to_bottom_field = s.read_se()
+            self.num_ref_frames_in_pic_order_cnt_cycle = s.read_ue()
+            self.offsets_for_ref_frame = [s.read_se() for i in xrange(
+                self.num_ref_frames_in_pic_order_cnt_cycle)]
+
+        self.max_num_ref_frames = s.read_ue()
+        self.gaps_in_frame_num_value_allowed_flag = s.read(1)
+        self.pic_width_in_mbs_minus1 = s.read_ue()
+        self.pic_height_in_map_units_minus1 = s.read_ue()
+        self.frame_mbs_only_flag = s.read(1)
         if self.frame_mbs_only_flag == 0:
-            self.mb_adaptive_frame_field_flag = s.read('uint:1')
-        self.direct_8x8_inference_flag = s.read('uint:1')
-        self.frame_cropping_flag = s.read('uint:1')
-        self.frame_crop_offsets = s.readlist('4*ue')
-        self.vui_parameters_present_flag = s.read('uint:1')
+            self.mb_adaptive_frame_field_flag = s.read(1)
+        self.direct_8x8_inference_flag = s.read(1)
+        self.frame_cropping_flag = s.read(1)
+        self.frame_crop_offsets = [s.read_ue() for i in xrange(4)]
+        self.vui_parameters_present_flag = s.read(1)
         self.width = 16 * (self.pic_width_in_mbs_minus1 + 1)
         self.height = 16 * (2 - self.frame_mbs_only_flag) * (self.pic_height_in_map_units_minus1 + 1)
 
@@ -398,6 +565,10 @@ class SPS(NALU):
 
 class VideoTag(Tag):
 
+    __slots__ = ('frame_type', 'codec_id', 'nalus', 'h264_packet_type',
+                 'composition_time', 'avc_header_offset', 'frame_offset',
+                 'data_size', 'configurationRecord')
+
     def __init__(self, parent_flv, f):
         Tag.__init__(self, parent_flv, f)
         self.frame_type = None
@@ -405,6 +576,15 @@ class VideoTag(Tag):
         self.nalus = []
         self.h264_packet_type = None # Always None for non-H.264 tags
 
+    def detach(self):
+        Tag.detach(self)
+        for nalu in self.nalus:
+            nalu.detach()
+        # sequence headers keep the file in their SPS and PPS NAL units
+        record = getattr(self, 'configurationRecord', None)
+        if record is not None:
+            record.detach()
+
     def write_tag_content(self, outfile):
         temp = (self.frame_type << 4) | self.codec_id
         outfile.write(make_ui8(temp))
@@ -419,7 +599,7 @@ class VideoTag(Tag):
 
 
 
-    def parse_tag_content(self):
+    def parse_video_flags(self):
         f = self.f
 
         video_flags = get_ui8(f)
@@ -440,22 +620,6 @@ class VideoTag(Tag):
             self.avc_header_offset = self.offset + 16
             self.frame_offset = self.avc_header_offset
             self.data_size = self.size - 5
-            if (self.h264_packet_type == 1):
-                self.nalus = []
-                if self.parent_flv.encrypted:
-                    f.seek(self.data_size, os.SEEK_CUR)
-                else:
-                    bytesRead = 0
-                    while bytesRead < self.data_size - 12:
-                        nal = NALU(self, f)
-                        nal.parse_tag_content()
-                        bytesRead += nal.size
-                        read_bytes += nal.size
-                        self.nalus.append(nal)
-            else:
-                self.configurationRecord = AVCDecoderConfigurationRecord(self, self.f)
-                self.configurationRecord.parse_tag_content()
-
 
         if strict_parser():
             try:
@@ -473,6 +637,40 @@ class VideoTag(Tag):
                 raise MalformedFLV("Invalid H.264 packet type: %d",
                                    self.h264_packet_type)
 
+        return read_bytes
+
+    def parse_tag_flags(self):
+        read_bytes = self.parse_video_flags()
+        self.f.seek(self.size - read_bytes, os.SEEK_CUR)
+
+    def parse_tag_content(self):
+        f = self.f
+        end = f.tell() + self.size
+
+        self.parse_video_flags()
+
+        if self.codec_id == CODEC_ID_H264:
+            if (self.h264_packet_type == 1):
+                self.nalus = []
+                if getattr(self.parent_flv, 'encrypted', False):
+                    f.seek(self.data_size, os.SEEK_CUR)
+                else:
+                    bytesRead = 0
+                    while bytesRead < self.data_size - 12:
+                        nal = NALU(self, f)
+                        nal.parse_tag_content()
+                        bytesRead += nal.size
+                        self.nalus.append(nal)
+            else:
+                self.configurationRecord = AVCDecoderConfigurationRecord(self, self.f)
+                self.configurationRecord.parse_tag_content()
+
+        # Make sure f ends up right before PreviousTagSize, whatever the
+        # codec and however many NAL units there were
+        position = f.tell()
+        if position != end:
+            f.seek(end - position, os.SEEK_CUR)
+
     def __repr__(self):
         if self.offset is None:
             return "<VideoTag unparsed>"
@@ -492,15 +690,52 @@ class VideoTag(Tag):
 
 class ScriptTag(Tag):
 
+    # The name is decoded when the tag is parsed, the value only when it's
+    # first asked for, since files can have thousands of cue points that
+    # nobody looks at
+    __slots__ = ('name', 'data', '_variable', '_variable_end')
+
+    # where the name starts in the payload
+    name_offset = 0
+
     def __init__(self, parent_flv, f):
         Tag.__init__(self, parent_flv, f)
         self.name = None
-        self.variable = None
+        self.data = None
+        self._variable = None
+        self._variable_end = None
 
     def parse_tag_content(self):
-        f = self.f
-        self.data = f.read(self.size)
+        data = self.data = read_payload(self.f, self.size)
+
+        # Here there's always a byte with the value of 0x02, which means
+        # "string", although the spec says NOTHING about it..
+        start = self.name_offset
+        if data[start:start + 1] != '\x02':
+            ensure(data[start:start + 1], '\x02',
+                   "The name of a script tag is not a string")
+            return
+        self.name, _ = decode_string(data, start + 1)
+        self._variable = UNDECODED
+
+        # Some muxers end the onMetaData ECMAArray without the end marker,
+        # only put up with that when not parsing strictly
+        if strict_parser():
+            self._variable_end = None
+        else:
+            self._variable_end = len(data)
 
+    def get_variable(self):
+        if self._variable is UNDECODED:
+            self._variable, _ = decode_script_data_value(
+                self.data, self.name_offset + len(self.name) + 3,
+                self._variable_end)
+        return self._variable
+
+    def set_variable(self, value):
+        self._variable = value
+
+    variable = property(get_variable, set_variable)
 
     def write_tag_content(self, outfile):
         outfile.write(self.data)
@@ -513,7 +748,14 @@ class ScriptTag(Tag):
                     (self.name, self.offset, self.timestamp, self.size))
 
 
-class ScriptAMF3Tag(Tag):
+class ScriptAMF3Tag(ScriptTag):
+
+    # The payload is a zero byte followed by the same name and value as in
+    # script tags, with the value usually an AMF3 one behind the AVM+
+    # marker
+    __slots__ = ()
+
+    name_offset = 1
 
     def __repr__(self):
         if self.offset is None:
@@ -539,7 +781,16 @@ class FLV(object):
         self.has_audio = None
         self.has_video = None
         self.encrypted = kwargs.get('encrypted', False)
+        self.payload = kwargs.get('payload', PAYLOAD_FULL)
+        # audio payloads are read from files that can't hand out views of
+        # their data only if this is set
+        self.keep_audio_data = kwargs.get('keep_audio_data', False)
         self.tags = []
+        self.follow_offset = None
+        # in recovery mode damaged parts of the file are skipped and their
+        # byte ranges get recorded in self.skipped
+        self.recover = kwargs.get('recover', False)
+        self.skipped = []
 
     def parse_header(self):
         f = self.f
@@ -586,8 +837,24 @@ class FLV(object):
         tag_0_size = get_ui32(f)
         ensure(tag_0_size, 0, "PreviousTagSize0 non zero: 0x%08X" % tag_0_size)
 
-    def iter_tags(self):
+    def iter_tags(self, payload=None):
+        # payload is one of PAYLOAD_NONE, PAYLOAD_FLAGS or PAYLOAD_FULL and
+        # overrides the mode the FLV was created with, until the iteration
+        # is over
+        if payload is not None and payload != self.payload:
+            previous = self.payload
+            self.payload = payload
+            try:
+                for tag in self.iter_tags():
+                    yield tag
+            finally:
+                self.payload = previous
+            return
         self.parse_header()
+        if self.recover:
+            for tag in self.iter_tags_recovering():
+                yield tag
+            return
         try:
             while True:
                 tag = self.get_next_tag()
@@ -595,20 +862,195 @@ class FLV(object):
         except EndOfTags:
             pass
 
+    def iter_tags_recovering(self):
+        f = self.f
+        self.skipped = []
+        last_timestamp = None
+        while True:
+            offset = f.tell()
+            try:
+                tag = self.get_next_tag()
+            except EndOfTags:
+                return
+            except (MalformedFLV, EndOfFile):
+                tag = None
+            # a tag that doesn't match its PreviousTagSize is damaged, the
+            # next one is likely to start somewhere else
+            if tag is None or tag.previous_tag_size != tag.size + 11:
+                resync_offset = self.find_next_tag(offset + 1, last_timestamp)
+                if resync_offset is None:
+                    end = self.file_size()
+                else:
+                    end = resync_offset
+                log.warning("Skipping %d damaged bytes at offset 0x%08X",
+                            end - offset, offset)
+                self.skipped.append((offset, end))
+                if resync_offset is None:
+                    return
+                f.seek(resync_offset)
+                continue
+            last_timestamp = tag.timestamp
+            yield tag
+
+    def find_next_tag(self, offset, min_timestamp=None):
+        """
+        Look for the next tag at or after offset, for when the file is
+        damaged. Returns its offset or None if there is none.
+
+        A candidate has to be followed by a PreviousTagSize that matches
+        it and then by another tag header or the end of the file. If
+        min_timestamp is given, its timestamp can't be lower.
+        """
+        f = self.f
+        while True:
+            f.seek(offset)
+            buf = f.read(RESYNC_BUFFER_SIZE)
+            for match in TAG_CANDIDATE.finditer(buf):
+                candidate = offset + match.start()
+                if self.is_plausible_tag(candidate, min_timestamp):
+                    return candidate
+            if len(buf) < RESYNC_BUFFER_SIZE:
+                return None
+            # overlap, to catch headers that straddle the buffers
+            offset += len(buf) - TAG_HEADER.size + 1
+
+    def is_plausible_tag(self, offset, min_timestamp=None):
+        f = self.f
+        f.seek(offset)
+        header = f.read(TAG_HEADER.size)
+        if len(header) < TAG_HEADER.size:
+            return False
+        tag_type, size, timestamp, _ = decode_tag_header(header)
+        if min_timestamp is not None and timestamp < min_timestamp:
+            return False
+
+        f.seek(offset + TAG_HEADER.size + size)
+        following = f.read(4 + TAG_HEADER.size)
+        if len(following) < 4:
+            return False
+        if PREVIOUS_TAG_SIZE.unpack(following[:4])[0] != size + 11:
+            return False
+        # the file may end in the middle of the next header, pad what's
+        # missing with zeros for the check
+        following = following[4:]
+        if not following:
+            return True
+        following = following.ljust(TAG_HEADER.size, '\x00')
+        return TAG_CANDIDATE.match(following) is not None
+
+    def follow_tags(self, offset=None, payload=None, poll_interval=0.5,
+                    timeout=None):
+        """
+        Yield tags from a file that is still being written to.
+
+        A tag is only parsed once it is completely in the file, including
+        its PreviousTagSize. When the end of the file is reached the
+        generator waits for more data, for ever or until nothing new
+        arrived for timeout seconds.
+
+        self.follow_offset is where the next tag starts. Pass it as offset
+        to carry on from there later, without parsing the header and the
+        tags before it again. The file needs to be a regular file object,
+        a MappedFile doesn't see data appended after it was created.
+
+        Like with iter_tags, payload overrides the payload mode until the
+        generator is done.
+        """
+        if payload is not None and payload != self.payload:
+            previous = self.payload
+            self.payload = payload
+            try:
+                for tag in self.follow_tags(offset, None, poll_interval,
+                                            timeout):
+                    yield tag
+            finally:
+                self.payload = previous
+            return
+        f = self.f
+
+        watcher = FileWatcher(getattr(f, 'name', None), poll_interval)
+        file_size = self.file_size()
+        last_change = time.time()
+        try:
+            while True:
+                # Work out how much has to be in the file before the next
+                # step: the header with PreviousTagSize0 or a whole tag
+                if offset is None:
+                    needed = 13
+                    if file_size >= needed:
+                        f.seek(5)
+                        needed = get_ui32(f) + 4
+                else:
+                    needed = offset + TAG_HEADER.size
+                    if file_size >= needed:
+                        f.seek(offset + 1)
+                        needed += get_ui24(f) + 4
+
+                if file_size >= needed:
+                    if offset is None:
+                        self.parse_header()
+                        offset = self.follow_offset = f.tell()
+                    else:
+                        f.seek(offset)
+                        tag = self.get_next_tag()
+                        # move on before handing the tag out, the consumer
+                        # may stop here or use f in the meantime
+                        offset = self.follow_offset = f.tell()
+                        yield tag
+                    last_change = time.time()
+                    continue
+
+                new_size = self.file_size()
+                if new_size != file_size:
+                    file_size = new_size
+                    last_change = time.time()
+                    continue
+
+                if timeout is None:
+                    watcher.wait()
+                else:
+                    remaining = last_change + timeout - time.time()
+                    if remaining <= 0:
+                        return
+                    watcher.wait(remaining)
+        finally:
+            watcher.close()
+
+    def file_size(self):
+        f = self.f
+        try:
+            return os.fstat(f.fileno()).st_size
+        except (AttributeError, EnvironmentError):
+            pos = f.tell()
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(pos)
+            return size
+
     def read_tags(self):
-        self.tags = list(self.iter_tags())
+        tags = []
+        for tag in self.iter_tags():
+            tag.detach()
+            tags.append(tag)
+        self.tags = tags
+
+    def build_index(self, use_numpy=True):
+        # see flvlib.index.build_index
+        from index import build_index
+        return build_index(self, use_numpy)
 
     def get_next_tag(self):
         f = self.f
 
-        try:
-            tag_type = get_ui8(f)
-        except EndOfFile:
+        header = f.read(TAG_HEADER.size)
+        if not header:
             raise EndOfTags
 
+        tag_type = ord(header[0])
         tag_klass = self.tag_type_to_class(tag_type)
         tag = tag_klass(self, f)
         tag.type = tag_type
+        tag._header = header
         tag.parse()
 
         return tag
@@ -620,6 +1062,144 @@ class FLV(object):
             raise MalformedFLV("Invalid tag type: %d at offset {} (Size: {})", tag_type, self.f.tell())
 
 
+class FLVParser(FLV):
+    """
+    A push based FLV parser, for streams that can't be seeked in.
+
+    Data gets passed to feed() in chunks of any size, which returns the
+    tags completed by that chunk. Only the current incomplete tag is kept
+    buffered. The returned tags are detached and their payloads are
+    strings.
+    """
+
+    def __init__(self, **kwargs):
+        # nothing can be read from the stream after a tag is returned
+        kwargs.setdefault('keep_audio_data', True)
+        FLV.__init__(self, None, **kwargs)
+        self.chunks = []
+        self.buffered = 0
+        # stream offset of the first buffered byte
+        self.offset = 0
+        # how many buffered bytes are needed before something can be parsed
+        self.needed = 9
+        self.header_parsed = False
+
+    def feed(self, data):
+        if data:
+            self.chunks.append(data)
+            self.buffered += len(data)
+        if self.buffered < self.needed:
+            return []
+
+        buf = ''.join(self.chunks)
+        pos = 0
+        tags = []
+        try:
+            while True:
+                available = len(buf) - pos
+                if not self.header_parsed:
+                    # the header and PreviousTagSize0, but make sure it is
+                    # an FLV header before waiting for DataOffset bytes
+                    needed = 9
+                    if available >= needed:
+                        self.check_header_start(buf)
+                        needed = PREVIOUS_TAG_SIZE.unpack_from(buf,
+                                                               pos + 5)[0] + 4
+                else:
+                    needed = TAG_HEADER.size
+                    if available >= needed:
+                        size_high, size_low = TAG_SIZE.unpack_from(buf,
+                                                                   pos + 1)
+                        needed += (size_high << 16) + size_low + 4
+                if available < needed:
+                    self.needed = needed
+                    break
+
+                self.f = OffsetStringIO(buf[pos:pos + needed],
+                                        self.offset + pos)
+                if not self.header_parsed:
+                    self.parse_header()
+                    self.header_parsed = True
+                else:
+                    tag = self.get_next_tag()
+                    tag.detach()
+                    tags.append(tag)
+                pos += needed
+        finally:
+            self.f = None
+            rest = buf[pos:]
+            self.chunks = rest and [rest] or []
+            self.buffered = len(rest)
+            self.offset += pos
+
+        return tags
+
+    def check_header_start(self, buf):
+        if buf[:3] != "FLV":
+            raise MalformedFLV("File signature is incorrect: 0x%X 0x%X 0x%X" %
+                               struct.unpack("3B", buf[:3]))
+        header_size = PREVIOUS_TAG_SIZE.unpack_from(buf, 5)[0]
+        if not 9 <= header_size <= MAX_HEADER_SIZE:
+            raise MalformedFLV("Invalid header size: %d" % header_size)
+
+    def close(self):
+        # Complain if the stream ended in the middle of a tag
+        if self.buffered:
+            raise EndOfFile("%d bytes of an incomplete tag left at offset "
+                            "%d" % (self.buffered, self.offset))
+        if not self.header_parsed:
+            raise EndOfFile("The stream ended before the FLV header")
+
+
+class FLVWriter(object):
+    """
+    Writes tags to a file in large blocks.
+
+    Tags get serialised with their usual write_tag_content methods, but
+    into a reusable in-memory buffer that is written out once buffer_size
+    bytes have been collected, instead of with several small writes per
+    tag. The output is the same as from Tag.write. Call flush() or close()
+    when done.
+    """
+
+    def __init__(self, outfile, buffer_size=WRITE_BUFFER_SIZE):
+        self.outfile = outfile
+        self.buffer_size = buffer_size
+        # a bytearray takes strings as well as buffer objects, like the
+        # payloads of tags read from a MappedFile
+        self.buffer = bytearray()
+
+    def write(self, data):
+        # Used both for raw data and as the outfile passed to the
+        # write_tag_content methods
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_header(self, has_audio=True, has_video=True):
+        self.write(create_flv_header(has_audio, has_video))
+
+    def write_tag(self, tag):
+        size = tag.size
+        timestamp = tag.timestamp & 0xFFFFFFFF
+        stream_id = tag.stream_id
+        self.buffer += TAG_HEADER.pack(tag.type, size >> 16, size & 0xFFFF,
+                                       (timestamp >> 16) & 0xFF,
+                                       timestamp & 0xFFFF, timestamp >> 24,
+                                       stream_id >> 16, stream_id & 0xFFFF)
+        tag.write_tag_content(self)
+        self.write(PREVIOUS_TAG_SIZE.pack(tag.previous_tag_size))
+
+    def flush(self):
+        if self.buffer:
+            self.outfile.write(self.buffer)
+            del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        self.outfile.flush()
+
+
 def create_flv_tag(type, data, timestamp=0):
     tag_type = struct.pack("B", type)
     timestamp = make_si32_extended(timestamp)
@@ -637,6 +1217,17 @@ def create_script_tag(name, data, timestamp=0):
     return create_flv_tag(TAG_TYPE_SCRIPT, payload, timestamp)
 
 
+def create_script_amf3_tag(name, data, timestamp=0):
+    payload = (make_ui8(0) + make_ui8(2) +
+               make_script_data_variable(name, AMF3Value(data)))
+    return create_flv_tag(TAG_TYPE_SCRIPT_AMF3, payload, timestamp)
+
+
+def script_tag_size(name, data):
+    # The length of create_script_tag(name, data), without creating it
+    return 11 + 1 + script_data_variable_size(name, data) + 4
+
+
 def create_flv_header(has_audio=True, has_video=True):
     type_flags = 0
     if has_video:
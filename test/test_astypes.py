@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import array
 from StringIO import StringIO
 from datetime import datetime, timedelta, tzinfo
 from test_common import SerializerTester
@@ -30,9 +31,30 @@ class ScriptDataValueSerializerTester(SerializerTester):
         for value in self.equivalence_tests:
             self.script_data_value_equivalent(value, getter, maker, value_type)
 
+        # the string based decoders give the same results
+        decoder = getattr(self.module, 'decode_' + self.name)
+        for input, expected in self.get_tests:
+            for data in (input, buffer('xx' + input, 2)):
+                value, offset = decoder(data, 0)
+                self.assertEquals(value, expected)
+                self.assertEquals(offset, len(input))
+        for value in self.equivalence_tests:
+            blob = maker(value)
+            self.assertEquals(decoder('xyz' + blob, 3),
+                              (value, len(blob) + 3))
+
+        # the sizes match what the makers produce
+        sizer = getattr(self.module, self.name + '_size')
+        for value, blob in self.make_tests:
+            self.assertEquals(sizer(value), len(blob))
+        for value in self.equivalence_tests:
+            self.assertEquals(sizer(value), len(maker(value)))
+
     def script_data_value_equivalent(self, val, getter, maker, value_type):
         s = StringIO(primitives.make_ui8(value_type) + maker(val))
         self.assertEquals(astypes.make_script_data_value(val), s.getvalue())
+        self.assertEquals(astypes.script_data_value_size(val),
+                          len(s.getvalue()))
         self.assertEquals(val, astypes.get_script_data_value(s))
         self.assertEquals(s.read(), '')
 
@@ -133,12 +155,35 @@ class TestASTypes(ScriptDataValueSerializerTester):
         self.add_equivalence_test(['a', 4, 'b', 6, True])
         self.add_equivalence_test([])
         self.add_equivalence_test(['a', 4, 'b', ['g', 6.3, 'j', {'a': 1, 'b': 2}]])
+        # arrays of numbers take the bulk path
+        self.add_make_test([1, 2.5, -3L], '\x00\x00\x00\x03\x00\x3f\xf0\x00\x00\x00\x00\x00\x00\x00\x40\x04\x00\x00\x00\x00\x00\x00\x00\xc0\x08\x00\x00\x00\x00\x00\x00')
+        self.add_make_test([True, 1], '\x00\x00\x00\x02\x01\x01\x00\x3f\xf0\x00\x00\x00\x00\x00\x00')
+        self.add_equivalence_test([0.5, 1e100, -7.0, 0.0])
+        self.add_equivalence_test([0.5, 3.0, 'a', 5.0])
         self.run_tests()
 
         # Various corner cases:
 
         # try wrong array size, should fail
         self.assertRaises(primitives.EndOfFile, astypes.get_strict_array, StringIO('\x00\x00\x00\x07\x00\x40\x08\x00\x00\x00\x00\x00\x00\x01\x00\x02\x00\x00\x00\xc0\x15\x99\x99\x99\x99\x99\x9a\x02\x00\x02\xc2\xbb\x01\x01'))
+        self.assertRaises(primitives.EndOfFile, astypes.get_strict_array, StringIO('\x00\x00\x00\x02\x00\x40\x08\x00\x00\x00\x00\x00\x00\x00\x40'))
+
+        # array.array objects get encoded like lists of numbers
+        self.assertEquals(astypes.make_script_data_value(array.array('d', [1, 2.5, -3])),
+                          astypes.make_script_data_value([1, 2.5, -3]))
+        self.assertEquals(astypes.script_data_value_size(array.array('i', [1, 2])), 23)
+
+        # arrays longer than a block, with something else in the middle
+        old_block = astypes.NUMBER_BLOCK
+        astypes.NUMBER_BLOCK = 4
+        try:
+            for value in ([float(i) for i in range(11)],
+                          [float(i) for i in range(9)] + [None, 3.0]):
+                s = StringIO(astypes.make_strict_array(value) + 'rest')
+                self.assertEquals(astypes.get_strict_array(s), value)
+                self.assertEquals(s.read(), 'rest')
+        finally:
+            astypes.NUMBER_BLOCK = old_block
 
     def test_date(self):
         self.set_name('date')
@@ -261,10 +306,168 @@ class TestScriptSerialization(SerializerTester):
         # Invalid value type
         self.assertRaises(astypes.MalformedFLV, astypes.get_script_data_value, StringIO('\x09\x00\x00\x00\x01\x00\x03\x66\x6f\x6f\x0a\x00\x00\x00\x03\x01\x00\x05\x0a\x00\x00\x00\x01\x00\x40\x0c\x00\x00\x00\x00\x00\x00\x00\x00\x09'))
 
+    def test_decode_script_data(self):
+        blob = '\x08\x00\x00\x00\x01\x00\x03\x66\x6f\x6f\x0a\x00\x00\x00\x03\x01\x00\x05\x0a\x00\x00\x00\x01\x00\x40\x0c\x00\x00\x00\x00\x00\x00\x00\x00\x09'
+        self.assertEquals(astypes.decode_script_data_value(blob),
+                          ({'foo': [False, None, [3.5]]}, len(blob)))
+        self.assertEquals(astypes.decode_script_data_variable('\x00\x03\x66\x6f\x6f\x05' + blob, 0),
+                          (('foo', None), 6))
+
+        # ECMA arrays that end without the marker, like some encoders do
+        self.assertEquals(astypes.decode_script_data_value(blob[:-3] + 'junk', 0, len(blob) - 3),
+                          ({'foo': [False, None, [3.5]]}, len(blob) - 3))
+
+        self.assertRaises(astypes.MalformedFLV, astypes.decode_script_data_value, '\x0e\x00')
+        for i in range(len(blob)):
+            self.assertRaises(primitives.EndOfFile, astypes.decode_script_data_value, blob[:i])
+
     def test_script_data_variable(self):
         self.set_name('script_data_variable')
         self.add_get_test('\x00\x03\x66\x6f\x6f\x05', ('foo', None))
         self.run_tests()
 
         # can't just add a maker test, because it expects the maker to accept only one argument
+        self.assertEquals(astypes.script_data_variable_size('variable name', [1, 2, '3']), 42)
         self.assertEquals(astypes.make_script_data_variable('variable name', [1, 2, '3']), '\x00\x0d\x76\x61\x72\x69\x61\x62\x6c\x65\x20\x6e\x61\x6d\x65\x0a\x00\x00\x00\x03\x00\x3f\xf0\x00\x00\x00\x00\x00\x00\x00\x40\x00\x00\x00\x00\x00\x00\x00\x02\x00\x01\x33')
+
+
+class TestAMF3(SerializerTester):
+
+    def check(self, value, blob, decoded=None):
+        if decoded is None:
+            decoded = value
+        self.assertEquals(astypes.make_amf3_value(value), blob)
+        self.assertEquals(astypes.decode_amf3_value(blob + 'junk'),
+                          (decoded, len(blob)))
+        self.assertEquals(astypes.decode_amf3_value(buffer('xx' + blob), 2),
+                          (decoded, len(blob) + 2))
+
+    def test_simple_values(self):
+        self.check(None, '\x01')
+        self.check(astypes.Undefined(), '\x00')
+        self.check(False, '\x02')
+        self.check(True, '\x03')
+        self.check(0, '\x04\x00')
+        self.check(127, '\x04\x7f')
+        self.check(128, '\x04\x81\x00')
+        self.check(0x3fff, '\x04\xff\x7f')
+        self.check(0x4000, '\x04\x81\x80\x00')
+        self.check(0x200000, '\x04\x80\xc0\x80\x00')
+        self.check(astypes.AMF3_MAX_INT, '\x04\xbf\xff\xff\xff')
+        self.check(-1, '\x04\xff\xff\xff\xff')
+        self.check(astypes.AMF3_MIN_INT, '\x04\xc0\x80\x80\x00')
+        # too large for an integer, sent as a double
+        self.check(0x10000000, '\x05\x41\xb0\x00\x00\x00\x00\x00\x00')
+        self.check(1.5, '\x05\x3f\xf8\x00\x00\x00\x00\x00\x00')
+        self.check('', '\x06\x01')
+        self.check(u'λ', '\x06\x05\xce\xbb', '\xce\xbb')
+        self.check(astypes.XML('<a/>'), '\x0b\x09<a/>')
+        self.check(astypes.XMLDocument('<a/>'), '\x07\x09<a/>')
+        self.check(astypes.ByteArray('\x00\xff'), '\x0c\x05\x00\xff')
+        self.check(datetime(2009, 2, 13, 23, 31, 30, 500000, astypes.utc),
+                   '\x08\x01\x42\x71\xf7\x1f\xb0\x64\x40\x00')
+
+    def test_references(self):
+        # strings have a separate table, and empty strings are not in it
+        self.check(['foo', '', 'foo', ''],
+                   '\x09\x09\x01\x06\x07foo\x06\x01\x06\x00\x06\x01')
+
+        # the outer array is the first entry in the object table
+        obj = astypes.FLVObject(a=1)
+        self.check([obj, obj], '\x09\x05\x01\x0a\x0b\x01\x03a\x04\x01\x01'
+                   '\x0a\x02')
+        decoded, _ = astypes.decode_amf3_value(
+            '\x09\x05\x01\x0a\x0b\x01\x03a\x04\x01\x01\x0a\x02')
+        self.assertTrue(decoded[0] is decoded[1])
+
+        # objects of the same class share traits
+        self.check([astypes.TypedObject('Foo', a=1),
+                    astypes.TypedObject('Foo', a=2)],
+                   '\x09\x05\x01\x0a\x0b\x07Foo\x03a\x04\x01\x01'
+                   '\x0a\x01\x02\x04\x02\x01')
+
+        # an array containing itself
+        l = []
+        l.append(l)
+        decoded, _ = astypes.decode_amf3_value(astypes.make_amf3_value(l))
+        self.assertTrue(decoded[0] is decoded)
+
+    def test_arrays_and_objects(self):
+        self.check([1, 'a'], '\x09\x05\x01\x04\x01\x06\x03a')
+        self.check(astypes.ECMAArray([('k', 1), (0, 2)]),
+                   '\x09\x03\x03k\x04\x01\x01\x04\x02')
+        self.check(astypes.TypedObject('Foo', a=None),
+                   '\x0a\x0b\x07Foo\x03a\x01\x01')
+        self.assertEquals(astypes.decode_amf3_value('\x0a\x0b\x01\x01')[0]
+                          .__class__, astypes.FLVObject)
+
+        # sealed members, then a dynamic one
+        obj, offset = astypes.decode_amf3_value(
+            '\x0a\x1b\x07Foo\x03x\x04\x05\x03y\x01\x01')
+        self.assertEquals(obj, astypes.TypedObject('Foo', [('x', 5), ('y', None)]))
+        self.assertEquals(obj.class_name, 'Foo')
+        self.assertEquals(offset, 14)
+
+        d = astypes.Dictionary({3: 'a'}, weak_keys=True)
+        self.check(d, '\x11\x03\x01\x04\x03\x06\x03a')
+        self.assertTrue(astypes.decode_amf3_value(
+                '\x11\x03\x01\x04\x03\x06\x03a')[0].weak_keys)
+
+    def test_vectors(self):
+        self.check(astypes.Vector([1, -1], constants.AMF3_VECTOR_INT, True),
+                   '\x0d\x05\x01\x00\x00\x00\x01\xff\xff\xff\xff')
+        self.check(astypes.Vector([0xffffffff], constants.AMF3_VECTOR_UINT),
+                   '\x0e\x03\x00\xff\xff\xff\xff')
+        self.check(astypes.Vector([1.5], constants.AMF3_VECTOR_DOUBLE),
+                   '\x0f\x03\x00\x3f\xf8\x00\x00\x00\x00\x00\x00')
+        self.check(astypes.Vector(['a', None], class_name='String'),
+                   '\x10\x05\x00\x0dString\x06\x03a\x01')
+
+        vector, _ = astypes.decode_amf3_value(
+            '\x0d\x05\x01\x00\x00\x00\x01\xff\xff\xff\xff')
+        self.assertEquals(vector.kind, constants.AMF3_VECTOR_INT)
+        self.assertTrue(vector.fixed)
+
+    def test_errors(self):
+        decode = astypes.decode_amf3_value
+        self.assertRaises(astypes.MalformedFLV, decode, '\x12')
+        # references to things that were not seen
+        self.assertRaises(astypes.MalformedFLV, decode, '\x06\x02')
+        self.assertRaises(astypes.MalformedFLV, decode, '\x09\x00')
+        self.assertRaises(astypes.MalformedFLV, decode, '\x0a\x01')
+        # externalizable classes can't be decoded
+        self.assertRaises(astypes.MalformedFLV, decode, '\x0a\x07\x07Foo')
+        self.assertRaises(astypes.MalformedFLV, decode,
+                          '\x11\x03\x00\x09\x01\x01\x01')
+        self.assertRaises(ValueError, astypes.make_u29, 0x20000000)
+
+        blob = astypes.make_amf3_value(
+            [astypes.TypedObject('Foo', a=[1.5, 'b']), 'b',
+             astypes.Vector([1], constants.AMF3_VECTOR_INT)])
+        for i in range(len(blob)):
+            self.assertRaises(primitives.EndOfFile, decode, blob[:i])
+
+    def test_avmplus(self):
+        value = astypes.AMF3Value({'a': [1, 'b']})
+        blob = '\x11\x09\x01\x03a\x09\x05\x01\x04\x01\x06\x03b\x01'
+        self.assertEquals(astypes.make_script_data_value(value), blob)
+        self.assertEquals(astypes.script_data_value_size(value), len(blob))
+        self.assertEquals(astypes.decode_script_data_value(blob),
+                          ({'a': [1, 'b']}, len(blob)))
+
+        f = StringIO(blob + 'junk')
+        self.assertEquals(astypes.get_script_data_value(f), {'a': [1, 'b']})
+        self.assertEquals(f.tell(), len(blob))
+
+        # longer than what gets read at once, without a bound
+        value = astypes.AMF3Value(['x' * 10000, 'y' * 20000])
+        blob = astypes.make_script_data_value(value)
+        f = StringIO(blob + 'junk' * 10000)
+        self.assertEquals(astypes.get_script_data_value(f), value.value)
+        self.assertEquals(f.tell(), len(blob))
+        f = StringIO(blob + 'junk')
+        self.assertEquals(astypes.get_script_data_value(f, len(blob)),
+                          value.value)
+        self.assertEquals(f.tell(), len(blob))
+        self.assertRaises(primitives.EndOfFile, astypes.get_script_data_value,
+                          StringIO(blob[:-1]))
@@ -0,0 +1,53 @@
+import unittest
+
+from flvlib import bitreader, primitives
+
+
+class TestBitReader(unittest.TestCase):
+
+    def test_read(self):
+        s = bitreader.BitReader('\xa5\x0f\xff')
+        self.assertEquals(s.read(1), 1)
+        self.assertEquals(s.read(2), 1)
+        self.assertEquals(s.read(5), 5)
+        self.assertEquals(s.read(4), 0)
+        self.assertEquals(s.read(12), 0xfff)
+        self.assertRaises(primitives.EndOfFile, s.read, 1)
+
+    def test_read_ue(self):
+        # 1 010 011 00100 00111 0001000, padded with ones
+        s = bitreader.BitReader('\xa6\x43\x88\x7f')
+        self.assertEquals([s.read_ue() for _ in xrange(6)],
+                          [0, 1, 2, 3, 6, 7])
+
+    def test_read_se(self):
+        # 1 010 011 00100 00101, padded with ones
+        s = bitreader.BitReader('\xa6\x42\xff')
+        self.assertEquals([s.read_se() for _ in xrange(5)],
+                          [0, 1, -1, 2, -2])
+
+    def test_truncated_ue(self):
+        s = bitreader.BitReader('\x00')
+        self.assertRaises(primitives.EndOfFile, s.read_ue)
+        s = bitreader.BitReader('\x01')
+        self.assertRaises(primitives.EndOfFile, s.read_ue)
+
+    def test_emulation_prevention(self):
+        self.assertEquals(
+            bitreader.remove_emulation_prevention('\x00\x00\x03\x01\x03'),
+            '\x00\x00\x01\x03')
+        self.assertEquals(
+            bitreader.remove_emulation_prevention('\x00\x00\x03\x00\x00\x03'),
+            '\x00\x00\x00\x00')
+
+        s = bitreader.BitReader('\x00\x00\x03\x01')
+        self.assertEquals(s.read(24), 1)
+        s = bitreader.BitReader('\x00\x00\x03\x01', emulation_prevention=False)
+        self.assertEquals(s.read(24), 3)
+
+    def test_slice_header(self):
+        # IDR slice: first_mb_in_slice 0, slice_type 7, pps 0, frame_num 5
+        s = bitreader.BitReader('\x65\x88\xa8')
+        self.assertEquals((s.read(1), s.read(2), s.read(5)), (0, 3, 5))
+        self.assertEquals((s.read_ue(), s.read_ue(), s.read_ue(), s.read(4)),
+                          (0, 7, 0, 5))
@@ -1,7 +1,14 @@
+import os
 import logging
 import unittest
+import tempfile
 from StringIO import StringIO
 
+from flvlib.constants import TAG_TYPE_AUDIO, TAG_TYPE_VIDEO
+from flvlib.primitives import make_ui8, make_ui24, make_ui32
+from flvlib.tags import FLV, ScriptTag, PAYLOAD_FLAGS
+from flvlib.tags import create_flv_tag, create_flv_header, create_script_tag
+
 class SerializerTester(unittest.TestCase):
 
     def setUp(self):
@@ -54,3 +61,83 @@ class WarningCounterFilter(object):
             self.warnings += 1
             return 0
         return 1
+
+
+# An IDR and a non-IDR slice header: first_mb_in_slice 0, slice_type 7 or 5,
+# pic_parameter_set_id 0 and a 4 bit frame_num
+IDR_SLICE_HEADER = '\x65\x88\x80'
+NON_IDR_SLICE_HEADER = '\x41\x9a\x00'
+AAC_SEQUENCE_HEADER = '\xaf\x00\x12\x10'
+
+
+def make_h264_tag(timestamp, keyframe, nalu_size):
+    if keyframe:
+        flags, header = 0x17, IDR_SLICE_HEADER
+    else:
+        flags, header = 0x27, NON_IDR_SLICE_HEADER
+    nalu = header + chr(timestamp % 256) * (nalu_size - len(header))
+    data = ''.join([make_ui8(flags), make_ui8(1), make_ui24(0),
+                    make_ui32(len(nalu)), nalu])
+    return create_flv_tag(TAG_TYPE_VIDEO, data, timestamp)
+
+
+def make_flv(seconds=10, fps=10, gop=10, start=0, metadata=None, video=True,
+             aac=False, midstream=False):
+    """
+    Write a small H.264 + MP3 FLV file to a temporary path and return the
+    path, like the one the benchmarks use but with the same contents every
+    time. The media starts at start milliseconds. With aac the audio is AAC
+    and begins with a sequence header, with midstream there's another
+    sequence header and an onCuePoint halfway through. The caller is
+    responsible for removing the file.
+    """
+    fd, path = tempfile.mkstemp(suffix='.flv')
+    f = os.fdopen(fd, 'wb')
+    f.write(create_flv_header(has_video=video))
+    if metadata is not None:
+        f.write(create_script_tag('onMetaData', metadata))
+    if aac:
+        f.write(create_flv_tag(TAG_TYPE_AUDIO, AAC_SEQUENCE_HEADER))
+    frames = seconds * fps
+    for frame in xrange(frames):
+        timestamp = start + frame * 1000 / fps
+        if video:
+            size = 50 + frame * 37 % 100
+            f.write(make_h264_tag(timestamp, frame % gop == 0, size))
+        if aac:
+            audio = '\xaf\x01' + 'a' * (frame % 7 + 10)
+        else:
+            audio = '\x2f' + 'm' * (frame % 7 + 10)
+        f.write(create_flv_tag(TAG_TYPE_AUDIO, audio, timestamp + 3))
+        if midstream and frame == frames / 2:
+            if aac:
+                f.write(create_flv_tag(TAG_TYPE_AUDIO, AAC_SEQUENCE_HEADER,
+                                       timestamp))
+            f.write(create_script_tag('onCuePoint', {'name': 'middle'},
+                                      timestamp))
+    f.close()
+    return path
+
+
+def read_file(path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def read_tags(path):
+    """Return the tags of a file, parsed up to their flags."""
+    f = open(path, 'rb')
+    try:
+        return list(FLV(f).iter_tags(PAYLOAD_FLAGS))
+    finally:
+        f.close()
+
+
+def read_metadata(path):
+    for tag in read_tags(path):
+        if isinstance(tag, ScriptTag) and tag.name == 'onMetaData':
+            return tag.variable
+    return None
@@ -0,0 +1,265 @@
+import os
+import logging
+import unittest
+import tempfile
+
+from flvlib import constants, index
+from flvlib.tags import create_script_tag
+from flvlib.scripts import cut_flv, index_flv, retimestamp_flv
+
+from test_common import make_flv, read_file, read_tags
+
+
+# (start, end) pairs for cut_file, None for open ones
+CUTS = [(None, 3000), (2500, 6000), (4000, None), (-1, 500), (9950, None)]
+
+
+class CutTestCase(unittest.TestCase):
+
+    loggers = ('flvlib.cut-flv', 'flvlib.index-flv', 'flvlib.tags')
+
+    def setUp(self):
+        self.levels = []
+        for name in self.loggers:
+            logger = logging.getLogger(name)
+            self.levels.append(logger.level)
+            logger.setLevel(logging.CRITICAL)
+        self.paths = []
+
+    def tearDown(self):
+        for name, level in zip(self.loggers, self.levels):
+            logging.getLogger(name).setLevel(level)
+        for path in self.paths:
+            for p in (path, index.sidecar_path(path)):
+                if os.path.exists(p):
+                    os.remove(p)
+
+    def temp_path(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.paths.append(path)
+        return path
+
+    def flv(self, indexed=False, **kwargs):
+        path = make_flv(**kwargs)
+        self.paths.append(path)
+        if indexed:
+            self.assertTrue(index_flv.index_file(path))
+        return path
+
+    def scanned(self, path, start, end):
+        # what cutting with a full scan of the file gives
+        f = open(path, 'rb')
+        try:
+            flv = cut_flv.CuttingFLV(f)
+            times = [cut_flv.normalize_times(start, end)]
+            cut = cut_flv.find_cuts_by_scanning(flv, path, times)[0]
+            first_media_tag_offset = flv.first_media_tag_offset
+        finally:
+            f.close()
+        if cut is None:
+            return None
+        data = read_file(path)
+        start_offset, end_offset = cut
+        return (data[:first_media_tag_offset] +
+                data[start_offset:end_offset or len(data)])
+
+    def cut(self, path, start, end, **kwargs):
+        out = self.temp_path()
+        if not cut_flv.cut_file(path, out, start, end, **kwargs):
+            return None
+        return read_file(out)
+
+    def found_with_index(self, path, start, end):
+        # the offsets find_cut_with_index gives, or None if it gives up
+        f = open(path, 'rb')
+        try:
+            flv = cut_flv.CuttingFLV(f)
+            table = cut_flv.read_cut_table(flv, path)
+            if table is None:
+                return None
+            start, end = cut_flv.normalize_times(start, end)
+            return cut_flv.find_cut_with_index(flv, table, start, end)
+        finally:
+            f.close()
+
+
+class TestCutWithIndex(CutTestCase):
+
+    def check_cuts(self, path, with_index=True, base=0):
+        for start, end in CUTS:
+            start = start is not None and start + base or start
+            end = end is not None and end + base or end
+            expected = self.scanned(path, start, end)
+            self.assertEquals(self.cut(path, start, end), expected)
+            if with_index and expected is not None:
+                self.assertFalse(self.found_with_index(path, start, end)
+                                 is None)
+
+    def test_metadata_table(self):
+        self.check_cuts(self.flv(indexed=True))
+        self.check_cuts(self.flv(indexed=True, gop=7, start=20000),
+                        base=20000)
+        self.check_cuts(self.flv(indexed=True, video=False))
+
+    def test_sidecar_table(self):
+        for kwargs in ({}, {'gop': 7, 'start': 20000}, {'video': False}):
+            path = self.flv(**kwargs)
+            index.write_sidecar(path)
+            self.check_cuts(path, base=kwargs.get('start', 0))
+
+    def test_stale_table(self):
+        path = self.flv(indexed=True)
+        data = read_file(path)
+        tag_list = read_tags(path)
+        metadata = tag_list[0].variable
+        times = metadata['keyframes'].times
+        positions = metadata['keyframes'].filepositions
+
+        # a table with the wrong timestamps and one with the wrong offsets,
+        # the metadata stays the same size
+        for stale_times, stale_positions in (
+                ([t + 0.5 for t in times], positions),
+                (times, [p + 40 for p in positions])):
+            metadata['keyframes'].times = stale_times
+            metadata['keyframes'].filepositions = stale_positions
+            stale = self.temp_path()
+            f = open(stale, 'wb')
+            f.write(data[:tag_list[0].offset] +
+                    create_script_tag('onMetaData', metadata) +
+                    data[tag_list[1].offset:])
+            f.close()
+            self.assertEquals(os.path.getsize(stale), len(data))
+
+            self.assertTrue(self.found_with_index(stale, 2500, 6000) is None)
+            self.check_cuts(stale, with_index=False)
+
+
+class TestCutRanges(CutTestCase):
+
+    def check_ranges(self, path):
+        # the ranges get cut in one go, but each the same as on its own
+        ranges = [(start, end, self.temp_path()) for start, end in CUTS
+                  if self.cut(path, start, end) is not None]
+        self.assertTrue(len(ranges) > 3)
+        self.assertTrue(cut_flv.cut_file_ranges(path, ranges))
+        for start, end, outpath in ranges:
+            self.assertEquals(read_file(outpath), self.cut(path, start, end))
+
+    def test_with_index(self):
+        self.check_ranges(self.flv(indexed=True))
+        self.check_ranges(self.flv(indexed=True, video=False))
+
+    def test_with_scan(self):
+        self.check_ranges(self.flv())
+        self.check_ranges(self.flv(video=False))
+
+    def test_failed_cuts(self):
+        for path in (self.flv(indexed=True), self.flv()):
+            good, empty, late = [self.temp_path() for i in range(3)]
+            # there's no keyframe between 3000 and 3500, nor after 9950
+            ranges = [(2500, 6000, good), (3000, 3500, empty),
+                      (9950, None, late)]
+            self.assertFalse(cut_flv.cut_file_ranges(path, ranges))
+            self.assertEquals(read_file(good), self.cut(path, 2500, 6000))
+            self.assertEquals(read_file(empty), '')
+            self.assertEquals(read_file(late), '')
+
+    def write_ranges(self, text):
+        path = self.temp_path()
+        f = open(path, 'w')
+        f.write(text)
+        f.close()
+        return path
+
+    def test_read_ranges(self):
+        path = self.write_ranges("# start end outpath\n"
+                                 "\n"
+                                 "0 1000 first.flv\n"
+                                 "  - 2000 with spaces.flv\n"
+                                 "3000 - last.flv\n"
+                                 "3000 3000 empty.flv\n")
+        self.assertEquals(cut_flv.read_ranges(path),
+                          [(0, 1000, 'first.flv'),
+                           (None, 2000, 'with spaces.flv'),
+                           (3000, None, 'last.flv'),
+                           (3000, 3000, 'empty.flv')])
+
+        for text, message in (("0 1000 a.flv\n1000 a.flv\n", "Line 2 "),
+                              ("\n1000 abc a.flv\n", "Line 2 "),
+                              ("1.5 2 a.flv\n", "Line 1 "),
+                              ("0 1000 a.flv\n5000 2000 a.flv\n", "Line 2 ")):
+            path = self.write_ranges(text)
+            try:
+                cut_flv.read_ranges(path)
+            except ValueError, e:
+                self.assertTrue(str(e).startswith(message))
+            else:
+                self.fail("%r was read" % text)
+
+
+class TestCutMetadata(CutTestCase):
+
+    def check_clip(self, path, start, end):
+        out = self.temp_path()
+        self.assertTrue(cut_flv.cut_file(path, out, start, end,
+                                         update_metadata=True))
+        tag_list = read_tags(out)
+        metadata = tag_list[0].variable
+        self.assertEquals(tag_list[0].name, 'onMetaData')
+        self.assertEquals(metadata['filesize'], os.path.getsize(out))
+        self.assertFalse('onMetaData' in [getattr(tag, 'name', None)
+                                          for tag in tag_list[1:]])
+
+        media = [tag for tag in tag_list
+                 if retimestamp_flv.is_nonheader_media(tag)]
+        self.assertEquals(media[0].timestamp, 0)
+        self.assertEquals(metadata['duration'],
+                          max([tag.timestamp for tag in tag_list]) / 1000.0)
+
+        by_offset = dict([(tag.offset, tag) for tag in tag_list])
+        keyframes = metadata['keyframes']
+        self.assertTrue(keyframes.filepositions)
+        for time, position in zip(keyframes.times, keyframes.filepositions):
+            tag = by_offset[int(position)]
+            self.assertEquals(tag.timestamp, int(round(time * 1000)))
+            if isinstance(tag, cut_flv.VideoTag):
+                self.assertEquals(tag.frame_type,
+                                  constants.FRAME_TYPE_KEYFRAME)
+
+        # the same tags and timestamps as retimestamping the plain cut
+        plain, retimestamped = self.temp_path(), self.temp_path()
+        self.assertTrue(cut_flv.cut_file(path, plain, start, end))
+        self.assertTrue(retimestamp_flv.retimestamp_file(plain,
+                                                         retimestamped))
+        expected = [(tag.type, tag.timestamp, tag.size)
+                    for tag in read_tags(retimestamped)
+                    if getattr(tag, 'name', None) != 'onMetaData']
+        self.assertEquals([(tag.type, tag.timestamp, tag.size)
+                           for tag in tag_list[1:]], expected)
+
+    def test_update_metadata(self):
+        for kwargs in ({}, {'start': 20000, 'gop': 7}, {'video': False},
+                       {'aac': True, 'midstream': True}):
+            path = self.flv(indexed=True, **kwargs)
+            # what gstreamer's flvmux leaves at the end
+            f = open(path, 'ab')
+            f.write(create_script_tag('onMetaData', {'duration': 99.0}))
+            f.close()
+
+            base = kwargs.get('start', 0)
+            for start, end in ((2500, 6000), (None, 4000), (4000, None)):
+                start = start is not None and start + base or start
+                end = end is not None and end + base or end
+                self.check_clip(path, start, end)
+
+    def test_many_clips(self):
+        path = self.flv(indexed=True, aac=True, midstream=True)
+        ranges = [(start, end, self.temp_path())
+                  for start, end in ((2500, 6000), (4000, None), (None, 4000))]
+        self.assertTrue(cut_flv.cut_file_ranges(path, ranges,
+                                                update_metadata=True))
+        for start, end, outpath in ranges:
+            out = self.temp_path()
+            cut_flv.cut_file(path, out, start, end, update_metadata=True)
+            self.assertEquals(read_file(outpath), read_file(out))
@@ -1,8 +1,12 @@
 import unittest
 import test_primitives, test_astypes, test_helpers, test_tags
+import test_bitreader, test_index, test_streams, test_index_flv
+import test_cut_flv, test_retimestamp_flv
 
 def get_suite():
-    modules = (test_primitives, test_astypes, test_helpers, test_tags)
+    modules = (test_primitives, test_astypes, test_helpers, test_tags,
+               test_bitreader, test_index, test_streams, test_index_flv,
+               test_cut_flv, test_retimestamp_flv)
     suites = [unittest.TestLoader().loadTestsFromModule(module) for
               module in modules]
     return unittest.TestSuite(suites)
@@ -2,8 +2,12 @@
 
 import unittest
 
+import os
+import imp
 import sys
+import time
 import datetime
+import tempfile
 from StringIO import StringIO
 
 from flvlib import helpers
@@ -304,3 +308,166 @@ class TestASPrettyPrinter(unittest.TestCase):
          5]]},
  (10, 11)]"""
         self.assertEquals(self.pp.pformat(l), expected.lstrip('\n'))
+
+
+class TestMappedFile(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, 'abcdefghij')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read_seek(self):
+        f = open(self.path, 'rb')
+        m = helpers.MappedFile(f)
+        self.assertEquals(m.read(3), 'abc')
+        self.assertEquals(m.tell(), 3)
+        m.seek(2, os.SEEK_CUR)
+        self.assertEquals(m.read(2), 'fg')
+        m.seek(-2, os.SEEK_END)
+        self.assertEquals(m.read(), 'ij')
+        self.assertEquals(m.read(5), '')
+        m.seek(20)
+        self.assertEquals(m.read(1), '')
+        self.assertRaises(IOError, m.seek, -1)
+        m.close()
+        f.close()
+
+    def test_read_view(self):
+        f = open(self.path, 'rb')
+        m = helpers.MappedFile(f)
+        m.seek(1)
+        view = m.read_view(4)
+        self.assertTrue(isinstance(view, buffer))
+        self.assertEquals(str(view), 'bcde')
+        self.assertEquals(m.tell(), 5)
+        self.assertEquals(str(m.read_view(10)), 'fghij')
+        self.assertEquals(str(m.read_view(10)), '')
+        m.close()
+        f.close()
+
+    def test_empty_file(self):
+        f = open(self.path, 'wb+')
+        m = helpers.MappedFile(f)
+        self.assertEquals(m.read(4), '')
+        self.assertEquals(str(m.read_view(4)), '')
+        m.close()
+        f.close()
+
+
+class TestCopyRange(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        self.data = ''.join([chr(i % 251) for i in range(300000)])
+        os.write(fd, self.data)
+        os.close(fd)
+        fd, self.outpath = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+        os.remove(self.outpath)
+
+    def copy(self, offset, count):
+        fi = open(self.path, 'rb')
+        fo = open(self.outpath, 'wb')
+        fo.write('head')
+        copied = helpers.copy_range(fi, fo, offset, count)
+        fo.write('tail')
+        self.assertEquals(fi.tell(), offset + copied)
+        fi.close()
+        fo.close()
+        return copied, open(self.outpath, 'rb').read()
+
+    def check_copies(self):
+        self.assertEquals(self.copy(10, 1000),
+                          (1000, 'head' + self.data[10:1010] + 'tail'))
+        self.assertEquals(self.copy(100, None),
+                          (299900, 'head' + self.data[100:] + 'tail'))
+        self.assertEquals(self.copy(299990, 100),
+                          (10, 'head' + self.data[299990:] + 'tail'))
+        self.assertEquals(self.copy(400000, 100), (0, 'headtail'))
+        self.assertEquals(self.copy(5, 0), (0, 'headtail'))
+
+    def test_copy_range(self):
+        self.check_copies()
+
+    def test_fallbacks(self):
+        old = helpers._copy_file_range, helpers._sendfile
+        try:
+            helpers._copy_file_range = None
+            self.check_copies()
+            helpers._sendfile = None
+            self.check_copies()
+        finally:
+            helpers._copy_file_range, helpers._sendfile = old
+
+    def test_file_like_objects(self):
+        out = StringIO()
+        copied = helpers.copy_range(StringIO(self.data), out, 7, 2000000)
+        self.assertEquals(copied, len(self.data) - 7)
+        self.assertEquals(out.getvalue(), self.data[7:])
+
+    def test_without_c_ssize_t(self):
+        # the ctypes of Python 2.6 doesn't have it
+        try:
+            import ctypes
+        except ImportError:
+            return
+        c_ssize_t = getattr(ctypes, 'c_ssize_t', None)
+        if c_ssize_t is not None:
+            del ctypes.c_ssize_t
+        try:
+            path = os.path.splitext(helpers.__file__)[0] + '.py'
+            module = imp.load_source('flvlib_helpers_copy', path)
+        finally:
+            if c_ssize_t is not None:
+                ctypes.c_ssize_t = c_ssize_t
+            sys.modules.pop('flvlib_helpers_copy', None)
+        out = StringIO()
+        self.assertEquals(module.copy_range(open(self.path, 'rb'), out, 7,
+                                            100), 100)
+        self.assertEquals(out.getvalue(), self.data[7:107])
+
+
+class TestOffsetStringIO(unittest.TestCase):
+
+    def test_offsets(self):
+        s = helpers.OffsetStringIO('abcdef', 100)
+        self.assertEquals(s.tell(), 100)
+        self.assertEquals(s.read(2), 'ab')
+        self.assertEquals(s.tell(), 102)
+        s.seek(104)
+        self.assertEquals(s.read(1), 'e')
+        s.seek(-3, os.SEEK_CUR)
+        self.assertEquals(s.read(), 'cdef')
+        s.seek(-1, os.SEEK_END)
+        self.assertEquals(s.tell(), 105)
+
+
+class TestFileWatcher(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_wait(self):
+        for path in (self.path, None):
+            watcher = helpers.FileWatcher(path, poll_interval=0.01)
+            f = open(self.path, 'ab')
+            f.write('abc')
+            f.close()
+            # returns on the change or after the poll interval at the latest
+            start = time.time()
+            watcher.wait()
+            watcher.wait(0)
+            self.assertTrue(time.time() - start < 1)
+            watcher.close()
+            watcher.close()
@@ -0,0 +1,226 @@
+import os
+import unittest
+import tempfile
+
+from StringIO import StringIO
+
+from flvlib import constants, index, tags
+
+
+def with_offset_typecodes(check):
+    # run check with the offset column as it is here, and as doubles like
+    # where a C long is 32 bits
+    columns = index.INDEX_COLUMNS
+    try:
+        for typecode in (index.OFFSET_TYPECODE, 'd'):
+            index.INDEX_COLUMNS = ((('offset', typecode, '<i8'),) +
+                                   columns[1:])
+            check()
+    finally:
+        index.INDEX_COLUMNS = columns
+
+
+class TestBuildIndex(unittest.TestCase):
+
+    # tag header with DataSize of 10 and timestamp of 9823
+    tag_header = '\x00\x00\x0a\x00\x26\x5f\x00\x00\x00\x00'
+    tag_footer = '\x00\x00\x00\x15'
+
+    def tag(self, tag_type, content):
+        return (chr(tag_type) + self.tag_header + content +
+                '\x00' * (10 - len(content)) + self.tag_footer)
+
+    def flv(self):
+        return tags.FLV(StringIO(
+                'FLV\x00\x05\x00\x00\x00\x09\x00\x00\x00\x00' +
+                self.tag(constants.TAG_TYPE_AUDIO, '\xaf\x01') +
+                self.tag(constants.TAG_TYPE_VIDEO, '\x17\x00') +
+                self.tag(constants.TAG_TYPE_VIDEO, '\x27\x01') +
+                self.tag(constants.TAG_TYPE_AUDIO, '\x2f') +
+                self.tag(constants.TAG_TYPE_SCRIPT, '\x02')))
+
+    def check_index(self, idx):
+        self.assertEquals(list(idx['offset']), [13, 38, 63, 88, 113])
+        self.assertEquals(list(idx['timestamp']), [9823] * 5)
+        self.assertEquals(list(idx['size']), [10] * 5)
+        self.assertEquals(list(idx['type']), [8, 9, 9, 8, 18])
+        self.assertEquals(list(idx['frame_type']), [-1, 1, 2, -1, -1])
+        self.assertEquals(list(idx['codec_id']), [10, 7, 7, 2, -1])
+        self.assertEquals(list(idx['packet_type']), [1, 0, 1, -1, -1])
+
+    def test_array_index(self):
+        idx = self.flv().build_index(use_numpy=False)
+        self.assertTrue(isinstance(idx, dict))
+        self.check_index(idx)
+
+    def test_numpy_index(self):
+        if index.numpy is None:
+            return
+        idx = self.flv().build_index()
+        self.assertTrue(isinstance(idx, index.numpy.ndarray))
+        self.assertEquals(idx.dtype.names,
+                          tuple([name for name, _, _ in index.INDEX_COLUMNS]))
+        self.check_index(idx)
+
+    def test_large_offsets(self):
+        row = (5 << 32, 9823, 10, 8, -1, 2, -1)
+
+        def check():
+            self.check_index(self.flv().build_index(use_numpy=False))
+            idx = index.make_index(index.collect_columns([row]), False)
+            self.assertEquals(idx['offset'][0], 5 << 32)
+            if index.numpy is not None:
+                self.check_index(self.flv().build_index())
+                idx = index.make_index(index.collect_columns([row]))
+                self.assertEquals(idx['offset'][0], 5 << 32)
+        with_offset_typecodes(check)
+
+    def test_errors(self):
+        s = StringIO('FLV\x00\x05\x00\x00\x00\x09\x00\x00\x00\x00' +
+                     self.tag(constants.TAG_TYPE_AUDIO, '\x2f')[:-2])
+        self.assertRaises(index.EndOfFile, tags.FLV(s).build_index)
+
+        s = StringIO('FLV\x00\x05\x00\x00\x00\x09\x00\x00\x00\x00' +
+                     self.tag(0x01, '\x2f'))
+        self.assertRaises(index.MalformedFLV, tags.FLV(s).build_index)
+
+
+class TestParallelIndex(unittest.TestCase):
+
+    def setUp(self):
+        # the video payload contains two things that look like tags, to
+        # trip up resynchronisation
+        fake = (tags.create_flv_tag(constants.TAG_TYPE_AUDIO, '\x2f' * 5) +
+                tags.create_flv_tag(constants.TAG_TYPE_VIDEO, '\x17' * 5))
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, tags.create_flv_header() +
+                 tags.create_flv_tag(constants.TAG_TYPE_AUDIO, '\x2f' * 20) +
+                 tags.create_flv_tag(constants.TAG_TYPE_VIDEO,
+                                     '\x12' + 'x' * 10 + fake + 'y' * 10, 40) +
+                 ''.join([tags.create_flv_tag(constants.TAG_TYPE_AUDIO,
+                                              '\x2f' * i, 40 + i)
+                          for i in range(1, 20)]))
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def serial_index(self):
+        f = open(self.path, 'rb')
+        try:
+            return tags.FLV(f).build_index(use_numpy=False)
+        finally:
+            f.close()
+
+    def test_resync(self):
+        f = open(self.path, 'rb')
+        data = f.read()
+        f.close()
+        offsets = list(self.serial_index()['offset'])
+        found = [offset for offset in range(13, len(data))
+                 if index.is_tag_boundary(data, offset, 13)]
+        # the real tags and the second fake one
+        self.assertEquals(len(found), len(offsets) + 1)
+        self.assertEquals(index.find_tag_boundary(data, 14, 100, 13), 48)
+        self.assertEquals(index.find_tag_boundary(data, 49, 100, 13), 90)
+        self.assertEquals(index.find_tag_boundary(data, 49, 90, 13), None)
+
+    def test_parallel_index(self):
+        serial = self.serial_index()
+        for shard_size in range(1, 120):
+            idx = index.build_index_parallel(self.path, processes=1,
+                                             use_numpy=False,
+                                             shard_size=shard_size)
+            self.assertEquals(idx, serial)
+
+        idx = index.build_index_parallel(self.path, processes=2,
+                                         use_numpy=False, shard_size=50)
+        self.assertEquals(idx, serial)
+        if index.numpy is not None:
+            idx = index.build_index_parallel(self.path, processes=2,
+                                             shard_size=50)
+            self.assertEquals(list(idx['offset']), list(serial['offset']))
+
+    def test_double_offsets(self):
+        offsets = list(self.serial_index()['offset'])
+
+        def check():
+            for shard_size in (1, 30, 50, 1000):
+                idx = index.build_index_parallel(self.path, processes=1,
+                                                 use_numpy=False,
+                                                 shard_size=shard_size)
+                self.assertEquals(list(idx['offset']), offsets)
+        with_offset_typecodes(check)
+
+
+class TestSidecar(unittest.TestCase):
+
+    def tag(self, tag_type, timestamp, content):
+        return tags.create_flv_tag(tag_type, content + '\x00' * 8, timestamp)
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, tags.create_flv_header() +
+                 self.tag(constants.TAG_TYPE_VIDEO, 0, '\x17\x00') +
+                 self.tag(constants.TAG_TYPE_VIDEO, 0, '\x17\x01') +
+                 self.tag(constants.TAG_TYPE_AUDIO, 10, '\x2f') +
+                 self.tag(constants.TAG_TYPE_VIDEO, 40, '\x27\x01') +
+                 self.tag(constants.TAG_TYPE_VIDEO, 2000, '\x17\x01') +
+                 self.tag(constants.TAG_TYPE_VIDEO, 4000, '\x17\x01'))
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+        if os.path.exists(index.sidecar_path(self.path)):
+            os.remove(index.sidecar_path(self.path))
+
+    def test_roundtrip(self):
+        self.assertTrue(index.read_sidecar(self.path) is None)
+
+        written = index.write_sidecar(self.path)
+        self.assertEquals(list(written.keyframe_timestamps), [0, 2000, 4000])
+        self.assertEquals(list(written.keyframe_offsets), [38, 112, 137])
+
+        keyframes = index.read_sidecar(self.path)
+        self.assertEquals(list(keyframes.keyframe_timestamps),
+                          [0, 2000, 4000])
+        self.assertEquals(list(keyframes.keyframe_offsets), [38, 112, 137])
+        self.assertTrue(keyframes.tag_offsets is None)
+
+        keyframes = index.read_sidecar(self.path, with_tags=True)
+        self.assertEquals(list(keyframes.tag_timestamps),
+                          [0, 0, 10, 40, 2000, 4000])
+        self.assertEquals(list(keyframes.tag_offsets),
+                          [13, 38, 63, 87, 112, 137])
+
+    def test_keyframe_lookup(self):
+        keyframes = index.get_keyframe_index(self.path)
+        self.assertEquals(keyframes.keyframe_at(1999), (0, 38))
+        self.assertEquals(keyframes.keyframe_at(2000), (2000, 112))
+        self.assertEquals(keyframes.keyframe_at(10000), (4000, 137))
+        self.assertTrue(keyframes.keyframe_at(-1) is None)
+        self.assertEquals(keyframes.keyframe_after(1), (2000, 112))
+        self.assertTrue(keyframes.keyframe_after(4001) is None)
+
+    def test_stale_sidecar(self):
+        index.write_sidecar(self.path)
+        f = open(self.path, 'ab')
+        f.write(self.tag(constants.TAG_TYPE_VIDEO, 6000, '\x17\x01'))
+        f.close()
+        self.assertTrue(index.read_sidecar(self.path) is None)
+
+        keyframes = index.get_keyframe_index(self.path)
+        self.assertEquals(keyframes.keyframe_at(10000), (6000, 162))
+        self.assertFalse(index.read_sidecar(self.path) is None)
+
+    def test_damaged_sidecar(self):
+        index.write_sidecar(self.path)
+        f = open(index.sidecar_path(self.path), 'r+b')
+        f.truncate(index.SIDECAR_HEADER.size + 4)
+        f.close()
+        self.assertTrue(index.read_sidecar(self.path) is None)
+
+        f = open(index.sidecar_path(self.path), 'wb')
+        f.write('garbage' * 10)
+        f.close()
+        self.assertTrue(index.read_sidecar(self.path) is None)
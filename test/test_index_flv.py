@@ -0,0 +1,126 @@
+import os
+import logging
+import unittest
+import tempfile
+
+from flvlib import constants
+from flvlib.scripts import index_flv, retimestamp_flv
+
+from test_common import make_flv, read_file, read_tags, read_metadata
+
+
+class TestIndexFile(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger('flvlib.index-flv')
+        self.level = logger.level
+        logger.setLevel(logging.CRITICAL)
+        self.paths = []
+
+    def tearDown(self):
+        logging.getLogger('flvlib.index-flv').setLevel(self.level)
+        for path in self.paths:
+            os.remove(path)
+
+    def flv(self, **kwargs):
+        path = make_flv(**kwargs)
+        self.paths.append(path)
+        return path
+
+    def temp_path(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.paths.append(path)
+        return path
+
+    def media(self, path):
+        # everything after the metadata tag
+        tag_list = read_tags(path)
+        return read_file(path)[tag_list[1].offset:]
+
+    def check_keyframes(self, path):
+        metadata = read_metadata(path)
+        by_offset = dict([(tag.offset, tag) for tag in read_tags(path)])
+        keyframes = metadata['keyframes']
+        self.assertTrue(keyframes.filepositions)
+        for time, position in zip(keyframes.times, keyframes.filepositions):
+            tag = by_offset[int(position)]
+            self.assertEquals(tag.frame_type, constants.FRAME_TYPE_KEYFRAME)
+            self.assertEquals(tag.timestamp, int(round(time * 1000)))
+        return metadata
+
+    def test_fits_in_place(self):
+        path = self.flv(metadata={'duration': 10.0,
+                                  index_flv.METADATA_PADDING_KEY: ' ' * 300})
+        size, media = os.path.getsize(path), self.media(path)
+
+        # the keyframe table takes some of the padding
+        self.assertTrue(index_flv.index_file(path))
+        self.assertEquals(os.path.getsize(path), size)
+        self.assertEquals(self.media(path), media)
+        metadata = self.check_keyframes(path)
+        self.assertEquals(len(metadata['keyframes'].times), 10)
+        padding = metadata[index_flv.METADATA_PADDING_KEY]
+        self.assertTrue(0 < len(padding) < 300)
+
+    def test_does_not_fit(self):
+        path = self.flv(metadata={'duration': 10.0})
+        size, media = os.path.getsize(path), self.media(path)
+        self.assertTrue(index_flv.index_file(path))
+        self.assertTrue(os.path.getsize(path) > size)
+        self.assertEquals(self.media(path), media)
+        metadata = self.check_keyframes(path)
+        self.assertFalse(index_flv.METADATA_PADDING_KEY in metadata)
+
+    def test_no_padding_unless_asked(self):
+        # an out of date keyframe table, bigger than the right one
+        stale = {'times': [0.0] * 50, 'filepositions': [0.0] * 50}
+        path = self.flv(metadata={'duration': 10.0, 'keyframes': stale})
+        self.assertTrue(index_flv.index_file(path))
+        metadata = self.check_keyframes(path)
+        self.assertFalse(index_flv.METADATA_PADDING_KEY in metadata)
+        self.assertEquals(len(metadata['keyframes'].times), 10)
+
+        # without anything to change, the file stays as it is
+        indexed = read_file(path)
+        self.assertTrue(index_flv.index_file(path))
+        self.assertEquals(read_file(path), indexed)
+
+    def test_repeated_padding(self):
+        path = self.flv(metadata={'duration': 10.0})
+        self.assertTrue(index_flv.index_file(path, padding=100))
+        indexed = read_file(path)
+        media = self.media(path)
+        for i in range(3):
+            self.assertTrue(index_flv.index_file(path, padding=100))
+            self.assertEquals(read_file(path), indexed)
+            self.assertEquals(self.media(path), media)
+        metadata = self.check_keyframes(path)
+        self.assertEquals(metadata[index_flv.METADATA_PADDING_KEY],
+                          ' ' * 100)
+
+    def test_retimestamp_as_separate_passes(self):
+        for kwargs in ({}, {'start': 5000}, {'start': 3000, 'video': False},
+                       {'start': 20000000, 'aac': True, 'midstream': True}):
+            path = self.flv(metadata={'duration': 10.0}, **kwargs)
+            retimestamped, expected = self.temp_path(), self.temp_path()
+            self.assertTrue(retimestamp_flv.retimestamp_file_atomically(
+                    path, retimestamped))
+            self.assertTrue(index_flv.index_file(retimestamped, expected))
+            expected = read_file(expected)
+
+            out = self.temp_path()
+            chunk_size = retimestamp_flv.COPY_CHUNK_SIZE
+            try:
+                # including timestamps split between two chunks
+                for retimestamp_flv.COPY_CHUNK_SIZE in (chunk_size, 1, 7,
+                                                        100):
+                    self.assertTrue(index_flv.index_file(path, out,
+                                                         retimestamp=True))
+                    self.assertEquals(read_file(out), expected)
+            finally:
+                retimestamp_flv.COPY_CHUNK_SIZE = chunk_size
+
+            self.assertTrue(index_flv.retimestamp_and_index_file(
+                    path, retimestamp='atomic'))
+            self.assertEquals(read_file(path), expected)
@@ -0,0 +1,95 @@
+import os
+import shutil
+import logging
+import unittest
+import tempfile
+
+from flvlib.scripts import retimestamp_flv
+
+from test_common import make_flv, read_file, read_tags
+
+
+class TestRetimestampFile(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger('flvlib.retimestamp-flv')
+        self.level = logger.level
+        logger.setLevel(logging.CRITICAL)
+        self.paths = []
+
+    def tearDown(self):
+        logging.getLogger('flvlib.retimestamp-flv').setLevel(self.level)
+        for path in self.paths:
+            os.remove(path)
+
+    def temp_path(self, data=None):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.paths.append(path)
+        if data is not None:
+            f = open(path, 'wb')
+            f.write(data)
+            f.close()
+        return path
+
+    def flv(self, **kwargs):
+        path = make_flv(**kwargs)
+        self.paths.append(path)
+        return path
+
+    def retimestamp(self, path, chunk_sizes):
+        # retimestamp path into a new file with each of the chunk sizes,
+        # return the results
+        results = []
+        chunk_size = retimestamp_flv.COPY_CHUNK_SIZE
+        try:
+            for retimestamp_flv.COPY_CHUNK_SIZE in chunk_sizes:
+                out = self.temp_path()
+                if retimestamp_flv.retimestamp_file_atomically(path, out):
+                    results.append(read_file(out))
+                else:
+                    results.append(None)
+        finally:
+            retimestamp_flv.COPY_CHUNK_SIZE = chunk_size
+        return results
+
+    def test_same_as_inplace(self):
+        # from one byte at a time, through splitting every tag header, to
+        # the whole file in one chunk
+        chunk_sizes = range(1, 40) + [100, 1000,
+                                      retimestamp_flv.COPY_CHUNK_SIZE]
+        for kwargs in ({}, {'start': 5000, 'metadata': {'duration': 10.0}},
+                       {'start': 3000, 'video': False},
+                       {'start': 20000000, 'aac': True, 'midstream': True}):
+            path = self.flv(**kwargs)
+            expected = self.temp_path(read_file(path))
+            self.assertTrue(retimestamp_flv.retimestamp_file_inplace(expected))
+            expected = read_file(expected)
+            if kwargs.get('start'):
+                self.assertNotEquals(expected, read_file(path))
+
+            for result in self.retimestamp(path, chunk_sizes):
+                self.assertEquals(result, expected)
+
+            self.assertTrue(retimestamp_flv.retimestamp_file(path))
+            self.assertEquals(read_file(path), expected)
+
+    def test_truncated(self):
+        path = self.flv(start=5000, aac=True, midstream=True)
+        data = read_file(path)
+        tag_list = read_tags(path)
+        first_media = [tag for tag in tag_list
+                       if retimestamp_flv.is_nonheader_media(tag)][0]
+
+        # in the last payload, in the last tag header and before the
+        # offset is known
+        for truncated in (data[:-10], data[:tag_list[-1].offset + 6],
+                          data[:first_media.offset + 5]):
+            truncated = self.temp_path(truncated)
+            for result in self.retimestamp(truncated, (1, 7, 100, 1 << 20)):
+                self.assertTrue(result is None)
+
+            # overwriting leaves the original alone
+            before = read_file(truncated)
+            self.assertFalse(retimestamp_flv.retimestamp_file(truncated))
+            self.assertEquals(read_file(truncated), before)
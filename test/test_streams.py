@@ -0,0 +1,74 @@
+import socket
+import asyncore
+import unittest
+
+from flvlib import constants, tags, streams
+
+
+class CollectingDispatcher(streams.FLVDispatcher):
+
+    def __init__(self, sock, map, **kwargs):
+        streams.FLVDispatcher.__init__(self, sock, map, **kwargs)
+        self.tags = []
+        self.ended = False
+        self.error = None
+
+    def handle_tag(self, tag):
+        self.tags.append(tag)
+
+    def handle_stream_end(self, error):
+        self.ended = True
+        self.error = error
+
+
+class TestFLVDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+
+    def tearDown(self):
+        asyncore.close_all(self.map)
+
+    def stream(self):
+        return (tags.create_flv_header() +
+                tags.create_flv_tag(constants.TAG_TYPE_AUDIO, '\x2f' * 100) +
+                tags.create_flv_tag(constants.TAG_TYPE_VIDEO, '\x12' * 50,
+                                    timestamp=40))
+
+    def run_streams(self, count, data, split):
+        dispatchers = []
+        senders = []
+        for i in range(count):
+            sender, receiver = socket.socketpair()
+            senders.append(sender)
+            dispatchers.append(CollectingDispatcher(receiver, self.map))
+        for start in range(0, len(data), split):
+            for sender in senders:
+                sender.sendall(data[start:start + split])
+            asyncore.loop(timeout=0.01, map=self.map, count=2)
+        for sender in senders:
+            sender.close()
+        asyncore.loop(timeout=0.01, map=self.map, count=5)
+        return dispatchers
+
+    def test_streams(self):
+        for dispatcher in self.run_streams(10, self.stream(), 7):
+            self.assertTrue(dispatcher.ended)
+            self.assertTrue(dispatcher.error is None)
+            self.assertEquals([tag.timestamp for tag in dispatcher.tags],
+                              [0, 40])
+            self.assertTrue(isinstance(dispatcher.tags[0], tags.AudioTag))
+            self.assertTrue(isinstance(dispatcher.tags[1], tags.VideoTag))
+        self.assertEquals(self.map, {})
+
+    def test_truncated_stream(self):
+        dispatcher, = self.run_streams(1, self.stream()[:-3], 50)
+        self.assertTrue(dispatcher.ended)
+        self.assertTrue(isinstance(dispatcher.error, streams.EndOfFile))
+        self.assertEquals(len(dispatcher.tags), 1)
+
+    def test_malformed_stream(self):
+        dispatcher, = self.run_streams(1, 'FLX' + self.stream()[3:], 1000)
+        self.assertTrue(dispatcher.ended)
+        self.assertTrue(isinstance(dispatcher.error, streams.MalformedFLV))
+        self.assertEquals(dispatcher.tags, [])
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
 
 import logging
+import tempfile
 import test_common
 from StringIO import StringIO
 
-from flvlib import constants, primitives, astypes, tags
+from flvlib import constants, primitives, astypes, tags, helpers
 
 
 class LStringIO(StringIO):
@@ -302,6 +304,22 @@ class TestScriptTag(TestUnderStrictParsing):
         self.assertEquals(t.name, 'onMetaData')
         self.assertEquals(t.variable, {'duration': 1.0})
 
+    def test_lazy_variable(self):
+        s = StringIO('\x00\x00\x28\x00\x26\x5f\x00\x00\x00\x00' +
+                     '\x02\x00\x0aonMetaData\x08\x00\x00\x00\x01' +
+                     '\x00\x08duration\x00\x3f\xf0\x00\x00\x00\x00\x00\x00' +
+                     '\x00\x00\x09\x00\x00\x00\x33')
+        t = tags.ScriptTag(None, s)
+        t.parse()
+        self.assertTrue(t._variable is tags.UNDECODED)
+
+        variable = t.variable
+        self.assertEquals(variable, {'duration': 1.0})
+        self.assertTrue(t.variable is variable)
+
+        t.variable = {'duration': 2.0}
+        self.assertEquals(t.variable, {'duration': 2.0})
+
     def test_errors(self):
         # name is not a string (no 0x02 byte before the name)
         s = StringIO('\x00\x00\x07\x00\x26\x5f\x00\x00\x00\x00' +
@@ -309,13 +327,16 @@ class TestScriptTag(TestUnderStrictParsing):
         t = tags.ScriptTag(None, s)
         self.assertRaises(tags.MalformedFLV, t.parse)
 
-        # an ECMAArray without the marer, should fail under strict parsing
+        # an ECMAArray without the marer, should fail under strict parsing,
+        # but only once the value gets decoded
         s = StringIO('\x00\x00\x25\x00\x26\x5f\x00\x00\x00\x00' +
                      '\x02\x00\x0aonMetaData\x08\x00\x00\x00\x01' +
                      '\x00\x08duration\x00\x3f\xf0\x00\x00\x00\x00\x00\x00' +
                      '\x00\x00\x00\x30')
         t = tags.ScriptTag(None, s)
-        self.assertRaises(primitives.EndOfFile, t.parse)
+        t.parse()
+        self.assertEquals(t.name, 'onMetaData')
+        self.assertRaises(primitives.EndOfFile, getattr, t, 'variable')
 
     def test_repr(self):
         s = LStringIO('\x00\x00\x07\x00\x26\x5f\x00\x00\x00\x00' +
@@ -342,6 +363,20 @@ class TestScriptAMF3Tag(TestUnderStrictParsing):
         self.assertEquals(t.offset, -1)
         self.assertEquals(t.size, 23)
         self.assertEquals(t.timestamp, 77)
+        self.assertEquals(t.name, 'streamPing')
+        self.assertEquals(t.variable, 1385570497717.0)
+
+    def test_amf3_variable(self):
+        value = {'code': 'NetStream.Data', 'level': [1, 1.5, 'status']}
+        tag = tags.create_script_amf3_tag('onStatus', value, 10)
+        t = tags.ScriptAMF3Tag(None, StringIO(tag[1:]))
+        t.parse()
+
+        self.assertEquals(t.name, 'onStatus')
+        self.assertEquals(t.timestamp, 10)
+        self.assertEquals(dict(t.variable), value)
+        self.assertEquals(tag[11:12], '\x00')
+        self.assertEquals(tag[23:24], chr(constants.VALUE_TYPE_AVMPLUS))
 
     def test_repr(self):
         s = LStringIO('\x00\x00\x17\x00\x00\x4d\x00\x00\x00\x00' +
@@ -393,6 +428,322 @@ class TestFLV(TestUnderStrictParsing, BodyGeneratorMixin):
         self.assertTrue(isinstance(f.tags[3], tags.ScriptAMF3Tag))
         self.assertTrue(isinstance(f.tags[4], tags.ScriptTag))
 
+    def test_single_read_header(self):
+        # the same tag parsed from FLV.get_next_tag and through Tag.parse
+        body = '\x00\x00\x0f\xcc\xff\x1b\xff\x00\x00\x00' + '\x2d' * 15
+        s = StringIO('FLV\x00\x04\x00\x00\x00\x09\x00\x00\x00\x00' +
+                     '\x08' + body + '\x00\x00\x00\x1a')
+        f = tags.FLV(s)
+        f.parse_header()
+
+        # both negative timestamps should give a warning
+        warnings = test_common.WarningCounterFilter()
+        logging.getLogger('flvlib.tags').addFilter(warnings)
+        t = f.get_next_tag()
+        t2 = tags.AudioTag(None, StringIO(body + '\x00\x00\x00\x1a'))
+        t2.type = constants.TAG_TYPE_AUDIO
+        t2.parse()
+        logging.getLogger('flvlib.tags').removeFilter(warnings)
+
+        self.assertEquals(warnings.warnings, 2)
+
+        self.assertEquals(t.offset, 13)
+        for tag in (t, t2):
+            self.assertEquals(tag.size, 15)
+            self.assertEquals(tag.timestamp, -3342565)
+            self.assertEquals(tag.previous_tag_size, 26)
+            self.assertEquals(tag.sound_format, constants.SOUND_FORMAT_MP3)
+        self.assertRaises(tags.EndOfTags, f.get_next_tag)
+
+    def test_payload_modes(self):
+        s = StringIO('FLV\x00\x05\x00\x00\x00\x09\x00\x00\x00\x00' +
+                     '\x08' + self.tag_body('\xaf\x01') +
+                     '\x09' + self.tag_body('\x22') +
+                     '\x09' + self.tag_body('\x17\x01\x00\x00\x00') +
+                     '\x12' + ('\x00\x00\x07\x00\x26\x5f\x00\x00\x00\x00' +
+                               '\x02\x00\x03\x66\x6f\x6f\x05\x00\x00\x00\x12'))
+
+        f = tags.FLV(s)
+        audio, video, h264, script = list(f.iter_tags(tags.PAYLOAD_NONE))
+        self.assertEquals([t.timestamp for t in (audio, video, h264, script)],
+                          [9823] * 4)
+        self.assertEquals(audio.offset, 13)
+        self.assertEquals(h264.offset, 13 + 2 * 25)
+        self.assertTrue(audio.sound_format is None)
+        self.assertTrue(video.frame_type is None)
+
+        f = tags.FLV(s)
+        audio, video, h264, script = list(f.iter_tags(tags.PAYLOAD_FLAGS))
+        self.assertEquals(audio.sound_format, constants.SOUND_FORMAT_AAC)
+        self.assertEquals(audio.aac_packet_type,
+                          constants.AAC_PACKET_TYPE_RAW)
+        self.assertEquals(video.frame_type, constants.FRAME_TYPE_INTERFRAME)
+        self.assertEquals(video.codec_id, constants.CODEC_ID_H263)
+        self.assertEquals(h264.frame_type, constants.FRAME_TYPE_KEYFRAME)
+        self.assertEquals(h264.h264_packet_type,
+                          constants.H264_PACKET_TYPE_NALU)
+        self.assertEquals(h264.nalus, [])
+        self.assertEquals(script.data, '\x02\x00\x03\x66\x6f\x6f\x05')
+
+        # the override only lasts for that iteration, also when it stops
+        # early
+        self.assertEquals(f.payload, tags.PAYLOAD_FULL)
+        tag_iterator = f.iter_tags(tags.PAYLOAD_NONE)
+        self.assertTrue(tag_iterator.next().sound_format is None)
+        tag_iterator.close()
+        self.assertEquals(f.payload, tags.PAYLOAD_FULL)
+        audio = list(f.iter_tags())[0]
+        self.assertEquals(audio.sound_format, constants.SOUND_FORMAT_AAC)
+
+    def test_mapped_file(self):
+        nalu = '\x65\x88\x80' + 'x' * 20
+        body = ('\x09' + '\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00' +
+                '\x17\x01\x00\x00\x00\x00\x00\x00\x17' + nalu +
+                '\x00\x00\x00\x2b' +
+                '\x08' + self.tag_body('\xaf\x01' + 'audio') +
+                '\x12' + ('\x00\x00\x07\x00\x26\x5f\x00\x00\x00\x00' +
+                          '\x02\x00\x03\x66\x6f\x6f\x05\x00\x00\x00\x12'))
+        fd, path = tempfile.mkstemp()
+        os.write(fd, 'FLV\x00\x05\x00\x00\x00\x09\x00\x00\x00\x00' + body)
+        os.close(fd)
+
+        f = open(path, 'rb')
+        m = helpers.MappedFile(f)
+        try:
+            video, audio, script = list(tags.FLV(m).iter_tags())
+
+            # payloads point into the mapped file instead of being copies
+            self.assertTrue(isinstance(video.nalus[0].data, buffer))
+            self.assertEquals(str(video.nalus[0].data), nalu)
+            self.assertEquals(video.nalus[0].frame_num, 0)
+            self.assertTrue(isinstance(audio.data, buffer))
+            self.assertEquals(str(audio.data), 'audio\x00\x00\x00')
+            self.assertTrue(isinstance(script.data, buffer))
+
+            # and get written out as they are
+            out = StringIO()
+            for tag in (video, audio, script):
+                tag.write(out)
+            self.assertEquals(out.getvalue(), body)
+
+            # from ordinary files audio payloads are only copied on request
+            f.seek(0)
+            audio = list(tags.FLV(f).iter_tags())[1]
+            self.assertEquals(audio.data, None)
+            f.seek(0)
+            audio = list(tags.FLV(f, keep_audio_data=True).iter_tags())[1]
+            self.assertEquals(audio.data, 'audio\x00\x00\x00')
+        finally:
+            m.close()
+            f.close()
+            os.remove(path)
+
+    def test_audio_data_not_kept(self):
+        body = ('\x08' + self.tag_body('\xaf\x01' + 'audio') +
+                '\x08' + self.tag_body('\x2f' + 'mp3'))
+        fd, path = tempfile.mkstemp()
+        os.write(fd, 'FLV\x00\x05\x00\x00\x00\x09\x00\x00\x00\x00' + body)
+        os.close(fd)
+
+        f = open(path, 'rb')
+        try:
+            # the payloads get read back from the file for writing
+            for source in (f, StringIO(test_common.read_file(path))):
+                source.seek(0)
+                out = StringIO()
+                for tag in tags.FLV(source).iter_tags():
+                    self.assertEquals(tag.data, None)
+                    tag.write(out)
+                self.assertEquals(out.getvalue(), body)
+
+            # which detached tags can't do
+            f.seek(0)
+            flv = tags.FLV(f)
+            flv.read_tags()
+            self.assertRaises(ValueError, flv.tags[0].write, StringIO())
+        finally:
+            f.close()
+            os.remove(path)
+
+    def test_compact_tags(self):
+        s = StringIO('FLV\x00\x05\x00\x00\x00\x09\x00\x00\x00\x00' +
+                     '\x08' + self.tag_body('\x4b') +
+                     '\x09' + self.tag_body('\x17\x00') +
+                     '\x12' + ('\x00\x00\x07\x00\x26\x5f\x00\x00\x00\x00' +
+                               '\x02\x00\x03\x66\x6f\x6f\x05\x00\x00\x00\x12'))
+        f = tags.FLV(s)
+        f.read_tags()
+
+        for tag in f.tags:
+            self.assertFalse(hasattr(tag, '__dict__'))
+            # read_tags does not keep references to the file around
+            self.assertTrue(tag.f is None)
+            self.assertTrue(tag.parent_flv is None)
+        self.assertEquals(f.tags[1].frame_type, constants.FRAME_TYPE_KEYFRAME)
+
+        # an AVC sequence header with one SPS and one PPS
+        record = ('\x01\x42\x00\x1e\xff\xe1' +
+                  '\x00\x09\x67\x42\x00\x1e\x95\xa8\x28\x0f\x64' +
+                  '\x01\x00\x04\x68\xce\x3c\x80')
+        body = ('\x09\x00\x00\x1d\x00\x00\x00\x00\x00\x00\x00' +
+                '\x17\x00\x00\x00\x00' + record + '\x00\x00\x00\x28')
+        data = 'FLV\x01\x01\x00\x00\x00\x09\x00\x00\x00\x00' + body
+        f = tags.FLV(StringIO(data))
+        f.read_tags()
+        parser = tags.FLVParser()
+        for tag in (f.tags[0], parser.feed(data)[0]):
+            nalus = tag.configurationRecord.sps + tag.configurationRecord.pps
+            self.assertEquals(len(nalus), 2)
+            self.assertTrue(tag.configurationRecord.f is None)
+            for nalu in nalus:
+                self.assertTrue(nalu.f is None)
+            out = StringIO()
+            tag.write(out)
+            self.assertEquals(out.getvalue(), body)
+
+        sps = tags.SPS(None, None)
+        self.assertFalse(hasattr(sps, '__dict__'))
+        self.assertEquals(sps.profile_idc, -1)
+        self.assertEquals(sps.nal_unit_type, -1)
+        self.assertEquals(sps.frame_crop_offsets, [])
+        self.assertFalse(sps.frame_crop_offsets is
+                         tags.SPS(None, None).frame_crop_offsets)
+
+    def test_follow_tags(self):
+        header = 'FLV\x00\x05\x00\x00\x00\x09\x00\x00\x00\x00'
+        audio = '\x08' + self.tag_body('\x4b')
+        video = '\x09' + self.tag_body('\x17\x00')
+        fd, path = tempfile.mkstemp()
+        os.write(fd, header[:10])
+        f = open(path, 'rb')
+
+        flv = tags.FLV(f)
+        self.assertEquals(list(flv.follow_tags(timeout=0)), [])
+        self.assertTrue(flv.follow_offset is None)
+
+        # a tag that's not complete yet is left for later
+        os.write(fd, header[10:] + audio + video[:-1])
+        followed = list(flv.follow_tags(timeout=0))
+        self.assertEquals(len(followed), 1)
+        self.assertTrue(isinstance(followed[0], tags.AudioTag))
+        self.assertEquals(flv.follow_offset, 13 + len(audio))
+
+        # resume where the previous run stopped
+        os.write(fd, video[-1:] + audio)
+        followed = list(tags.FLV(f).follow_tags(flv.follow_offset,
+                                                timeout=0))
+        self.assertEquals([tag.offset for tag in followed],
+                          [13 + len(audio), 13 + len(audio) + len(video)])
+        self.assertTrue(isinstance(followed[0], tags.VideoTag))
+
+        # waiting gives up after the timeout
+        flv = tags.FLV(f)
+        list(flv.follow_tags(timeout=0))
+        self.assertEquals(flv.follow_offset, 13 + 2 * len(audio) + len(video))
+        self.assertEquals(list(flv.follow_tags(flv.follow_offset,
+                                               poll_interval=0.01,
+                                               timeout=0.05)), [])
+
+        os.close(fd)
+        f.close()
+        os.remove(path)
+
+    def test_follow_tags_resume(self):
+        data = tags.create_flv_header() + ''.join(
+            [tags.create_flv_tag(constants.TAG_TYPE_AUDIO, '\x2f' * 20, i * 10)
+             for i in range(4)])
+        fd, path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        f = open(path, 'rb')
+
+        # stop after the tag at 10, having moved f around meanwhile
+        flv = tags.FLV(f)
+        for tag in flv.follow_tags(timeout=0):
+            f.seek(0)
+            if tag.timestamp == 10:
+                break
+        self.assertEquals(flv.follow_offset, tag.offset + 35)
+
+        followed = tags.FLV(f).follow_tags(flv.follow_offset, timeout=0)
+        self.assertEquals([tag.timestamp for tag in followed], [20, 30])
+
+        # with a payload mode of its own, that doesn't stick
+        flv = tags.FLV(f)
+        followed = list(flv.follow_tags(payload=tags.PAYLOAD_NONE, timeout=0))
+        self.assertEquals(len(followed), 4)
+        self.assertTrue(followed[0].sound_format is None)
+        self.assertEquals(flv.follow_offset, len(data))
+        self.assertEquals(flv.payload, tags.PAYLOAD_FULL)
+
+        f.close()
+        os.remove(path)
+
+    def test_recover(self):
+        tag_list = [tags.create_flv_tag(constants.TAG_TYPE_AUDIO,
+                                        '\x2f' * 20, i * 10)
+                    for i in range(6)]
+        data = tags.create_flv_header() + ''.join(tag_list)
+        # a torn write in the third tag and a truncated last one
+        damaged = (data[:13 + 35 * 2 + 5] + '\xff' * 30 +
+                   data[13 + 35 * 3:-10])
+
+        self.assertRaises(tags.MalformedFLV, list,
+                          tags.FLV(StringIO(damaged)).iter_tags())
+
+        flv = tags.FLV(StringIO(damaged), recover=True)
+        self.assertEquals([tag.timestamp for tag in flv.iter_tags()],
+                          [0, 10, 30, 40])
+        self.assertEquals(flv.skipped, [(83, 118), (188, len(damaged))])
+
+        # candidates with earlier timestamps are not accepted
+        flv = tags.FLV(StringIO(data), recover=True)
+        self.assertEquals(flv.find_next_tag(14), 48)
+        self.assertEquals(flv.find_next_tag(14, 30), 118)
+        self.assertEquals(flv.find_next_tag(14, 60), None)
+
+    def test_recover_buffer_boundary(self):
+        old_size = tags.RESYNC_BUFFER_SIZE
+        tags.RESYNC_BUFFER_SIZE = 16
+        try:
+            data = (tags.create_flv_header() + 'x' * 50 +
+                    tags.create_flv_tag(constants.TAG_TYPE_AUDIO, '\x2f') +
+                    tags.create_flv_tag(constants.TAG_TYPE_AUDIO, '\x2f'))
+            flv = tags.FLV(StringIO(data), recover=True)
+            for start in range(13, 64):
+                self.assertEquals(flv.find_next_tag(start), 63)
+            self.assertEquals(len(list(flv.iter_tags())), 2)
+            self.assertEquals(flv.skipped, [(13, 63)])
+        finally:
+            tags.RESYNC_BUFFER_SIZE = old_size
+
+    def test_parse_override(self):
+        # tag classes that override parse without arguments keep working
+        parsed = []
+
+        class CountingAudioTag(tags.AudioTag):
+            def parse(self):
+                tags.AudioTag.parse(self)
+                parsed.append(self.offset)
+
+        class CountingFLV(tags.FLV):
+            def tag_type_to_class(self, tag_type):
+                return CountingAudioTag
+
+        s = StringIO('FLV\x00\x04\x00\x00\x00\x09\x00\x00\x00\x00' +
+                     '\x08' + self.tag_body('\x2f') +
+                     '\x08' + self.tag_body('\x2f'))
+        tag_list = list(CountingFLV(s).iter_tags())
+        self.assertEquals(parsed, [13, 38])
+        self.assertEquals([t.timestamp for t in tag_list], [9823, 9823])
+
+    def test_truncated_header(self):
+        s = StringIO('FLV\x00\x04\x00\x00\x00\x09\x00\x00\x00\x00' +
+                     '\x08\x00\x00\x0a\x00')
+        f = tags.FLV(s)
+        f.parse_header()
+        self.assertRaises(primitives.EndOfFile, f.get_next_tag)
+
     def test_errors(self):
         # file shorter than 3 bytes
         s = StringIO()
@@ -411,6 +762,140 @@ class TestFLV(TestUnderStrictParsing, BodyGeneratorMixin):
         self.assertRaises(tags.MalformedFLV, f.read_tags)
 
 
+class TestFLVParser(TestUnderStrictParsing, BodyGeneratorMixin):
+
+    def stream(self):
+        return ('FLV\x00\x05\x00\x00\x00\x09\x00\x00\x00\x00' +
+                '\x08' + self.tag_body('\xaf\x01' + 'audio') +
+                '\x09' + self.tag_body('\x17\x00') +
+                '\x12' + ('\x00\x00\x07\x00\x26\x5f\x00\x00\x00\x00' +
+                          '\x02\x00\x03\x66\x6f\x6f\x05\x00\x00\x00\x12'))
+
+    def check_tags(self, parsed):
+        self.assertEquals([tag.offset for tag in parsed], [13, 38, 63])
+        audio, video, script = parsed
+        self.assertTrue(isinstance(audio, tags.AudioTag))
+        self.assertEquals(audio.aac_packet_type,
+                          constants.AAC_PACKET_TYPE_RAW)
+        self.assertEquals(audio.data, 'audio\x00\x00\x00')
+        self.assertTrue(isinstance(video, tags.VideoTag))
+        self.assertEquals(video.frame_type, constants.FRAME_TYPE_KEYFRAME)
+        self.assertTrue(isinstance(script, tags.ScriptTag))
+        for tag in parsed:
+            self.assertEquals(tag.timestamp, 9823)
+            self.assertTrue(tag.f is None)
+
+    def test_single_chunk(self):
+        parser = tags.FLVParser()
+        self.check_tags(parser.feed(self.stream()))
+        self.assertEquals(parser.version, 0)
+        self.assertEquals(parser.has_audio, True)
+        self.assertEquals(parser.has_video, True)
+        parser.close()
+
+    def test_split_chunks(self):
+        data = self.stream()
+        for chunk_size in (1, 2, 7, 12, 25):
+            parser = tags.FLVParser()
+            parsed = []
+            for i in xrange(0, len(data), chunk_size):
+                parsed.extend(parser.feed(data[i:i + chunk_size]))
+                # never more than a tag is kept around
+                self.assertTrue(parser.buffered <= 25)
+            self.check_tags(parsed)
+            parser.close()
+
+    def test_payload_modes(self):
+        parser = tags.FLVParser(payload=tags.PAYLOAD_FLAGS)
+        audio, video, script = parser.feed(self.stream())
+        self.assertEquals(audio.aac_packet_type,
+                          constants.AAC_PACKET_TYPE_RAW)
+        self.assertEquals(audio.data, None)
+
+    def test_errors(self):
+        data = self.stream()
+
+        parser = tags.FLVParser()
+        self.assertEquals(len(parser.feed(data[:-1])), 2)
+        self.assertRaises(primitives.EndOfFile, parser.close)
+        self.assertRaises(primitives.EndOfFile, tags.FLVParser().close)
+
+        parser = tags.FLVParser()
+        self.assertRaises(tags.MalformedFLV, parser.feed, 'FLX' + data[3:])
+
+        # bogus data is rejected without waiting for a header of the size
+        # it claims
+        for bogus in ('<html><head>', 'FLV\x01\x05\xff\xff\xff\xff',
+                      'FLV\x01\x05\x00\x00\x00\x03\x00\x00\x00\x00'):
+            parser = tags.FLVParser()
+            self.assertEquals(parser.feed(bogus[:8]), [])
+            self.assertRaises(tags.MalformedFLV, parser.feed, bogus[8:])
+
+        parser = tags.FLVParser()
+        parser.feed(data[:13])
+        self.assertRaises(tags.MalformedFLV, parser.feed,
+                          '\x01' + self.tag_body('\x2f'))
+
+
+class TestFLVWriter(unittest.TestCase, BodyGeneratorMixin):
+
+    def test_same_as_tag_write(self):
+        nalu = '\x65\x88\x80' + 'x' * 20
+        data = ('FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00' +
+                '\x09' + '\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00' +
+                '\x17\x01\x00\x00\x00\x00\x00\x00\x17' + nalu +
+                '\x00\x00\x00\x2b' +
+                '\x08' + self.tag_body('\xaf\x01' + 'audio') +
+                '\x12' + ('\x00\x00\x07\xff\xff\xff\xff\x00\x00\x00' +
+                          '\x02\x00\x03\x66\x6f\x6f\x05\x00\x00\x00\x12'))
+        tag_list = list(tags.FLV(StringIO(data),
+                                 keep_audio_data=True).iter_tags())
+        self.assertEquals(tag_list[2].timestamp, -1)
+
+        for buffer_size in (1, 10, 1000):
+            out = StringIO()
+            writer = tags.FLVWriter(out, buffer_size)
+            writer.write_header()
+            for tag in tag_list:
+                writer.write_tag(tag)
+            writer.close()
+            self.assertEquals(out.getvalue(), data)
+
+        out = StringIO()
+        for tag in tag_list:
+            tag.write(out)
+        self.assertEquals(out.getvalue(), data[13:])
+
+    def test_audio_from_plain_file(self):
+        path = test_common.make_flv(seconds=2, aac=True, midstream=True)
+        f = open(path, 'rb')
+        try:
+            # the audio payloads get read back from f as the tags come
+            out = StringIO()
+            writer = tags.FLVWriter(out, 100)
+            flv = tags.FLV(f)
+            flv.parse_header()
+            writer.write_header(flv.has_audio, flv.has_video)
+            for tag in flv.iter_tags():
+                writer.write_tag(tag)
+            writer.close()
+            self.assertEquals(out.getvalue(), test_common.read_file(path))
+        finally:
+            f.close()
+            os.remove(path)
+
+    def test_buffering(self):
+        out = StringIO()
+        writer = tags.FLVWriter(out, 10)
+        writer.write('abc')
+        self.assertEquals(out.getvalue(), '')
+        writer.write(buffer('defghijk', 0, 7))
+        self.assertEquals(out.getvalue(), 'abcdefghij')
+        writer.write('x')
+        writer.flush()
+        self.assertEquals(out.getvalue(), 'abcdefghijx')
+
+
 class TestCreateTags(TestUnderStrictParsing):
 
     def test_create_flv_tag(self):
@@ -426,6 +911,12 @@ class TestCreateTags(TestUnderStrictParsing):
                               '\x02\x00\x0aonMetaData\x08\x00\x00\x00\x01' +
                               '\x00\x05silly\x01\x01\x00\x00\x09' +
                               '\x00\x00\x00\x29'))
+        self.assertEquals(tags.script_tag_size('onMetaData', {'silly': True}),
+                          len(s))
+        metadata = {'keyframes': {'times': [0.0, 2.5], 'filepositions': [13]},
+                    'metadatacreator': u'fl\xfcvlib'}
+        self.assertEquals(tags.script_tag_size('onMetaData', metadata),
+                          len(tags.create_script_tag('onMetaData', metadata)))
 
     def test_create_flv_header(self):
         data = (((True, True), 'FLV\x01\x05\x00\x00\x00\t\x00\x00\x00\x00'),